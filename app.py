@@ -1,9 +1,18 @@
 import streamlit as st
 from data_handler import DataHandler
 from aws.aws_handler import AWSHandler
-from snow.snow_handler import SnowflakeHandler
-import uuid
+from backends import create_warehouse_handler
+from experiment_index import ExperimentIndex
+from result_cache import ResultCache
+from tracing import Tracer
+from jobs import ACTIVE_STATES, create_job_runner, run_ingest
+from ingest_scheduler import create_ingest_scheduler
+from report import create_report_builder
+from schema import memory_usage
+from collections import OrderedDict
 import pandas as pd
+import re
+import uuid
 
 st.title(
     """
@@ -14,7 +23,7 @@ Smart Data Analyzer :female-scientist: :male-scientist:
 st.markdown(
     "Your data should be in the following **format**:",
     help="""
-📋 **Expected file format:** `.csv`
+📋 **Expected file format:** `.csv` or `.parquet` (with the same names and columns)
 📋 **Required files and columns:**
 
 **`data_photodynamic_therapy_cell_lines.csv`**
@@ -38,9 +47,49 @@ st.markdown(
 """,
 )
 
-data_handler = DataHandler()
-aws_handler = AWSHandler()
-snow_handler = SnowflakeHandler() 
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(".cache/results")
+
+@st.cache_resource
+def get_job_runner():
+    return create_job_runner()
+
+@st.cache_resource
+def get_ingest_scheduler():
+    cache = get_result_cache()
+    # the batch spans are recorded on the factory's tracer and copied to every submitting session
+    return create_ingest_scheduler(lambda tracer: create_warehouse_handler(cache, tracer))
+
+@st.cache_resource
+def get_report_builder():
+    return create_report_builder(DataHandler())
+
+@st.fragment(run_every=1)
+def show_job_progress(job_id):
+    """
+    Shows the progress of an ingest job and reruns the page once it has finished.
+    """
+    job = job_runner.get(job_id)
+    if job is None or job["state"] not in ACTIVE_STATES:
+        st.rerun()
+    stages = ["uploading", "loading", "merging"]
+    done = stages.index(job["state"]) + job["progress"].get(job["state"], 0.0) if job["state"] in stages else 0.0
+    st.progress(done / len(stages), text=f"Saving your data: {job['state']}...")
+
+tracer = st.session_state.setdefault('tracer', Tracer())
+job_runner = get_job_runner()
+result_cache = get_result_cache()
+# the S3 client and the warehouse backend are created, and connections opened, on first use
+aws_handler = AWSHandler(tracer=tracer)
+snow_handler = create_warehouse_handler(result_cache, tracer)
+data_handler = DataHandler(staging_format=snow_handler.staging_format)
+data_handler.replicate_statistics.exclude_outliers = st.sidebar.toggle(
+    "Exclude outlier replicates from MEAN",
+    key="exclude_outliers",
+    disabled=snow_handler.aggregation_mode == "warehouse",
+    help="Replicates with a modified z-score above 3.5 within their well are left out of MEAN, STD and CV.",
+)
 
 
 if "data_uploaded" not in st.session_state:
@@ -57,75 +106,170 @@ if st.session_state['user_id'] is None:
     ##TODO: create a button to generate a new ID
     ##TODO: create a button to use an existing ID
     ##TODO: create a function to check if the ID already exists in the database
-    # generate a unique user ID
+    # generate a unique user ID, unless the link already carries one
     full_uuid = uuid.uuid4()
     hex_uuid = full_uuid.hex
-    st.session_state['user_id'] = hex_uuid[:10]
+    linked_user_id = st.query_params.get("user_id", "")
+    st.session_state['user_id'] = linked_user_id if re.fullmatch(r"[A-Za-z0-9]{1,20}", linked_user_id) else hex_uuid[:10]
+    st.query_params["user_id"] = st.session_state['user_id']
+    tracer.user_id = st.session_state['user_id']
+
+    # a reload during an ingest reattaches to its job
+    linked_job = job_runner.get(st.query_params.get("job_id", "0"))
+    if linked_job is not None and linked_job["user_id"] == st.session_state['user_id']:
+        st.session_state['job_id'] = linked_job["job_id"]
+        st.session_state["data_uploaded"] = True
+    # returning users with cached results skip the upload and the merges
+    elif result_cache.has_results(st.session_state['user_id']):
+        st.session_state["data_uploaded"] = True
+        st.session_state["snowflake_connected"] = True
+        st.session_state["returning_user"] = True
 
 with st.container():
     ##TODO: add note to inform the user that the ID is generated automatically or that they can choose an existing one
     st.write(f"**Your Unique ID:** {st.session_state['user_id']}")
+    if st.session_state.get("returning_user") and st.button("Upload new data :arrows_counterclockwise:"):
+        st.session_state["returning_user"] = False
+        st.session_state.pop('job_id', None)
+        st.query_params.pop("job_id", None)
+        st.session_state["data_uploaded"] = False
+        st.session_state["snowflake_connected"] = False
+        st.session_state["data_updated"] = False
+        st.rerun()
 
 if not st.session_state["data_uploaded"]:
     ##TODO: add function to this part
     uploaded_files = data_handler.upload_user_files()
     if uploaded_files:
-        valid_files = data_handler.validate_user_data(uploaded_files)
+        with tracer.span("validate", files=len(uploaded_files)) as span:
+            valid_files = data_handler.validate_user_data(uploaded_files)
+            span["rows"] = sum(data_handler.row_counts.values())
         if valid_files:
             if st.button("Save your data :cloud:"):
-                with st.spinner("Uploading your data to the cloud..."):
-                    uploaded_files = aws_handler.upload_files_to_s3(valid_files)
-                    if uploaded_files:
-                        st.success(
-                            ":white_check_mark: Your data has been saved to the cloud."
-                        )
-                        st.session_state["data_uploaded"] = True 
-
-                   
-if st.session_state["data_uploaded"] and not st.session_state['snowflake_connected']:
-    with st.spinner('Waiting for Snowflake...', show_time=True):
-        st.session_state['snowflake_connected'] = True
+                result_cache.invalidate(st.session_state['user_id'])
+                # the upload, Snowpipe wait and merges run in the background, see `jobs.run_ingest`
+                job_id = job_runner.submit(
+                    st.session_state['user_id'], run_ingest, valid_files, dict(data_handler.row_counts),
+                    list(data_handler.load_ids.values()), st.session_state['user_id'], aws_handler,
+                    lambda: create_warehouse_handler(result_cache, tracer), get_ingest_scheduler(),
+                )
+                st.session_state['job_id'] = job_id
+                st.query_params["job_id"] = job_id
+                st.session_state["data_uploaded"] = True
+                st.rerun()
 
-        snow_handler.reset_pipeline()
+if st.session_state.get('job_id') and not st.session_state['snowflake_connected']:
+    job = job_runner.get(st.session_state['job_id'])
+    if job is None or job["state"] == "failed":
+        st.error(f":x: Saving your data failed: {job['error'] if job else 'the job was not found.'}")
+        if st.button("Try again :arrows_counterclockwise:"):
+            del st.session_state['job_id']
+            del st.query_params["job_id"]
+            st.session_state["data_uploaded"] = False
+            st.rerun()
+    elif job["state"] == "ready":
+        st.session_state['snowflake_connected'] = True
+        st.success(":white_check_mark: Your data has been saved and merged.")
+        merge_timings = job["result"]["merge_timings"]
+        st.caption(
+            f"Merged with {job['result']['batch_size'] - 1} other uploads. Merge timings: "
+            + ", ".join(f"{step} {seconds:.1f} s" for step, seconds in merge_timings.items())
+        )
+    else:
+        show_job_progress(st.session_state['job_id'])
 
 if st.session_state['snowflake_connected'] and not st.session_state['data_updated']:
-    ##TODO: find a faster way to do this
-    with st.spinner("Merging data into target tables..."):
-        snow_handler.call_procedure("merge_into_dim_cell_lines()")
-        snow_handler.call_procedure("merge_into_dim_drugs()")
-        snow_handler.call_procedure("merge_into_fac_results()")
-
-    tables = ["dim_cell_lines", "dim_drugs", "fac_results"]
-    for table in tables:
-        with st.spinner(f'Fetching {table}...'):
-            columns, data = snow_handler.fetch_data(table)
-            df = pd.DataFrame(data, columns=columns)
-            st.session_state["data"][table] = df
-
-    results = snow_handler.fetch_full_data("combined_results", st.session_state['user_id'])
-    st.session_state['data'] = results
-    st.session_state["data_updated"] = True
+    if snow_handler.aggregation_mode == "warehouse":
+        # Survival is computed in Snowflake per experiment, only the experiment numbers are fetched here
+        with st.spinner('Fetching your experiments...'), tracer.span("fetch"):
+            results = snow_handler.fetch_full_data("combined_results", st.session_state['user_id'], columns=["EXPERIMENT_NUMBER"])
+        if results is not None:
+            st.session_state['experiment_numbers'] = sorted(int(n) for n in results['EXPERIMENT_NUMBER'])
+            st.session_state['survival'] = {}
+    else:
+        with st.spinner('Fetching your results...'), tracer.span("fetch"):
+            results = snow_handler.fetch_full_data("combined_results", st.session_state['user_id'])
+        if results is not None:
+            st.session_state['experiment_index'] = ExperimentIndex(results)
+            st.session_state['experiment_numbers'] = st.session_state['experiment_index'].numbers
+            st.session_state['data'] = st.session_state['experiment_index'].data
+            st.session_state['analysis'] = None
+    if results is None:
+        # data_updated stays False, so the fetch is retried on the next rerun
+        st.error(":x: Fetching your results failed. Please try again.")
+    else:
+        st.session_state['fits'] = {}
+        st.session_state["data_updated"] = True
+
+exclude_outliers = data_handler.replicate_statistics.exclude_outliers
+if st.session_state['data_updated'] and snow_handler.aggregation_mode != "warehouse" and (
+    st.session_state.get('analysis') is None or st.session_state.get('analysis_excludes_outliers') != exclude_outliers
+):
+    with st.spinner('Analyzing your data...'), tracer.span("analyze_all_experiments", exclude_outliers=exclude_outliers) as span:
+        analysis = data_handler.analyze_all_experiments(st.session_state['data'])
+        span["rows"] = len(analysis)
+        st.session_state['analysis'] = ExperimentIndex(analysis)
+    st.session_state['analysis_excludes_outliers'] = exclude_outliers
+    st.session_state['fits'] = {}
 
 if st.session_state['data_updated'] and not st.session_state['data_analyzed']:
     ##TODO: write test for this part
-    df = st.session_state['data']
-    number = st.number_input("Insert experiment number", value = None, step = 1, min_value = 1)
+    experiment_numbers = st.session_state['experiment_numbers']
+    number = st.number_input(
+        "Insert experiment number",
+        value = None,
+        step = 1,
+        min_value = experiment_numbers[0] if experiment_numbers else 1,
+        max_value = experiment_numbers[-1] if experiment_numbers else None,
+        help = f"Available experiments: {experiment_numbers}",
+    )
 
     if number is not None:
-        with st.spinner('Analyzing your data...'):
-            experiment_data = data_handler.fetch_experiment_data(data = df, experiment_number = number)
-            experiment_data_analyzed, control_means, full_experiment_data = data_handler.analyze_experiment_data(experiment_data)
-            user_result = data_handler.calculate_survival(full_experiment_data)
+        with st.spinner('Analyzing your data...'), tracer.span("analyze_experiment", experiment_number=number):
+            if snow_handler.aggregation_mode == "warehouse":
+                user_result = st.session_state['survival'].get(number)
+                if user_result is None:
+                    user_result = snow_handler.fetch_experiment_survival(
+                        "combined_results", st.session_state['user_id'], number
+                    )
+                    # a failed fetch (None) is not cached, so it is retried
+                    if user_result is not None:
+                        st.session_state['survival'][number] = user_result
+            else:
+                user_result = data_handler.slice_experiment(st.session_state['analysis'], experiment_number = number)
 
-            with st.expander("Analysis Results:"):
-                st.write(user_result)
+    if number is not None and (user_result is None or user_result.empty):
+        st.warning(f":warning: Experiment {number} has no analyzable data. Available experiments: {experiment_numbers}")
+        number = None
 
-            st.subheader("Select parameters for your plot")
-            
-            options = list(user_result.columns)
-            cell_lines = user_result['CELL_LINE_NAME'].unique()
-            drugs = user_result['DRUG_NAME'].unique()
-            treatment_times = user_result['TREATMENT_TIME'].unique()
+    if number is not None:
+        with st.expander("Analysis Results:"):
+            st.write(user_result)
+
+        if number not in st.session_state['fits']:
+            with st.spinner('Fitting dose-response curves...'), tracer.span("fit_dose_response", experiment_number=number) as span:
+                fits = data_handler.fit_dose_response(user_result)
+                span["groups"] = int(fits['IC50'].notna().sum())
+                # None when no group has enough concentrations to be fitted
+                st.session_state['fits'][number] = fits if fits['IC50'].notna().any() else None
+        fits = st.session_state['fits'][number]
+        if fits is None:
+            st.info(
+                f":information_source: No dose-response curves were fitted: every group has fewer than "
+                f"{data_handler.curve_fitter.min_concentrations} distinct concentrations."
+            )
+        else:
+            with st.expander("Dose-response fits (IC50):"):
+                st.dataframe(fits, hide_index=True)
+                if not fits['CONVERGED'].all():
+                    st.caption("Fits that did not converge to a plausible dose-response curve (CONVERGED is False) are drawn dashed.")
+
+        st.subheader("Select parameters for your plot")
+        
+        options = list(user_result.columns)
+        cell_lines = user_result['CELL_LINE_NAME'].unique()
+        drugs = user_result['DRUG_NAME'].unique()
+        treatment_times = user_result['TREATMENT_TIME'].unique()
 
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -140,15 +284,72 @@ if st.session_state['data_updated'] and not st.session_state['data_analyzed']:
         else:
             selected_value = st.selectbox("Select cell line:", cell_lines) 
         
+        layout = st.radio(
+            "Plot layout:", ["One figure, faceted by treatment time", "One figure per treatment time"],
+            index=0, horizontal=True,
+        )
+
+        data_version = f"{result_cache.version(st.session_state['user_id'])}-{number}{'-outliers-excluded' if exclude_outliers else ''}"
+
         ##TODO: create plots: interactive and publication ready
         if st.button("Create your plot :bar_chart:"):
-            with st.spinner("Creating your plot..."):
-                figures = data_handler.create_plots(user_result, filter_type, selected_value, x_axis, y_axis, treatment_times)
+            with st.spinner("Creating your plot..."), tracer.span("plot", layout=layout):
+                if layout == "One figure per treatment time":
+                    figures = data_handler.create_plots(user_result, filter_type, selected_value, x_axis, y_axis, treatment_times, fits=fits)
+                else:
+                    figures = [data_handler.create_faceted_plot(
+                        user_result, filter_type, selected_value, x_axis, y_axis, treatment_times,
+                        data_version=data_version, cache=st.session_state.setdefault('plot_cache', OrderedDict()), fits=fits,
+                    )]
                 for fig in figures:
                     st.plotly_chart(fig)
                 st.session_state['plot_created'] = True
 
-        ##TODO: download plots as a report pdf
+        report_key = (data_version, filter_type, x_axis, y_axis)
+        if st.button("Prepare a PDF report :page_facing_up:"):
+            progress_bar = st.progress(0.0, text="Rendering your report...")
+            with tracer.span("report", filter_type=filter_type) as span:
+                report_path = get_report_builder().build(
+                    user_result, data_version, filter_type, x_axis, y_axis, fits=fits,
+                    progress=lambda done, total: progress_bar.progress(done / total, text=f"Rendering page {done} of {total}..."),
+                )
+                span["bytes"] = report_path.stat().st_size
+            progress_bar.empty()
+            st.session_state['report'] = (report_key, report_path)
+
+        report = st.session_state.get('report')
+        if report is not None and report[0] == report_key and report[1].exists():
+            st.download_button(
+                "Download your report :arrow_down:",
+                data=report[1].read_bytes(),
+                file_name=f"experiment_{number}_report.pdf",
+                mime="application/pdf",
+            )
+
+if snow_handler.pool is not None:
+    with st.sidebar.expander("Connection pool"):
+        st.write(snow_handler.pool.stats())
+with st.sidebar.expander("Ingest jobs"):
+    st.write(job_runner.stats())
+    st.write(get_ingest_scheduler().stats())
+with st.sidebar.expander("Result cache"):
+    st.write(result_cache.stats())
+    st.write(get_report_builder().stats())
+with st.sidebar.expander("Session memory"):
+    session_frames = {
+        "data": st.session_state.get('data'),
+        "analysis": getattr(st.session_state.get('analysis'), 'data', None),
+        **{f"survival {n}": frame for n, frame in st.session_state.get('survival', {}).items()},
+    }
+    st.write({
+        name: f"{memory_usage(frame) / 1e6:.1f} MB"
+        for name, frame in session_frames.items() if isinstance(frame, pd.DataFrame)
+    })
+with st.sidebar.expander("Timings"):
+    st.dataframe(tracer.to_frame(), hide_index=True)
+
+# written only when this rerun recorded new spans
+tracer.export(".cache/traces")
 
 if snow_handler:
     snow_handler.close_connection()
\ No newline at end of file
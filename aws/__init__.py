@@ -1,3 +0,0 @@
-from utils import load_secrets
-
-secrets = load_secrets("secrets.yaml")
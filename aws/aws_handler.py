@@ -1,45 +1,251 @@
-import boto3
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gzip
+import hashlib
+import io
+import shutil
+import tempfile
+import time
 import streamlit as st
-from . import secrets
+from backends import get_backend, get_secrets
+from tracing import Tracer, traced
+from schema import is_parquet
 
 class AWSHandler:
-    def __init__(self):
+    def __init__(self, s3_client=None, tracer=None):
         """
-        Initializes the AWSHandler with credentials from secrets.
+        Initializes the AWSHandler with credentials and upload settings from secrets.
+
+        Parameters:
+        ----------
+        s3_client : object, optional
+            The storage client to upload with. Defaults to the shared boto3 S3 client of the
+            backend registry, created on the first upload. Any object with the same
+            `upload_fileobj` method (e.g. `LocalStorageClient`) can be used.
+        tracer : Tracer, optional
+            Records a span per upload, with byte counts.
         """
+        secrets = get_secrets()
         self.s3_secret_key = secrets["aws_secret_access_key"]
         self.key_id = secrets["aws_access_key_id"]
         self.bucket_name = secrets["s3_bucket_name"]
         self.region_name = secrets["aws_default_region"]
-        self.s3_user = boto3.client(
-            "s3",
-            aws_access_key_id=self.key_id,
-            aws_secret_access_key=self.s3_secret_key,
-            region_name=self.region_name,
-        )
+        self.compress = secrets.get("s3_gzip_uploads", True)
+        self.max_workers = secrets.get("s3_max_workers", 4)
+        self.transfer_settings = {
+            "multipart_threshold": secrets.get("s3_multipart_threshold_mb", 16) * 1024 * 1024,
+            "multipart_chunksize": secrets.get("s3_multipart_chunksize_mb", 8) * 1024 * 1024,
+            "max_concurrency": secrets.get("s3_max_part_workers", 8),
+        }
+        self.upload_stats = []
+        self.tracer = tracer or Tracer()
+        self._s3_client = s3_client
+        self._transfer_config = None
+
+    @property
+    def s3_user(self):
+        """
+        The storage client, taken from the backend registry on first use.
+        """
+        if self._s3_client is None:
+            self._s3_client = get_backend("s3_client")
+        return self._s3_client
+
+    @s3_user.setter
+    def s3_user(self, s3_client):
+        self._s3_client = s3_client
 
+    @property
+    def transfer_config(self):
+        """
+        The boto3 transfer settings of multipart uploads, built on first use.
+        """
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+
+            self._transfer_config = TransferConfig(**self.transfer_settings)
+        return self._transfer_config
+
+    @traced
     def upload_files_to_s3(self, valid_files):
         """
         Uploads files to an S3 bucket.
 
+        Files are uploaded in parallel. Each file is gzip-compressed first when `compress`
+        is set, and files above the multipart threshold are sent as multipart uploads with
+        parallel parts.
+
         Parameters:
         ----------
         valid_files : list
-            A list of tuples containing file names and their contents.
+            A list of tuples containing file names and their contents (bytes or binary file objects).
 
         Returns:
         -------
         uploaded_file_names : list
             A list of unique file names uploaded to S3.
         """
+        self.upload_files(valid_files)
+
         uploaded_file_names = []
-        for file_name, file_content in valid_files:
-            current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_file_name = f"{current_time}_{file_name}"
-            self.s3_user.put_object(Bucket=self.bucket_name, Key=unique_file_name, Body=file_content)
-            st.success(
-                f':white_check_mark: File "{unique_file_name}" has been uploaded to the cloud.'
-            )
-            uploaded_file_names.append(unique_file_name)
-        return uploaded_file_names
\ No newline at end of file
+        for stats in self.upload_stats:
+            if stats["skipped"]:
+                st.info(f':information_source: File "{stats["key"]}" is already in the cloud.')
+            else:
+                st.success(
+                    f':white_check_mark: File "{stats["key"]}" has been uploaded to the cloud '
+                    f'({stats["bytes"] / 1e6:.1f} MB in {stats["seconds"]:.1f} s, {stats["mb_per_s"]:.1f} MB/s).'
+                )
+            uploaded_file_names.append(stats["key"])
+        return uploaded_file_names
+
+    @traced
+    def upload_files(self, valid_files, progress=None):
+        """
+        Uploads files in parallel without reporting to the page, e.g. from a background job.
+
+        Parameters:
+        ----------
+        valid_files : list
+            A list of tuples containing file names and their contents (bytes or binary file objects).
+        progress : callable, optional
+            Called with (uploaded_files, total_files) as each upload finishes.
+
+        Returns:
+        -------
+        list of dict
+            The statistics of each upload (see `upload_file`), in the order of `valid_files`.
+        """
+        parent_id = self.tracer.current_span_id()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._upload_file_under, parent_id, *valid_file) for valid_file in valid_files]
+            for done, _ in enumerate(as_completed(futures), start=1):
+                if progress:
+                    progress(done, len(futures))
+            self.upload_stats = [future.result() for future in futures]
+        self.tracer.current()["bytes"] = sum(stats["bytes"] for stats in self.upload_stats)
+        return self.upload_stats
+
+    @traced
+    def object_exists(self, key):
+        """
+        Checks whether an object is already stored in the bucket.
+
+        Parameters:
+        ----------
+        key : str
+            The S3 key to look up.
+
+        Returns:
+        -------
+        bool
+            True if the object exists.
+        """
+        response = self.s3_user.list_objects_v2(Bucket=self.bucket_name, Prefix=key, MaxKeys=1)
+        return any(item["Key"] == key for item in response.get("Contents", []))
+
+    @traced
+    def upload_file(self, file_name, file_content):
+        """
+        Uploads a single file under a content-addressed key.
+        The key starts with a hash of the content, so a file that is already stored
+        is not uploaded (or loaded by Snowpipe) again. Parquet files are stored under the
+        "parquet/" prefix and, being compressed already, are not gzipped.
+
+        Parameters:
+        ----------
+        file_name : str
+            The name of the file.
+        file_content : bytes or file-like
+            The content of the file.
+
+        Returns:
+        -------
+        dict
+            Upload statistics: the S3 key, whether the upload was skipped, the bytes before
+            and after compression, the duration and the throughput.
+        """
+        body = io.BytesIO(file_content) if isinstance(file_content, bytes) else file_content
+        body.seek(0)
+        digest = hashlib.sha256()
+        for block in iter(lambda: body.read(1024 * 1024), b""):
+            digest.update(block)
+        raw_size = body.tell()
+        parquet = is_parquet(body)
+        if parquet:
+            unique_file_name = f"parquet/{digest.hexdigest()[:32]}_{file_name.rsplit('.', 1)[0]}.parquet"
+        else:
+            unique_file_name = f"{digest.hexdigest()[:32]}_{file_name}" + (".gz" if self.compress else "")
+        compress = self.compress and not parquet
+
+        span = self.tracer.current()
+        span.update(file_name=file_name, format="parquet" if parquet else "csv", raw_bytes=raw_size)
+        if self.object_exists(unique_file_name):
+            span["skipped"] = True
+            return {
+                "file_name": file_name,
+                "key": unique_file_name,
+                "skipped": True,
+                "raw_bytes": raw_size,
+                "bytes": 0,
+                "seconds": 0.0,
+                "mb_per_s": 0.0,
+            }
+
+        start = time.perf_counter()
+        if compress:
+            body = self._gzip(body)
+        size = body.seek(0, io.SEEK_END)
+        body.seek(0)
+        self.s3_user.upload_fileobj(body, self.bucket_name, unique_file_name, Config=self.transfer_config)
+        seconds = time.perf_counter() - start
+        span.update(skipped=False, bytes=size)
+
+        return {
+            "file_name": file_name,
+            "key": unique_file_name,
+            "skipped": False,
+            "raw_bytes": raw_size,
+            "bytes": size,
+            "seconds": seconds,
+            "mb_per_s": size / 1e6 / seconds if seconds else 0.0,
+        }
+
+    def _upload_file_under(self, parent_id, file_name, file_content):
+        """
+        Runs `upload_file` in a worker thread, with its span nested under the `upload_files` span.
+        """
+        with self.tracer.nested_under(parent_id):
+            return self.upload_file(file_name, file_content)
+
+    @staticmethod
+    def _gzip(body):
+        """
+        Compresses a binary file object into a spooled temporary file.
+        """
+        compressed = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        with gzip.GzipFile(fileobj=compressed, mode="wb", compresslevel=6) as gz:
+            shutil.copyfileobj(body, gz, length=1024 * 1024)
+        compressed.seek(0)
+        return compressed
+
+
+def create_s3_client():
+    """
+    Creates a boto3 S3 client with the credentials from secrets.
+    boto3 clients are thread-safe, so one client can be shared by all sessions
+    (see `backends.get_backend("s3_client")`).
+
+    Returns:
+    -------
+    botocore.client.S3
+        The S3 client.
+    """
+    import boto3
+
+    secrets = get_secrets()
+    return boto3.client(
+        "s3",
+        aws_access_key_id=secrets["aws_access_key_id"],
+        aws_secret_access_key=secrets["aws_secret_access_key"],
+        region_name=secrets["aws_default_region"],
+    )
@@ -0,0 +1,65 @@
+from pathlib import Path
+import shutil
+
+class LocalStorageClient:
+    """
+    A filesystem-backed stand-in for the boto3 S3 client, used for local tests and benchmarks.
+
+    Objects are stored as files under `root/<bucket>/<key>`.
+
+    Attributes:
+    ----------
+    root : Path
+        The directory holding the buckets.
+    """
+
+    def __init__(self, root):
+        """
+        Initializes the client with the directory to store objects in.
+
+        Parameters:
+        ----------
+        root : str or Path
+            The directory holding the buckets. It is created if it does not exist.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, bucket, key):
+        path = self.root / bucket / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        """
+        Writes a binary file object to `root/<Bucket>/<Key>`.
+        """
+        with open(self._path(Bucket, Key), "wb") as target:
+            shutil.copyfileobj(Fileobj, target, length=1024 * 1024)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        """
+        Writes bytes or a binary file object to `root/<Bucket>/<Key>`.
+        """
+        if isinstance(Body, bytes):
+            self._path(Bucket, Key).write_bytes(Body)
+        else:
+            self.upload_fileobj(Body, Bucket, Key)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000):
+        """
+        Lists the stored keys starting with a prefix, in the shape of the boto3 response.
+        """
+        bucket = self.root / Bucket
+        keys = sorted(
+            path.relative_to(bucket).as_posix() for path in bucket.rglob("*") if path.is_file()
+        ) if bucket.exists() else []
+        contents = [{"Key": key} for key in keys if key.startswith(Prefix)][:MaxKeys]
+        return {"Contents": contents, "KeyCount": len(contents)}
+
+    def get_object(self, Bucket, Key):
+        """
+        Returns the stored object in the shape of the boto3 response.
+        """
+        return {"Body": open(self.root / Bucket / Key, "rb")}
@@ -0,0 +1,129 @@
+import importlib
+import threading
+from utils import load_secrets
+
+SECRETS_FILE = "secrets.yaml"
+
+_secrets = None
+_secrets_lock = threading.Lock()
+
+def get_secrets():
+    """
+    Returns the settings from `secrets.yaml`, read once per process on first use.
+
+    Returns:
+    -------
+    dict
+        The settings.
+    """
+    global _secrets
+    with _secrets_lock:
+        if _secrets is None:
+            _secrets = load_secrets(SECRETS_FILE)
+        return _secrets
+
+
+class BackendRegistry:
+    """
+    A registry of the shared backends of the app, such as the S3 client and the Snowflake pool.
+
+    Backends are registered by the import path of their factory ("module:function"), so neither
+    the backend nor the libraries its module imports (boto3, the Snowflake connector) are loaded
+    until a session first asks for it. Every backend is created once per process and then shared.
+
+    Attributes:
+    ----------
+    factories : dict
+        A dictionary mapping backend names to factory paths or callables.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty registry.
+        """
+        self.factories = {}
+        self._backends = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, factory):
+        """
+        Registers a backend, replacing any previous one of that name.
+
+        Parameters:
+        ----------
+        name : str
+            The name of the backend, e.g. "s3_client".
+        factory : str or callable
+            A "module:function" path or a function, called without arguments to create the backend.
+        """
+        with self._lock:
+            self.factories[name] = factory
+            self._backends.pop(name, None)
+
+    def get(self, name):
+        """
+        Returns a backend, creating it on first use.
+
+        Parameters:
+        ----------
+        name : str
+            The name of the backend.
+
+        Returns:
+        -------
+        object
+            The shared backend.
+        """
+        with self._lock:
+            if name not in self._backends:
+                factory = self.factories[name]
+                if isinstance(factory, str):
+                    module_name, function_name = factory.split(":")
+                    factory = getattr(importlib.import_module(module_name), function_name)
+                self._backends[name] = factory()
+            return self._backends[name]
+
+    def loaded(self):
+        """
+        Returns the names of the backends created so far.
+        """
+        with self._lock:
+            return sorted(self._backends)
+
+
+registry = BackendRegistry()
+registry.register("s3_client", "aws.aws_handler:create_s3_client")
+registry.register("snowflake_pool", "snow.snow_handler:create_connection_pool")
+registry.register("local_warehouse", "snow.local_warehouse:create_local_database")
+
+def get_backend(name):
+    """
+    Returns a shared backend from the registry, creating it on first use.
+    """
+    return registry.get(name)
+
+
+def create_warehouse_handler(cache=None, tracer=None):
+    """
+    Creates a warehouse handler for the backend set by `warehouse_backend` in secrets:
+    "snowflake" (default) or "local", the embedded warehouse of `snow.local_warehouse`.
+
+    Parameters:
+    ----------
+    cache : ResultCache, optional
+        A cache consulted by `fetch_full_data` before querying the warehouse.
+    tracer : Tracer, optional
+        Records a span per handler call.
+
+    Returns:
+    -------
+    SnowflakeHandler or LocalWarehouseHandler
+        A new handler on the shared Snowflake pool or local database.
+    """
+    if get_secrets().get("warehouse_backend", "snowflake") == "local":
+        from snow.local_warehouse import LocalWarehouseHandler
+
+        return LocalWarehouseHandler(get_backend("local_warehouse"), cache, tracer)
+    from snow.snow_handler import SnowflakeHandler
+
+    return SnowflakeHandler(get_backend("snowflake_pool"), cache, tracer)
@@ -0,0 +1,67 @@
+"""
+Compares the batched dose-response fit with fitting every group one at a time.
+
+Survival is computed for a synthetic dataset (`DataHandler.analyze_all_experiments`) and a 4PL
+curve is fitted per (experiment, drug, cell line, treatment time): once with `CurveFitter`, and
+once with a loop of `scipy.optimize.curve_fit` calls, as a per-group implementation would.
+
+Usage:
+    python -m benchmarks.bench_curve_fitting --rows 50000 200000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.generate_data import combined_results_frame
+from curve_fitting import CurveFitter, fit_single_curve
+from data_handler import DataHandler
+
+GROUP_COLUMNS = ['EXPERIMENT_NUMBER', 'DRUG_NAME', 'CELL_LINE_NAME', 'TREATMENT_TIME']
+
+
+def fit_one_by_one(survival, fitter):
+    """
+    Fits every group separately with scipy, starting from the same initial guess as the batch.
+    """
+    fits = []
+    for _, group in survival.groupby(GROUP_COLUMNS, sort=True, observed=True):
+        x = group['DRUG_CONCENTRATION'].to_numpy('float64')
+        y = group['SURVIVAL_RATE'].to_numpy('float64')
+        if len(np.unique(x)) < fitter.min_concentrations:
+            continue
+        positive = x > 0
+        start = fitter._initial_guess(y[None], np.ones((1, len(y)), bool), positive[None], np.log(np.where(positive, x, 1))[None])
+        fits.append(fit_single_curve((x, y, start[0])))
+    return fits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[50_000])
+    parser.add_argument("--skip-loop", action="store_true", help="Only time the batched fit.")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'groups':>7} {'batched s':>10} {'scipy fallbacks':>16} {'converged':>10} {'one by one s':>13}")
+    for rows in args.rows:
+        survival = DataHandler().analyze_all_experiments(combined_results_frame(rows))
+        fitter = CurveFitter(group_columns=GROUP_COLUMNS)
+
+        start = time.perf_counter()
+        fits = fitter.fit(survival)
+        batched_seconds = time.perf_counter() - start
+
+        loop_seconds = float("nan")
+        if not args.skip_loop:
+            start = time.perf_counter()
+            fit_one_by_one(survival, fitter)
+            loop_seconds = time.perf_counter() - start
+
+        print(
+            f"{rows:>10} {len(fits):>7} {batched_seconds:>10.2f} {(fits['METHOD'] == 'scipy').sum():>16} "
+            f"{fits['CONVERGED'].sum():>10} {loop_seconds:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Simulates a burst of concurrent ingests with and without the micro-batch scheduler.
+
+Every simulated user arrives at a random time within `--burst-seconds` and needs a Snowpipe
+refresh and wait plus a merge of their rows. The warehouse is modelled by fixed and per-row
+costs, and merges are serialized, as concurrent MERGEs into the same tables are in Snowflake.
+"per-session" runs one refresh and merge cycle per user, as app.py did before the scheduler;
+"batched" submits every load to an `IngestScheduler`.
+
+Usage:
+    python -m benchmarks.bench_ingest_batching --users 50 --burst-seconds 2 --window 0.5
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+
+from ingest_scheduler import IngestScheduler
+from tracing import Tracer
+
+
+class SimulatedWarehouse:
+    """
+    A cost model of the Snowpipe wait and the merges, shared by all simulated handlers.
+    """
+
+    def __init__(self, pipe_latency=0.3, merge_fixed=0.2, merge_per_row=1e-7):
+        self.pipe_latency = pipe_latency
+        self.merge_fixed = merge_fixed
+        self.merge_per_row = merge_per_row
+        self.merge_lock = threading.Lock()
+        self.busy_seconds = 0.0
+        self.cycles = 0
+
+    def handler(self, tracer=None):
+        return SimulatedHandler(self, tracer)
+
+
+class SimulatedHandler:
+    """
+    Implements the part of the `SnowflakeHandler` interface the scheduler uses.
+    """
+
+    def __init__(self, warehouse, tracer=None):
+        self.warehouse = warehouse
+        self.tracer = tracer or Tracer()
+        self.staging_counts = {}
+        self._rows = 0
+
+    def reset_pipeline(self, expected_rows=None, load_ids=None):
+        self._rows = sum((expected_rows or {}).values())
+        time.sleep(self.warehouse.pipe_latency)
+        return True
+
+    def run_merge_pipeline(self, load_ids=None):
+        seconds = self.warehouse.merge_fixed + self.warehouse.merge_per_row * self._rows
+        with self.warehouse.merge_lock:
+            time.sleep(seconds)
+            self.warehouse.busy_seconds += seconds
+            self.warehouse.cycles += 1
+        return {"total": seconds}
+
+    def close_connection(self):
+        pass
+
+
+def run_burst(mode, arrivals, rows, window):
+    """
+    Runs one burst and returns the number of merge cycles, warehouse time and latencies.
+    """
+    warehouse = SimulatedWarehouse()
+    scheduler = IngestScheduler(warehouse.handler, window=window) if mode == "batched" else None
+    start = time.monotonic()
+
+    def ingest(user):
+        time.sleep(max(0.0, start + arrivals[user] - time.monotonic()))
+        submitted = time.monotonic()
+        expected_rows = {"data_photodynamic_therapy_results.csv": rows}
+        if scheduler is not None:
+            scheduler.submit(expected_rows, [f"load-{user}"]).result()
+        else:
+            handler = warehouse.handler()
+            handler.reset_pipeline(expected_rows, [f"load-{user}"])
+            handler.run_merge_pipeline([f"load-{user}"])
+        return time.monotonic() - submitted
+
+    with ThreadPoolExecutor(max_workers=len(arrivals)) as executor:
+        latencies = list(executor.map(ingest, range(len(arrivals))))
+    return {
+        "cycles": warehouse.cycles,
+        "warehouse_seconds": warehouse.busy_seconds,
+        "wall_seconds": time.monotonic() - start,
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "scheduler": scheduler.stats() if scheduler else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--burst-seconds", type=float, default=2.0)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--window", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    arrivals = np.sort(np.random.default_rng(args.seed).uniform(0, args.burst_seconds, args.users))
+    print(f"{'mode':>12} {'cycles':>7} {'warehouse s':>12} {'wall s':>8} {'p50 s':>7} {'p95 s':>7}")
+    for mode in ("per-session", "batched"):
+        result = run_burst(mode, arrivals, args.rows, args.window)
+        print(
+            f"{mode:>12} {result['cycles']:>7} {result['warehouse_seconds']:>12.2f} {result['wall_seconds']:>8.2f} "
+            f"{result['p50']:>7.2f} {result['p95']:>7.2f}"
+        )
+        if result["scheduler"]:
+            print(f"{'':>12} scheduler: {result['scheduler']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares the CSV and Parquet staging formats at every hop of the ingest.
+
+For each format the results file is validated and re-encoded (`DataHandler.stream_validate_file`),
+uploaded (`AWSHandler.upload_file` against `LocalStorageClient`, gzip for CSV) and bulk-loaded
+into staging (`LocalWarehouseHandler.load_staging_files`). The handlers read their settings
+from `secrets.yaml` in the working directory (dummy credentials are fine).
+
+Usage:
+    python -m benchmarks.bench_staging_format --rows 100000 1000000
+"""
+import argparse
+import io
+import tempfile
+import time
+
+from aws.aws_handler import AWSHandler
+from aws.local_storage import LocalStorageClient
+from benchmarks.generate_data import RESULTS_FILE, results_csv
+from data_handler import DataHandler
+from snow.local_warehouse import LocalWarehouseHandler
+
+
+def run(rows, staging_format, content, workdir):
+    """
+    Runs one ingest and returns the bytes and seconds of each hop.
+    """
+    start = time.perf_counter()
+    validated_file, _, errors = DataHandler(staging_format=staging_format).stream_validate_file(
+        io.BytesIO(content), RESULTS_FILE, "benchmark", load_id="benchmark"
+    )
+    if errors:
+        raise ValueError(errors)
+    validate_seconds = time.perf_counter() - start
+    validated_bytes = validated_file.seek(0, io.SEEK_END)
+
+    upload = AWSHandler(LocalStorageClient(f"{workdir}/{staging_format}")).upload_file(RESULTS_FILE, validated_file)
+
+    warehouse = LocalWarehouseHandler(":memory:")
+    start = time.perf_counter()
+    loaded_rows = warehouse.load_staging_files([(RESULTS_FILE, validated_file)])
+    load_seconds = time.perf_counter() - start
+    if loaded_rows["stg_results"] != rows:
+        raise ValueError(f"Loaded {loaded_rows} rows, expected {rows}")
+    warehouse.close_connection()
+
+    return {
+        "validate_s": validate_seconds,
+        "validated_mb": validated_bytes / 1e6,
+        "wire_mb": upload["bytes"] / 1e6,
+        "upload_s": upload["seconds"],
+        "load_s": load_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000])
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'format':>8} {'validate s':>11} {'validated MB':>13} {'wire MB':>8} {'upload s':>9} {'load s':>7}")
+    for rows in args.rows:
+        content = results_csv(rows)
+        with tempfile.TemporaryDirectory() as workdir:
+            for staging_format in ("csv", "parquet"):
+                result = run(rows, staging_format, content, workdir)
+                print(
+                    f"{rows:>10} {staging_format:>8} {result['validate_s']:>11.2f} {result['validated_mb']:>13.1f} "
+                    f"{result['wire_mb']:>8.1f} {result['upload_s']:>9.2f} {result['load_s']:>7.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
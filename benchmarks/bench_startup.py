@@ -0,0 +1,139 @@
+"""
+Measures how fast the app starts: the cold import of its modules and the time to first render.
+
+Each measurement runs in a fresh interpreter. "cold_import" imports every module app.py
+imports; "first_render" runs app.py once with Streamlit's `AppTest`, from interpreter start
+to the end of the script, as a new session would. Both report the best wall time over
+`--repeat` runs, the peak resident memory, and which heavy backends (boto3, the Snowflake
+connector, plotly) got imported, which should only happen once a session needs them.
+
+Run it from a directory with a `secrets.yaml` (dummy credentials are fine). Results can be
+saved as a baseline and compared with it, as for `benchmarks.run_benchmarks`.
+
+Usage:
+    python -m benchmarks.bench_startup --save-baseline benchmarks/startup_baseline.json
+    python -m benchmarks.bench_startup --compare benchmarks/startup_baseline.json
+"""
+import argparse
+import ast
+import json
+import os
+import platform
+import subprocess
+import sys
+from pathlib import Path
+
+from benchmarks.run_benchmarks import compare
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+HEAVY_MODULES = ["boto3", "snowflake.connector", "plotly.express"]
+
+COLD_IMPORT = """
+import resource, sys, time
+start = time.perf_counter()
+{imports}
+seconds = time.perf_counter() - start
+"""
+
+FIRST_RENDER = """
+import resource, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file({app!r}, default_timeout=120).run()
+seconds = time.perf_counter() - start
+if app.exception:
+    raise SystemExit(app.exception[0].value)
+"""
+
+REPORT = """
+import json
+print(json.dumps({{
+    "seconds": seconds,
+    "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def app_imports(app=APP):
+    """
+    Returns the top-level import statements of app.py.
+    """
+    tree = ast.parse(app.read_text())
+    return [ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+def run_fresh(code):
+    """
+    Runs code in a new interpreter, with the repository on the path, and returns its report.
+    """
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [str(APP.parent), environment.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-c", code + REPORT.format(heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, env=environment,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(repeat=3):
+    """
+    Runs both measurements `repeat` times.
+
+    Returns:
+    -------
+    dict
+        A dictionary mapping "cold_import" and "first_render" to their best time, peak memory
+        and loaded heavy modules.
+    """
+    codes = {
+        "cold_import": COLD_IMPORT.format(imports="\n".join(app_imports())),
+        "first_render": FIRST_RENDER.format(app=str(APP)),
+    }
+    results = {}
+    for name, code in codes.items():
+        runs = [run_fresh(code) for _ in range(repeat)]
+        best = min(runs, key=lambda measurement: measurement["seconds"])
+        results[name] = {
+            "seconds": best["seconds"],
+            "peak_mb": max(measurement["peak_mb"] for measurement in runs),
+            "loaded": best["loaded"],
+        }
+        print(f"{name:<14} {best['seconds']:>8.3f} s {results[name]['peak_mb']:>8.1f} MB  loaded: {', '.join(best['loaded']) or '-'}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--compare", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps({
+            "environment": {"python": platform.python_version(), "machine": platform.machine()},
+            "results": results,
+        }, indent=2))
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name, current in results.items():
+            newly_loaded = set(current["loaded"]) - set(baseline.get(name, {}).get("loaded", current["loaded"]))
+            if newly_loaded:
+                regressions.append(f"{name}: now imports {', '.join(sorted(newly_loaded))} at startup")
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
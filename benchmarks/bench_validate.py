@@ -0,0 +1,75 @@
+"""
+Compares peak memory of the streaming validator with the previous read-all path.
+
+Each path runs in a fresh process on the same in-memory upload, and the reported value
+is the growth of the peak resident set size (ru_maxrss) while validating.
+
+Usage:
+    python -m benchmarks.bench_validate --rows 1000000
+"""
+import argparse
+import io
+import multiprocessing
+import resource
+import time
+
+import pandas as pd
+
+from benchmarks.generate_data import RESULTS_FILE, results_csv
+
+
+def legacy_validate(upload):
+    """
+    The previous `validate_user_data` path: read everything, add user_id, re-encode.
+    """
+    user_data = pd.read_csv(upload)
+    user_data["user_id"] = "benchmark"
+    return user_data.to_csv(index=False).encode()
+
+
+def streaming_validate(upload):
+    from data_handler import DataHandler
+
+    validated_file, _, errors = DataHandler().stream_validate_file(upload, RESULTS_FILE, "benchmark")
+    if errors:
+        raise ValueError(errors)
+    return validated_file
+
+
+def _run(path_name, content, queue):
+    if path_name == "streaming":
+        # Import outside the measured region, the legacy path does not need it.
+        import data_handler  # noqa: F401
+    upload = io.BytesIO(content)
+    del content
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    PATHS[path_name](upload)
+    seconds = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((seconds, (rss_after - rss_before) / 1024))
+
+
+PATHS = {"legacy": legacy_validate, "streaming": streaming_validate}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'rows':>10} {'MB':>8} {'path':>10} {'seconds':>8} {'peak RSS growth MB':>19}")
+    for rows in args.rows:
+        content = results_csv(rows)
+        for path_name in PATHS:
+            queue = context.Queue()
+            process = context.Process(target=_run, args=(path_name, content, queue))
+            process.start()
+            seconds, rss_mb = queue.get()
+            process.join()
+            print(f"{rows:>10} {len(content) / 1e6:>8.1f} {path_name:>10} {seconds:>8.2f} {rss_mb:>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
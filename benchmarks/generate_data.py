@@ -0,0 +1,165 @@
+"""
+Generates synthetic photodynamic therapy datasets in the format the app expects.
+
+The three CSVs have the names and columns of `DataHandler.expected_files`. Results are laid
+out as blocks of 4 treatment times x 5 drug concentrations per (drug, cell line), so every
+block contains one control well (time 0, concentration 0), and about 40% of the replicates
+are blank (" "), as in `sample_files/your_results.csv`. Files are written in chunks, so
+datasets of 10M rows can be generated with little memory.
+
+Usage:
+    python -m benchmarks.generate_data --rows 1000000 --output data/1m
+"""
+import argparse
+import io
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CELL_LINES_FILE = "data_photodynamic_therapy_cell_lines.csv"
+DRUGS_FILE = "data_photodynamic_therapy_drugs.csv"
+RESULTS_FILE = "data_photodynamic_therapy_results.csv"
+TREATMENT_TIMES = np.array([0, 5, 10, 20])
+DRUG_CONCENTRATIONS = np.array([0, 10, 20, 40, 80])
+RESULT_COLUMNS = [f"result_{i:03d}" for i in range(1, 13)]
+
+
+def cell_lines_frame(n_cell_lines=10):
+    return pd.DataFrame({
+        "cell_line_code": [f"cl{i:03d}" for i in range(1, n_cell_lines + 1)],
+        "cell_line_name": [f"cell line name{i}" for i in range(1, n_cell_lines + 1)],
+    })
+
+
+def drugs_frame(n_drugs=10):
+    return pd.DataFrame({
+        "drug_code": [f"d{i:03d}" for i in range(1, n_drugs + 1)],
+        "drug_name": [f"drug{i} name" for i in range(1, n_drugs + 1)],
+    })
+
+
+def results_chunks(rows, n_cell_lines=10, n_drugs=10, rows_per_experiment=10_000, chunk_size=500_000,
+                   blank_rate=0.4, seed=0):
+    """
+    Yields the results table in chunks, with replicates as floats and blanks as NaN.
+
+    Parameters:
+    ----------
+    rows : int
+        The total number of wells.
+    n_cell_lines, n_drugs : int
+        The number of cell lines and drugs the wells are spread over.
+    rows_per_experiment : int
+        The number of wells per experiment number.
+    chunk_size : int
+        The number of rows per yielded chunk.
+    blank_rate : float
+        The share of blank replicates.
+    seed : int
+        The random seed.
+
+    Yields:
+    ------
+    DataFrame
+        A chunk with the columns of the results file.
+    """
+    rng = np.random.default_rng(seed)
+    block = len(TREATMENT_TIMES) * len(DRUG_CONCENTRATIONS)
+    for start in range(0, rows, chunk_size):
+        index = np.arange(start, min(start + chunk_size, rows))
+        times = TREATMENT_TIMES[index % len(TREATMENT_TIMES)]
+        concentrations = DRUG_CONCENTRATIONS[(index // len(TREATMENT_TIMES)) % len(DRUG_CONCENTRATIONS)]
+        chunk = pd.DataFrame({
+            "experiment_id": index + 1,
+            "experiment_number": index // rows_per_experiment + 1,
+            "cell_line_code": np.char.add("cl", np.char.zfill((index // (block * n_drugs) % n_cell_lines + 1).astype(str), 3)),
+            "treatment_time": times,
+            "drug_code": np.char.add("d", np.char.zfill((index // block % n_drugs + 1).astype(str), 3)),
+            "drug_concentration": concentrations,
+        })
+        survival = np.exp(-concentrations * times / 400)
+        values = np.round(100 * survival[:, None] + rng.normal(0, 5, (len(index), len(RESULT_COLUMNS))))
+        values = np.clip(values, 0, None)
+        values[rng.random(values.shape) < blank_rate] = np.nan
+        for position, column in enumerate(RESULT_COLUMNS):
+            chunk[column] = values[:, position]
+        yield chunk
+
+
+def write_dataset(directory, rows, n_cell_lines=10, n_drugs=10, rows_per_experiment=10_000, seed=0):
+    """
+    Writes the three expected CSVs into a directory.
+
+    Returns:
+    -------
+    dict
+        A dictionary mapping file names to paths.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = {name: directory / name for name in (CELL_LINES_FILE, DRUGS_FILE, RESULTS_FILE)}
+    cell_lines_frame(n_cell_lines).to_csv(paths[CELL_LINES_FILE], index=False)
+    drugs_frame(n_drugs).to_csv(paths[DRUGS_FILE], index=False)
+
+    with open(paths[RESULTS_FILE], "w", newline="") as file:
+        write_results_csv(file, rows, n_cell_lines, n_drugs, rows_per_experiment, seed)
+    return paths
+
+
+def write_results_csv(file, rows, n_cell_lines=10, n_drugs=10, rows_per_experiment=10_000, seed=0):
+    """
+    Writes the results CSV chunk by chunk into an open text file, with blank replicates as " ".
+    """
+    for number, chunk in enumerate(results_chunks(rows, n_cell_lines, n_drugs, rows_per_experiment, seed=seed)):
+        replicates = chunk[RESULT_COLUMNS].astype("Int64").astype(str)
+        chunk[RESULT_COLUMNS] = replicates.mask(chunk[RESULT_COLUMNS].isna(), " ")
+        chunk.to_csv(file, index=False, header=number == 0)
+
+
+def results_csv(rows, seed=0):
+    """
+    Returns the results CSV as bytes, for in-memory uploads.
+    """
+    buffer = io.StringIO()
+    write_results_csv(buffer, rows, seed=seed)
+    return buffer.getvalue().encode()
+
+
+def combined_results_frame(rows, n_cell_lines=10, n_drugs=10, rows_per_experiment=10_000, user_id="benchmark", seed=0):
+    """
+    Builds the frame `SnowflakeHandler.fetch_full_data` returns from the combined_results view.
+    """
+    cell_lines = cell_lines_frame(n_cell_lines)
+    drugs = drugs_frame(n_drugs)
+    results = pd.concat(results_chunks(rows, n_cell_lines, n_drugs, rows_per_experiment, seed=seed), ignore_index=True)
+    combined = (
+        results
+        .merge(cell_lines, on="cell_line_code", how="left")
+        .merge(drugs, on="drug_code", how="left")
+        .assign(user_id=user_id)
+    )
+    columns = ["experiment_id", "experiment_number", "user_id", "cell_line_name", "drug_name",
+               "treatment_time", "drug_concentration", *RESULT_COLUMNS]
+    combined = combined[columns]
+    combined.columns = [column.upper() for column in columns]
+    return combined
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000)
+    parser.add_argument("--output", default="benchmarks/data")
+    parser.add_argument("--cell-lines", type=int, default=10)
+    parser.add_argument("--drugs", type=int, default=10)
+    parser.add_argument("--rows-per-experiment", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = write_dataset(args.output, args.rows, args.cell_lines, args.drugs, args.rows_per_experiment, args.seed)
+    for name, path in paths.items():
+        print(f"{path} ({path.stat().st_size / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
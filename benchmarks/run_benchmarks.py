@@ -0,0 +1,263 @@
+"""
+Runs the benchmark suite on synthetic datasets and compares it with a saved baseline.
+
+For every dataset size the three CSVs are generated (see `benchmarks.generate_data`) and the
+hot paths are timed: validation, experiment lookup, the per-experiment and vectorized
+analysis, plotting, and the S3 upload and warehouse steps against the local stand-ins
+(`LocalStorageClient` and `LocalWarehouseHandler`). Each benchmark reports the best wall
+time over `--repeat` runs and the peak Python memory (tracemalloc) of one extra run.
+
+The handler benchmarks read their settings from `secrets.yaml` in the working directory
+(dummy credentials are fine); they are skipped if it is missing.
+
+Usage:
+    python -m benchmarks.run_benchmarks --rows 1000 100000 --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --rows 1000 100000 --compare benchmarks/baseline.json
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+from streamlit import logger as streamlit_logger
+
+from benchmarks.generate_data import RESULTS_FILE, combined_results_frame, write_dataset
+from data_handler import DataHandler
+from experiment_index import ExperimentIndex
+from replicates import replicate_matrix
+
+USER_ID = "benchmark"
+TREATMENT_TIMES = [0, 5, 10, 20]
+
+
+class NamedBytesIO(io.BytesIO):
+    """
+    An in-memory upload with a file name, like Streamlit's `UploadedFile`.
+    """
+
+    def __init__(self, content, name):
+        super().__init__(content)
+        self.name = name
+
+
+def measure(func, setup=None, repeat=3):
+    """
+    Times a function and records its peak memory.
+
+    Parameters:
+    ----------
+    func : callable
+        The function to benchmark. It is called with the value returned by `setup`, if any.
+    setup : callable, optional
+        A function run before every call, outside of the measurement.
+    repeat : int
+        The number of timed runs.
+
+    Returns:
+    -------
+    dict
+        The best wall time in seconds and the peak traced memory in MB.
+    """
+    timings = []
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = (setup(),) if setup else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(timings), "peak_mb": peak / 1024 ** 2}
+
+
+def data_benchmarks(rows, paths):
+    """
+    Returns the `DataHandler` benchmarks of one dataset size as (name, func, setup) tuples.
+    """
+    import streamlit as st
+
+    st.session_state["user_id"] = USER_ID
+    handler = DataHandler()
+    content = paths[RESULTS_FILE].read_bytes()
+    uploads = {name: path.read_bytes() for name, path in paths.items()}
+
+    data = combined_results_frame(rows, user_id=USER_ID)
+    index = ExperimentIndex(data)
+    experiment = handler.fetch_experiment_data(index, 1)
+    _, _, full_experiment = handler.analyze_experiment_data(experiment.copy())
+    survival = handler.calculate_survival(full_experiment.copy())
+    replicates = replicate_matrix(data)
+    selected_drug = survival["DRUG_NAME"].iloc[0]
+
+    def validate_user_data():
+        handler.valid_files = []
+        return handler.validate_user_data([NamedBytesIO(body, name) for name, body in uploads.items()])
+
+    return [
+        ("stream_validate_file", lambda: handler.stream_validate_file(io.BytesIO(content), RESULTS_FILE, USER_ID), None),
+        ("validate_user_data", validate_user_data, None),
+        ("fetch_experiment_data", lambda: handler.fetch_experiment_data(data, 1), None),
+        ("fetch_experiment_data[index]", lambda: handler.fetch_experiment_data(index, 1), None),
+        ("analyze_experiment_data", handler.analyze_experiment_data, experiment.copy),
+        ("calculate_survival", handler.calculate_survival, full_experiment.copy),
+        ("analyze_all_experiments", lambda: handler.analyze_all_experiments(data), None),
+        ("replicate_statistics", lambda: handler.replicate_statistics.compute(*replicates), None),
+        ("create_plots", lambda: handler.create_plots(
+            survival, "Drugs", selected_drug, "DRUG_CONCENTRATION", "SURVIVAL_RATE", TREATMENT_TIMES), None),
+        ("create_faceted_plot", lambda: handler.create_faceted_plot(
+            survival, "Drugs", selected_drug, "DRUG_CONCENTRATION", "SURVIVAL_RATE", TREATMENT_TIMES), None),
+    ]
+
+
+def handler_benchmarks(paths, workdir):
+    """
+    Returns the upload and warehouse benchmarks as (name, func, setup) tuples.
+    """
+    from backends import SECRETS_FILE
+
+    # the handlers read their settings from secrets when they are constructed
+    if not Path(SECRETS_FILE).exists():
+        print(f"Skipping handler benchmarks: {SECRETS_FILE} not found")
+        return []
+    from aws.aws_handler import AWSHandler
+    from aws.local_storage import LocalStorageClient
+    from snow.local_warehouse import LocalWarehouseHandler
+
+    handler = DataHandler()
+    validated_files = []
+    for name, path in paths.items():
+        with open(path, "rb") as file:
+            validated_file, _, errors = handler.stream_validate_file(file, name, USER_ID, load_id="benchmark")
+        if errors:
+            raise ValueError(errors)
+        validated_files.append((name, validated_file))
+    results_file = dict(validated_files)[RESULTS_FILE]
+
+    aws_handler = AWSHandler(LocalStorageClient(workdir / "s3"))
+    uploads = iter(range(sys.maxsize))
+
+    def fresh_storage():
+        # Uploads are deduplicated by content hash, so every run gets an empty bucket.
+        aws_handler.s3_user = LocalStorageClient(workdir / f"s3-{next(uploads)}")
+        results_file.seek(0)
+        return results_file
+
+    def fresh_warehouse():
+        for _, validated_file in validated_files:
+            validated_file.seek(0)
+        return LocalWarehouseHandler(":memory:")
+
+    def staged_warehouse():
+        local = fresh_warehouse()
+        local.load_staging_files(validated_files)
+        return local
+
+    warehouse = staged_warehouse()
+    warehouse.run_merge_pipeline()
+
+    return [
+        ("aws.upload_file", lambda file: aws_handler.upload_file(RESULTS_FILE, file), fresh_storage),
+        ("warehouse.load_staging_files", lambda local: local.load_staging_files(validated_files), fresh_warehouse),
+        ("warehouse.run_merge_pipeline", lambda local: local.run_merge_pipeline(["benchmark"]), staged_warehouse),
+        ("warehouse.fetch_full_data", lambda: warehouse.fetch_full_data("combined_results", USER_ID), None),
+        ("warehouse.fetch_experiment_survival",
+         lambda: warehouse.fetch_experiment_survival("combined_results", USER_ID, 1), None),
+    ]
+
+
+def run(sizes, repeat=3):
+    """
+    Runs all benchmarks for each dataset size.
+
+    Returns:
+    -------
+    dict
+        A dictionary mapping "name[rows]" to the measurement of `measure`.
+    """
+    results = {}
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            workdir = Path(workdir)
+            paths = write_dataset(workdir / "data", rows)
+            for name, func, setup in data_benchmarks(rows, paths) + handler_benchmarks(paths, workdir):
+                key = f"{name}[{rows}]"
+                results[key] = measure(func, setup, repeat)
+                print(f"{key:<50} {results[key]['seconds']:>10.4f} s {results[key]['peak_mb']:>10.1f} MB", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares results with a baseline.
+
+    Parameters:
+    ----------
+    results : dict
+        The current measurements, as returned by `run`.
+    baseline : dict
+        The baseline measurements.
+    tolerance : float
+        The relative slowdown or memory growth above which a benchmark counts as a regression.
+
+    Returns:
+    -------
+    list of str
+        A description of every regression.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<50} {'seconds':>18} {'peak MB':>18}")
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        changes = []
+        for metric in ("seconds", "peak_mb"):
+            ratio = current[metric] / previous[metric] if previous[metric] else 1.0
+            changes.append(f"{ratio - 1:>+17.0%}")
+            if ratio > 1 + tolerance:
+                regressions.append(f"{key}: {metric} {previous[metric]:.4g} -> {current[metric]:.4g}")
+        print(f"{key:<50} {changes[0]:>18} {changes[1]:>18}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--compare", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Streamlit warns about the missing script context on every call in bare mode.
+    streamlit_logger.set_log_level("error")
+    results = run(args.rows, args.repeat)
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps({
+            "environment": {"python": platform.python_version(), "pandas": pd.__version__, "machine": platform.machine()},
+            "results": results,
+        }, indent=2))
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text())["results"], args.tolerance)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import threading
+import time
+
+class ConnectionPool:
+    """
+    A thread-safe pool of reusable connections, shared by all Streamlit sessions of a process.
+
+    Idle connections are reused most-recently-released first. Connections idle for longer
+    than `idle_timeout` are closed, connections idle for longer than `check_interval` are
+    health-checked before reuse, and broken connections are replaced by new ones.
+
+    Attributes:
+    ----------
+    max_size : int
+        The maximum number of open connections.
+    idle_timeout : float
+        The number of seconds after which an idle connection is closed.
+    check_interval : float
+        The number of idle seconds after which a connection is health-checked before reuse.
+    hits : int
+        The number of acquisitions served by an idle connection.
+    misses : int
+        The number of acquisitions that opened a new connection.
+    evictions : int
+        The number of idle connections closed for exceeding `idle_timeout`.
+    reconnects : int
+        The number of connections replaced after a failed health check.
+    """
+
+    def __init__(self, connect, max_size=4, idle_timeout=600, check_interval=60, health_check=None, close=None):
+        """
+        Initializes an empty pool.
+
+        Parameters:
+        ----------
+        connect : callable
+            A function returning a new connection.
+        max_size : int
+            The maximum number of open connections.
+        idle_timeout : float
+            The number of seconds after which an idle connection is closed.
+        check_interval : float
+            The number of idle seconds after which a connection is health-checked before reuse.
+        health_check : callable, optional
+            A function returning True if a connection is usable. Defaults to `not conn.is_closed()`.
+        close : callable, optional
+            A function closing a connection. Defaults to `conn.close()`.
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.health_check = health_check or (lambda conn: not conn.is_closed())
+        self.close = close or (lambda conn: conn.close())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reconnects = 0
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=30):
+        """
+        Takes a connection out of the pool, opening one if none is idle.
+
+        Parameters:
+        ----------
+        timeout : float
+            The number of seconds to wait for a connection when the pool is exhausted.
+
+        Returns:
+        -------
+        object
+            A connection, to be given back with `release`.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._evict_idle()
+                while self._idle:
+                    conn, released_at = self._idle.pop()
+                    if time.monotonic() - released_at < self.check_interval or self._is_healthy(conn):
+                        self.hits += 1
+                        return conn
+                    self.reconnects += 1
+                    self._discard(conn)
+                if self._size < self.max_size:
+                    self._size += 1
+                    self.misses += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No connection available after {timeout} s (pool size {self.max_size})")
+                self._condition.wait(remaining)
+
+        try:
+            return self.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn):
+        """
+        Gives a connection back to the pool.
+
+        Parameters:
+        ----------
+        conn : object
+            A connection returned by `acquire`.
+        """
+        with self._condition:
+            if self._is_healthy(conn):
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._condition.notify()
+
+    def stats(self):
+        """
+        Returns the pool counters.
+
+        Returns:
+        -------
+        dict
+            The hits, misses, evictions, reconnects, open and idle connection counts.
+        """
+        with self._condition:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reconnects": self.reconnects,
+                "open": self._size,
+                "idle": len(self._idle),
+            }
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        expired = [item for item in self._idle if now - item[1] > self.idle_timeout]
+        self._idle = [item for item in self._idle if now - item[1] <= self.idle_timeout]
+        for conn, _ in expired:
+            self.evictions += 1
+            self._discard(conn)
+
+    def _discard(self, conn):
+        self._size -= 1
+        try:
+            self.close(conn)
+        except Exception as e:
+            print(f"Error closing pooled connection: {e}")
+
+    def _is_healthy(self, conn):
+        try:
+            return self.health_check(conn)
+        except Exception:
+            return False
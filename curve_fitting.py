@@ -0,0 +1,330 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+GROUP_COLUMNS = ['DRUG_NAME', 'CELL_LINE_NAME', 'TREATMENT_TIME']
+PARAMETER_COLUMNS = ['IC50', 'HILL_SLOPE', 'TOP', 'BOTTOM', 'R_SQUARED', 'CONVERGED', 'N_POINTS', 'METHOD']
+
+def four_parameter_logistic(concentration, bottom, top, ic50, hill_slope):
+    """
+    Evaluates the four-parameter logistic (4PL) dose-response model.
+
+    Parameters:
+    ----------
+    concentration : float or array
+        The drug concentrations.
+    bottom, top : float
+        The responses at infinite and at zero concentration (for a positive Hill slope).
+    ic50 : float
+        The concentration halfway between top and bottom.
+    hill_slope : float
+        The steepness of the curve; positive for responses falling with concentration.
+
+    Returns:
+    -------
+    float or array
+        bottom + (top - bottom) / (1 + (concentration / ic50) ** hill_slope)
+    """
+    concentration = np.asarray(concentration, dtype='float64')
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        ratio = np.power(concentration / ic50, hill_slope)
+    return bottom + (top - bottom) / (1 + ratio)
+
+
+class CurveFitter:
+    """
+    Fits 4PL dose-response curves to every group of a survival table in one batch.
+
+    All groups are padded into one (groups x points) matrix and fitted together with a
+    vectorized Levenberg-Marquardt iteration, so a few hundred groups cost about as much as a
+    handful of numpy operations per iteration. Groups that do not converge within `max_iter`
+    iterations are refitted one by one with `scipy.optimize.curve_fit`, on a process pool when
+    there are enough of them.
+
+    Attributes:
+    ----------
+    x_column, y_column : str
+        The concentration and response columns.
+    group_columns : list of str
+        The columns identifying one curve.
+    min_concentrations : int
+        The number of distinct concentrations a group needs to be fitted.
+    max_iter : int
+        The maximum number of batched iterations.
+    tolerance : float
+        The relative decrease of the squared error below which a fit has converged.
+    fallback_workers : int or None
+        The number of processes for the fallback fits; None uses one per CPU.
+    min_pool_groups : int
+        The number of fallback fits from which a process pool is used.
+    """
+
+    def __init__(self, x_column='DRUG_CONCENTRATION', y_column='SURVIVAL_RATE', group_columns=None,
+                 min_concentrations=4, max_iter=1000, tolerance=1e-9, fallback_workers=None, min_pool_groups=16):
+        self.x_column = x_column
+        self.y_column = y_column
+        self.group_columns = list(group_columns or GROUP_COLUMNS)
+        self.min_concentrations = min_concentrations
+        self.max_iter = max_iter
+        self.tolerance = tolerance
+        self.fallback_workers = fallback_workers
+        self.min_pool_groups = min_pool_groups
+
+    def fit(self, data):
+        """
+        Fits one curve per group.
+
+        Parameters:
+        ----------
+        data : DataFrame
+            A survival table, e.g. from `DataHandler.analyze_all_experiments` or `calculate_survival`.
+
+        Returns:
+        -------
+        DataFrame
+            One row per group with the group columns and `PARAMETER_COLUMNS`. Groups with fewer
+            than `min_concentrations` distinct concentrations have NaN parameters. CONVERGED is
+            True only for fits that converged to a plausible curve (see `_plausible`); METHOD tells whether a fit came from the batch or the scipy fallback.
+        """
+        points = data[self.group_columns + [self.x_column, self.y_column]].copy()
+        points[self.x_column] = pd.to_numeric(points[self.x_column], errors='coerce').astype('float64')
+        points[self.y_column] = pd.to_numeric(points[self.y_column], errors='coerce').astype('float64')
+        points = points.dropna(subset=[self.x_column, self.y_column])
+        points = points[points[self.x_column] >= 0]
+
+        grouped = points.groupby(self.group_columns, sort=True, observed=True)
+        group_ids = grouped.ngroup().to_numpy()
+        keys = grouped[self.x_column].agg(['size', 'nunique']).reset_index()
+        fits = keys[self.group_columns].copy()
+        for column in PARAMETER_COLUMNS:
+            fits[column] = np.nan
+        fits['CONVERGED'] = False
+        fits['N_POINTS'] = keys['size'].to_numpy()
+        fits['METHOD'] = None
+        if fits.empty:
+            return fits
+
+        fittable = np.flatnonzero(keys['nunique'].to_numpy() >= self.min_concentrations)
+        if not len(fittable):
+            return fits
+        x, y, mask = self._pack(points[self.x_column].to_numpy(), points[self.y_column].to_numpy(), group_ids, fittable)
+        params, converged = self._fit_batch(x, y, mask)
+        method = np.full(len(fittable), 'batched', dtype=object)
+
+        retry = np.flatnonzero(~converged)
+        if len(retry):
+            fallback = self._fit_fallback([(x[i][mask[i]], y[i][mask[i]], params[i]) for i in retry])
+            for i, (fallback_params, fallback_converged) in zip(retry, fallback):
+                if fallback_params is not None:
+                    params[i], converged[i], method[i] = fallback_params, fallback_converged, 'scipy'
+
+        bottom, top, log_ic50, hill_slope = params.T
+        fits.loc[fittable, 'BOTTOM'] = bottom
+        fits.loc[fittable, 'TOP'] = top
+        with np.errstate(over='ignore'):
+            fits.loc[fittable, 'IC50'] = np.exp(log_ic50)
+        fits.loc[fittable, 'HILL_SLOPE'] = hill_slope
+        fits.loc[fittable, 'R_SQUARED'] = self._r_squared(x, y, mask, params)
+        fits.loc[fittable, 'CONVERGED'] = converged & np.isfinite(params).all(axis=1) & self._plausible(x, y, mask, params)
+        fits.loc[fittable, 'METHOD'] = method
+        fits['CONVERGED'] = fits['CONVERGED'].astype(bool)
+        return fits
+
+    def curve(self, fit, concentrations):
+        """
+        Evaluates a fitted curve, given one row of the table returned by `fit`.
+        """
+        return four_parameter_logistic(concentrations, fit['BOTTOM'], fit['TOP'], fit['IC50'], fit['HILL_SLOPE'])
+
+    def _pack(self, x_values, y_values, group_ids, fittable):
+        """
+        Lays the points of the fittable groups out as padded (groups x points) matrices and a validity mask.
+        """
+        rows = np.full(group_ids.max() + 1, -1)
+        rows[fittable] = np.arange(len(fittable))
+        selected = rows[group_ids] >= 0
+        row = rows[group_ids[selected]]
+        order = np.argsort(row, kind='stable')
+        row = row[order]
+        counts = np.bincount(row, minlength=len(fittable))
+        column = np.arange(len(row)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        shape = (len(fittable), counts.max() if len(counts) else 0)
+        x, y, mask = np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=bool)
+        x[row, column] = x_values[selected][order]
+        y[row, column] = y_values[selected][order]
+        mask[row, column] = True
+        return x, y, mask
+
+    def _fit_batch(self, x, y, mask):
+        """
+        Runs Levenberg-Marquardt on all groups at once.
+
+        The parameters are (bottom, top, log IC50, Hill slope); fitting the logarithm keeps the IC50
+        positive. Each group has its own damping factor and stops iterating once it has converged.
+
+        Returns:
+        -------
+        params : ndarray
+            A (groups x 4) array of fitted parameters.
+        converged : ndarray
+            A boolean array, True for the groups that converged.
+        """
+        positive = mask & (x > 0)
+        log_x = np.log(np.where(positive, x, 1.0))
+        params = self._initial_guess(y, mask, positive, log_x)
+        damping = np.full(len(params), 1e-3)
+        converged = np.zeros(len(params), dtype=bool)
+        sse = self._sse(params, log_x, positive, y, mask)
+
+        for _ in range(self.max_iter):
+            active = np.flatnonzero(~converged)
+            if not len(active):
+                break
+            jacobian, residuals = self._jacobian(params[active], log_x[active], positive[active], y[active], mask[active])
+            normal = np.einsum('gni,gnj->gij', jacobian, jacobian)
+            gradient = np.einsum('gni,gn->gi', jacobian, residuals)
+            diagonal = np.diagonal(normal, axis1=1, axis2=2)
+            normal[:, np.arange(4), np.arange(4)] += damping[active, None] * diagonal + 1e-12
+            step = np.linalg.solve(normal, gradient[..., None])[..., 0]
+
+            candidate = params[active] + step
+            candidate_sse = self._sse(candidate, log_x[active], positive[active], y[active], mask[active])
+            improved = np.isfinite(candidate_sse) & (candidate_sse <= sse[active])
+            decrease = (sse[active] - candidate_sse) / np.maximum(sse[active], 1e-12)
+
+            accepted = active[improved]
+            params[accepted] = candidate[improved]
+            sse[accepted] = candidate_sse[improved]
+            damping[accepted] = np.maximum(damping[accepted] / 3, 1e-12)
+            damping[active[~improved]] *= 4
+            # a group has converged when an accepted step barely lowers the error, or when
+            # no step is accepted even with heavy damping (it sits at a minimum)
+            converged[accepted[decrease[improved] < self.tolerance]] = True
+            converged[active[~improved][damping[active[~improved]] > 1e8]] = True
+
+        return params, converged
+
+    def _initial_guess(self, y, mask, positive, log_x):
+        """
+        Starts every group at its response range, the concentration closest to half response and a slope of 1.
+        """
+        bottom = np.where(mask, y, np.inf).min(axis=1)
+        top = np.where(mask, y, -np.inf).max(axis=1)
+        middle = (top + bottom) / 2
+        closest = np.where(positive, np.abs(y - middle[:, None]), np.inf).argmin(axis=1)
+        log_ic50 = log_x[np.arange(len(y)), closest]
+
+        # responses rising with concentration get a negative slope
+        count = np.maximum(positive.sum(axis=1), 1)
+        mean_log_x = np.where(positive, log_x, 0).sum(axis=1) / count
+        mean_y = np.where(positive, y, 0).sum(axis=1) / count
+        covariance = np.where(positive, (log_x - mean_log_x[:, None]) * (y - mean_y[:, None]), 0).sum(axis=1)
+        hill_slope = np.where(covariance > 0, -1.0, 1.0)
+        return np.column_stack([bottom, top, log_ic50, hill_slope])
+
+    def _response(self, params, log_x, positive):
+        """
+        Returns the 4PL fraction (top is 1, bottom 0) of each point; zero concentrations sit at the top
+        for a positive slope and at the bottom for a negative one.
+        """
+        log_ic50, hill_slope = params[:, 2:3], params[:, 3:4]
+        exponent = np.clip(hill_slope * (log_x - log_ic50), -500, 500)
+        return np.where(positive, 1 / (1 + np.exp(exponent)), (1 + np.sign(hill_slope)) / 2)
+
+    def _sse(self, params, log_x, positive, y, mask):
+        fraction = self._response(params, log_x, positive)
+        predicted = params[:, 0:1] + (params[:, 1:2] - params[:, 0:1]) * fraction
+        return np.where(mask, (y - predicted) ** 2, 0).sum(axis=1)
+
+    def _jacobian(self, params, log_x, positive, y, mask):
+        """
+        Returns the Jacobian of the model (groups x points x 4) and the residuals, both zero on padding.
+        """
+        bottom, top, log_ic50, hill_slope = (params[:, i:i + 1] for i in range(4))
+        fraction = self._response(params, log_x, positive)
+        slope = (top - bottom) * fraction * (1 - fraction)
+        jacobian = np.stack([
+            1 - fraction,
+            fraction,
+            slope * hill_slope,
+            -slope * (log_x - log_ic50),
+        ], axis=-1) * mask[..., None]
+        residuals = np.where(mask, y - (bottom + (top - bottom) * fraction), 0)
+        return jacobian, residuals
+
+    def _r_squared(self, x, y, mask, params):
+        bottom, top, log_ic50, hill_slope = (params[:, i:i + 1] for i in range(4))
+        with np.errstate(over='ignore'):
+            predicted = four_parameter_logistic(x, bottom, top, np.exp(log_ic50), hill_slope)
+        count = np.maximum(mask.sum(axis=1), 1)
+        mean = np.where(mask, y, 0).sum(axis=1) / count
+        residual = np.where(mask, (y - predicted) ** 2, 0).sum(axis=1)
+        total = np.where(mask, (y - mean[:, None]) ** 2, 0).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, 1 - residual / total, np.nan)
+
+    def _plausible(self, x, y, mask, params):
+        """
+        Checks that each fit describes a dose response: the IC50 lies within a decade of the tested
+        concentrations, top and bottom lie within three response ranges of the data, and the curve
+        spans at least half that range. Flat responses, such as the dark controls at time 0, fit
+        about as well with any IC50 and fail these checks.
+        """
+        positive = mask & (x > 0)
+        low = np.log(np.where(positive, x, np.inf).min(axis=1) / 10)
+        high = np.log(np.where(positive, x, 0).max(axis=1) * 10)
+        minimum = np.where(mask, y, np.inf).min(axis=1)
+        maximum = np.where(mask, y, -np.inf).max(axis=1)
+        span = maximum - minimum
+        bottom, top, log_ic50 = params[:, 0], params[:, 1], params[:, 2]
+        return (
+            (low <= log_ic50) & (log_ic50 <= high)
+            & (np.minimum(bottom, top) >= minimum - 3 * span)
+            & (np.maximum(bottom, top) <= maximum + 3 * span)
+            & (np.abs(top - bottom) >= span / 2)
+        )
+
+    def _fit_fallback(self, problems):
+        """
+        Refits groups with scipy, on a process pool when there are at least `min_pool_groups` of them.
+        Returns a list of (params, converged), with params None if scipy is not installed.
+        """
+        if len(problems) >= self.min_pool_groups:
+            with ProcessPoolExecutor(max_workers=self.fallback_workers) as executor:
+                return list(executor.map(fit_single_curve, problems, chunksize=max(1, len(problems) // 32)))
+        return [fit_single_curve(problem) for problem in problems]
+
+
+def fit_single_curve(problem):
+    """
+    Fits one 4PL curve with `scipy.optimize.curve_fit`, starting from a previous estimate.
+
+    Parameters:
+    ----------
+    problem : tuple
+        The concentrations, the responses and the (bottom, top, log IC50, Hill slope) start values.
+
+    Returns:
+    -------
+    tuple
+        The fitted (bottom, top, log IC50, Hill slope) and whether the fit converged,
+        or (None, False) if scipy is not installed.
+    """
+    try:
+        from scipy.optimize import curve_fit
+    except ImportError:
+        return None, False
+
+    x, y, (bottom, top, log_ic50, hill_slope) = problem
+    start = [bottom, top, float(np.exp(np.clip(log_ic50, -700, 700))), hill_slope]
+    start = [value if np.isfinite(value) else 1.0 for value in start]
+    start[2] = min(max(start[2], 1e-12), 1e12)
+    try:
+        (bottom, top, ic50, hill_slope), _ = curve_fit(
+            four_parameter_logistic, x, y, p0=start,
+            bounds=([-np.inf, -np.inf, 1e-12, -np.inf], [np.inf, np.inf, np.inf, np.inf]), maxfev=1_000,
+        )
+    except (RuntimeError, ValueError):
+        return np.array(problem[2], dtype='float64'), False
+    return np.array([bottom, top, np.log(ic50), hill_slope]), True
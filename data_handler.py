@@ -1,6 +1,20 @@
+import csv
+import hashlib
+import re
+from pathlib import Path
+import tempfile
 import streamlit as st
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import pyarrow as pa
+import pyarrow.parquet as pq
+from curve_fitting import CurveFitter
+from experiment_index import ExperimentIndex
+from replicates import ReplicateStatistics
+from schema import is_parquet, staging_schema
+
+# a spare CSV column that holds the extra field of a row with too many fields
+EXTRA_FIELDS = "_extra_fields"
 
 class DataHandler:
     """
@@ -10,15 +24,42 @@ class DataHandler:
     ----------
     expected_files : dict
         A dictionary containing expected file names and their respective column names.
+    integer_columns : dict
+        A dictionary containing, per expected file, the columns that must hold integers.
+    chunk_size : int
+        The number of rows validated at a time.
+    spool_max_size : int
+        The size in bytes above which a validated file is spooled to disk.
+    max_plot_points : int
+        The number of points per facet above which faceted plots are downsampled.
+    plot_facet_columns : int
+        The number of facets per row in faceted plots.
+    plot_cache_size : int
+        The number of figures, facets and traces kept in a plot cache.
+    curve_fitter : CurveFitter
+        The engine fitting dose-response curves per (drug, cell line, treatment time).
+    curve_points : int
+        The number of points fitted curves are drawn with.
+    replicate_statistics : ReplicateStatistics
+        The engine computing the per-well replicate statistics and outlier flags.
     valid_files : list
         A list to store valid files after validation.
     unexpected_files : list
         A list to store unexpected files encountered during validation.
+    row_counts : dict
+        A dictionary containing the number of data rows of each valid file.
+    load_ids : dict
+        A dictionary containing the load identifier of each valid file.
     """
 
-    def __init__(self):
+    def __init__(self, staging_format="csv"):
         """
-        Initializes the DataHandler class with expected files and empty lists for valid and unexpected files.
+        Initializes the DataHandler class with expected files, validation settings and empty lists for valid and unexpected files.
+
+        Parameters:
+        ----------
+        staging_format : str
+            The format validated files are written in: "csv" or "parquet".
         """
         self.expected_files = {
             "data_photodynamic_therapy_cell_lines.csv": [
@@ -47,8 +88,26 @@ class DataHandler:
                 "result_012"
                 ]
                 }
+        self.integer_columns = {
+            "data_photodynamic_therapy_results.csv": [
+                column
+                for column in self.expected_files["data_photodynamic_therapy_results.csv"]
+                if column not in ("cell_line_code", "drug_code")
+            ]
+        }
+        self.chunk_size = 50_000
+        self.max_plot_points = 5_000
+        self.plot_facet_columns = 3
+        self.plot_cache_size = 64
+        self.curve_fitter = CurveFitter()
+        self.curve_points = 200
+        self.replicate_statistics = ReplicateStatistics()
+        self.spool_max_size = 16 * 1024 * 1024
+        self.staging_format = staging_format
         self.valid_files = []
         self.unexpected_files = []
+        self.row_counts = {}
+        self.load_ids = {}
 
     def upload_user_files(self):
         """
@@ -60,7 +119,7 @@ class DataHandler:
             A list of uploaded files.
         """
         uploaded_files = st.file_uploader(
-            "Add your data in file.csv", type="csv", accept_multiple_files=True
+            "Add your data in file.csv or file.parquet", type=["csv", "parquet"], accept_multiple_files=True
         )
         return uploaded_files
     
@@ -68,6 +127,9 @@ class DataHandler:
         """
         Validates the uploaded files against expected file names and column structures.
 
+        Files are streamed in chunks (see `stream_validate_file`), so memory use does not
+        grow with the size of the upload.
+
         Parameters
         ----------
         uploaded_files : list
@@ -76,42 +138,212 @@ class DataHandler:
         Returns
         -------
         list of tuple
-            A list of valid files, where each item is a tuple (file_name, file_content_bytes).
+            A list of valid files, where each item is a tuple (file_name, file_object)
+            and file_object is a binary file positioned at its start.
         """
         for uploaded_file in uploaded_files:
-            if uploaded_file.name not in self.expected_files:
+            # Parquet uploads stand in for the CSV file of the same name
+            file_name = str(Path(uploaded_file.name).with_suffix(".csv"))
+            if file_name not in self.expected_files or Path(uploaded_file.name).suffix not in (".csv", ".parquet"):
                 self.unexpected_files.append(uploaded_file.name)
                 st.error(
                     f""":x: Unexpected files: {self.unexpected_files}\n
                         Expected files: {list(self.expected_files.keys())}"""
                 )
-            else:
-                user_data = pd.read_csv(uploaded_file)
-                expected_columns = self.expected_files[uploaded_file.name]
-                if user_data.empty:
-                    st.error(f':x: File "{uploaded_file.name}" is empty.')
-                    continue
-                if list(user_data.columns) != expected_columns:
-                    st.error(
-                        f""":x: File "{uploaded_file.name}" has incorrect columns.\n
-                            Expected: {expected_columns}\n Found: {list(user_data.columns)}"""
-                    )
-                    continue
+                continue
 
-            user_data['user_id'] = st.session_state['user_id']
-            self.valid_files.append((uploaded_file.name, user_data.to_csv(index=False).encode()))
+            load_id = self.compute_load_id(uploaded_file, st.session_state['user_id'])
+            validated_file, row_count, errors = self.stream_validate_file(
+                uploaded_file, file_name, st.session_state['user_id'], load_id
+            )
+            if errors:
+                st.error(f':x: File "{uploaded_file.name}" is invalid.\n\n' + "\n\n".join(errors))
+                continue
+
+            self.row_counts[file_name] = row_count
+            self.load_ids[file_name] = load_id
+            self.valid_files.append((file_name, validated_file))
             st.success(f':white_check_mark: File "{uploaded_file.name}" is valid.')
     
         return self.valid_files
 
+    def compute_load_id(self, source, user_id):
+        """
+        Computes the load identifier of a file: a hash of the user ID and the file content.
+        Re-uploading the same file gives the same identifier, which scopes the staging rows
+        and merges of that load.
+
+        Parameters
+        ----------
+        source : file-like
+            A binary file object with the CSV content.
+        user_id : str
+            The user ID the file is uploaded for.
+
+        Returns
+        -------
+        str
+            The load identifier, 32 hexadecimal characters.
+        """
+        digest = hashlib.sha256(user_id.encode() + b"\0")
+        source.seek(0)
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+        source.seek(0)
+        return digest.hexdigest()[:32]
+
+    def stream_validate_file(self, source, file_name, user_id, load_id=None):
+        """
+        Validates a CSV or Parquet file chunk by chunk and re-encodes it with 'user_id' and 'load_id' columns.
+
+        The header (or Parquet schema) is checked against `expected_files`, then rows are
+        read `chunk_size` at a time, rows with too many fields are rejected, integer columns
+        are type-checked and each chunk is
+        appended to a spooled temporary file, which only spills to disk above `spool_max_size`.
+        The file is written as CSV, or as Snappy-compressed Parquet with the staging table
+        types when `staging_format` is "parquet".
+
+        Parameters
+        ----------
+        source : file-like
+            A binary file object with CSV or Parquet content (e.g. a Streamlit UploadedFile).
+        file_name : str
+            The expected file name, used to look up the expected columns.
+        user_id : str
+            The user ID appended to every row.
+        load_id : str, optional
+            The load identifier appended to every row. Defaults to `compute_load_id`.
+
+        Returns
+        -------
+        tuple
+            A tuple (validated_file, row_count, errors). Errors refer to rows by their line
+            number in the file (the header is line 1); when errors is not empty, validated_file
+            is None.
+        """
+        expected_columns = self.expected_files[file_name]
+        if load_id is None:
+            load_id = self.compute_load_id(source, user_id)
+        if is_parquet(source):
+            parquet_file = pq.ParquetFile(source)
+            header = parquet_file.schema_arrow.names
+            chunks = (
+                batch.to_pandas().astype("string").fillna("")
+                for batch in parquet_file.iter_batches(batch_size=self.chunk_size)
+            )
+        else:
+            header_line = source.readline().decode("utf-8-sig")
+            header = next(csv.reader([header_line]), [])
+            chunks = pd.read_csv(
+                source,
+                header=None,
+                names=expected_columns + [EXTRA_FIELDS],
+                index_col=False,
+                dtype=str,
+                keep_default_na=False,
+                chunksize=self.chunk_size,
+            )
+        if header != expected_columns:
+            return None, 0, [
+                f"""Incorrect columns.\n
+                    Expected: {expected_columns}\n Found: {header}"""
+            ]
+
+        validated_file = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        if self.staging_format == "parquet":
+            schema = staging_schema(expected_columns, self.integer_columns.get(file_name, []))
+            writer = pq.ParquetWriter(validated_file, schema, compression="snappy")
+        else:
+            writer = None
+            validated_file.write(",".join(expected_columns + ["user_id", "load_id"]).encode() + b"\n")
+
+        errors = []
+        row_count = 0
+        try:
+            for chunk in chunks:
+                first_line = row_count + 2
+                row_count += len(chunk)
+                if EXTRA_FIELDS in chunk:
+                    extra = chunk.pop(EXTRA_FIELDS).to_numpy() != ""
+                    if extra.any():
+                        errors.append(
+                            f"Wrong number of fields, expected {len(expected_columns)} "
+                            f"(lines {_format_lines(np.flatnonzero(extra) + first_line)})."
+                        )
+                errors.extend(self._validate_chunk(chunk, file_name, first_line))
+                if errors:
+                    continue
+                chunk['user_id'] = user_id
+                chunk['load_id'] = load_id
+                if writer is not None:
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                else:
+                    validated_file.write(chunk.to_csv(index=False, header=False).encode())
+        except pd.errors.ParserError as e:
+            # pandas counts lines from the first data line, and its expected count includes EXTRA_FIELDS
+            fields = re.search(r"Expected \d+ fields in line (\d+), saw (\d+)", str(e))
+            if fields:
+                errors.append(
+                    f"Wrong number of fields, expected {len(expected_columns)} "
+                    f"(line {int(fields[1]) + 1} has {fields[2]})."
+                )
+            else:
+                errors.append(f"Malformed row after line {row_count + 1}: {e}")
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if row_count == 0 and not errors:
+            errors.append("File is empty.")
+        if errors:
+            validated_file.close()
+            return None, row_count, errors
+
+        validated_file.seek(0)
+        return validated_file, row_count, errors
+
+    def _validate_chunk(self, chunk, file_name, first_line):
+        """
+        Checks and casts the integer columns of one chunk in place.
+
+        Parameters
+        ----------
+        chunk : DataFrame
+            The chunk read as strings.
+        file_name : str
+            The expected file name, used to look up the integer columns.
+        first_line : int
+            The line number of the first row of the chunk in the file.
+
+        Returns
+        -------
+        list of str
+            One message per invalid column, with the offending line numbers.
+        """
+        errors = []
+        for column in self.integer_columns.get(file_name, []):
+            values = chunk[column].str.strip()
+            blank = values == ""
+            numbers = pd.to_numeric(values.mask(blank), errors="coerce")
+            invalid = ~blank & (numbers.isna() | (numbers % 1 != 0))
+            if not column.startswith("result_"):
+                invalid |= blank
+
+            if invalid.any():
+                lines = np.flatnonzero(invalid.to_numpy()) + first_line
+                errors.append(f'Column "{column}" must contain integers (lines {_format_lines(lines)}).')
+            else:
+                chunk[column] = numbers.astype("Int64")
+        return errors
+
     def fetch_experiment_data(self, data, experiment_number):
         """
         Fetches experiment data for a specific experiment number.
 
         Parameters:
         ----------
-        data : DataFrame
-            The DataFrame containing experiment data.
+        data : DataFrame or ExperimentIndex
+            The DataFrame containing experiment data, or an index built over it.
         experiment_number : int
             The number of the experiment to fetch data for.
 
@@ -120,6 +352,9 @@ class DataHandler:
         experiment_data : DataFrame
             A DataFrame containing data for the specified experiment number.
         """
+        if isinstance(data, ExperimentIndex):
+            return data.get(experiment_number)
+
         experiment_data = pd.DataFrame(data)
         experiment_data = experiment_data[experiment_data['EXPERIMENT_NUMBER'] == experiment_number]
         
@@ -127,7 +362,7 @@ class DataHandler:
 
     def analyze_experiment_data(self, experiment_data):
         """
-        Analyzes the experiment data by calculating mean and standard deviation of result columns.
+        Analyzes the experiment data by calculating the replicate statistics of every well.
 
         Parameters:
         ----------
@@ -137,19 +372,20 @@ class DataHandler:
         Returns:
         -------
         experiment_data : DataFrame
-            The DataFrame with added 'MEAN' and 'STD' columns.
+            The DataFrame with added 'MEAN', 'STD', 'CV', 'MEDIAN', 'MAD', 'N_REPLICATES' and
+            'N_OUTLIERS' columns. MEAN leaves out outlier replicates when
+            `replicate_statistics.exclude_outliers` is set.
         control_means : DataFrame
             A DataFrame containing mean values for control groups.
         full_experiment_data : DataFrame
             The DataFrame with merged experiment data and control means.
         """
-        results_columns = [col for col in experiment_data.columns if col.startswith('RESULT_')]
-        
-        experiment_data['MEAN'] = experiment_data[results_columns].mean(axis=1, skipna=True).round(2)
-        experiment_data['STD'] = experiment_data[results_columns].std(axis=1, skipna=True).round(2)
-        
+        # Replicates may come as narrow nullable integers (see `schema.apply_schema`) or as text
+        # with blanks; the statistics are computed on one float64 matrix (see `ReplicateStatistics`).
+        self.replicate_statistics.add_columns(experiment_data)
+
         controls = experiment_data[(experiment_data['TREATMENT_TIME'] == 0) & (experiment_data['DRUG_CONCENTRATION'] == 0)]
-        control_means = controls.groupby(['DRUG_NAME', 'CELL_LINE_NAME'])['MEAN'].mean().reset_index()
+        control_means = controls.groupby(['DRUG_NAME', 'CELL_LINE_NAME'], observed=True)['MEAN'].mean().reset_index()
 
         full_experiment_data = experiment_data.merge(control_means, on=['DRUG_NAME', 'CELL_LINE_NAME'], suffixes=('', '_CONTROL'))
 
@@ -183,7 +419,88 @@ class DataHandler:
 
         return full_experiment_data
     
-    def create_plots(self, user_result, filter_type, selected_value, x_axis, y_axis, treatment_times):
+    def analyze_all_experiments(self, data):
+        """
+        Computes the replicate statistics, control means and SURVIVAL_RATE for every experiment in one pass.
+
+        The result matches, row for row, what `analyze_experiment_data` followed by
+        `calculate_survival` returns for a single experiment, so a per-experiment view
+        is just a slice of this frame (see `slice_experiment`).
+
+        Parameters:
+        ----------
+        data : DataFrame
+            The DataFrame containing data for all experiments.
+
+        Returns:
+        -------
+        full_data : DataFrame
+            The DataFrame with added replicate statistics (see `analyze_experiment_data`),
+            'MEAN_CONTROL' and 'SURVIVAL_RATE' columns.
+            Rows without a control group in their experiment are dropped.
+        """
+        full_data = pd.DataFrame(data).reset_index(drop=True)
+        self.replicate_statistics.add_columns(full_data)
+
+        # Control wells are those with no treatment time and no drug; their MEAN is
+        # averaged per (experiment, drug, cell line) and broadcast back to every row.
+        is_control = (full_data['TREATMENT_TIME'] == 0) & (full_data['DRUG_CONCENTRATION'] == 0)
+        group_ids = full_data.groupby(['EXPERIMENT_NUMBER', 'DRUG_NAME', 'CELL_LINE_NAME'], sort=False, observed=True).ngroup()
+        control_count = is_control.groupby(group_ids).transform('sum')
+        full_data['MEAN_CONTROL'] = full_data['MEAN'].where(is_control).groupby(group_ids).transform('mean')
+
+        # Same as the inner merge in `analyze_experiment_data`: drop rows without controls
+        # and rows whose drug or cell line is missing (groupby skips NaN keys).
+        has_control = (group_ids >= 0) & (control_count > 0)
+        full_data = full_data[has_control].reset_index(drop=True)
+
+        survival = (full_data['MEAN'] / full_data['MEAN_CONTROL'] * 100).round(2)
+        full_data['SURVIVAL_RATE'] = survival.mask(full_data['MEAN_CONTROL'] == 0, 0.0)
+
+        return full_data
+
+    def slice_experiment(self, full_data, experiment_number):
+        """
+        Returns the precomputed analysis of a single experiment.
+
+        Parameters:
+        ----------
+        full_data : DataFrame or ExperimentIndex
+            The DataFrame returned by `analyze_all_experiments`, or an index built over it.
+        experiment_number : int
+            The number of the experiment to return.
+
+        Returns:
+        -------
+        user_result : DataFrame
+            The rows of the specified experiment, equal to the output of `calculate_survival`.
+        """
+        if isinstance(full_data, ExperimentIndex):
+            user_result = full_data.get(experiment_number)
+        else:
+            user_result = full_data[full_data['EXPERIMENT_NUMBER'] == experiment_number]
+
+        return user_result.reset_index(drop=True)
+
+    def fit_dose_response(self, user_result):
+        """
+        Fits a 4-parameter logistic curve of SURVIVAL_RATE against DRUG_CONCENTRATION per
+        (drug, cell line, treatment time), all groups in one batch (see `CurveFitter`).
+
+        Parameters:
+        ----------
+        user_result : DataFrame
+            The survival table, e.g. returned by `calculate_survival` or `slice_experiment`.
+
+        Returns:
+        -------
+        fits : DataFrame
+            One row per group with IC50, HILL_SLOPE, TOP, BOTTOM, R_SQUARED, CONVERGED,
+            N_POINTS and METHOD.
+        """
+        return self.curve_fitter.fit(user_result)
+
+    def create_plots(self, user_result, filter_type, selected_value, x_axis, y_axis, treatment_times, fits=None, template=None):
         """
         Creates a list of scatter plots based on the filtered data.
 
@@ -194,6 +511,8 @@ class DataHandler:
         - **x_axis** (str): The column name for the x-axis.
         - **y_axis** (str): The column name for the y-axis.
         - **treatment_times** (list): A list of treatment times to create plots for. Each time should be in a format that can be sorted numerically (e.g., "0 min", "5 min", etc.).
+        - **fits** (DataFrame, optional): The curve fits returned by `fit_dose_response`, drawn as lines on survival vs concentration plots.
+        - **template** (str, optional): The Plotly template, e.g. "plotly" for figures rendered outside of Streamlit; defaults to the active one.
 
         Returns:
         - **figures** (list): A list of Plotly figures, each representing a scatter plot for a specific treatment time.
@@ -202,7 +521,11 @@ class DataHandler:
         - The function first filters the data based on the specified filter type and value.
         - It then sorts the treatment times in ascending order before creating the plots.
         - If 'CELL_LINE_NAME' or 'DRUG_NAME' columns are present in the filtered data, they are used for coloring the points in the scatter plots.
+        - Fitted curves take the color of the points they were fitted to; fits that did not converge are dashed.
         """
+        # plotly is imported on the first plot, not when the app starts
+        import plotly.express as px
+
         def format_axis_title(axis_name):
             return axis_name.replace("_", " ").lower().capitalize()
         
@@ -237,9 +560,15 @@ class DataHandler:
                 y=y_axis,
                 color=color_col if color_col else None,
                 hover_data=['DRUG_NAME', 'CELL_LINE_NAME'],
-                title=f"{x_axis_title} vs {y_axis_title} for {selected_value} at {time} min"
+                title=f"{x_axis_title} vs {y_axis_title} for {selected_value} at {time} min",
+                template=template,
             )
-            
+
+            trace_colors = {trace.name: trace.marker.color for trace in fig.data}
+            for fit_trace in self._fit_traces(fits, filter_type, selected_value, time, x_axis, y_axis, df_subset):
+                fit_trace.line.color = trace_colors.get(fit_trace.legendgroup)
+                fig.add_trace(fit_trace)
+
             fig.update_layout(
                 xaxis_title=x_axis_title,
                 yaxis_title=y_axis_title,
@@ -252,3 +581,192 @@ class DataHandler:
         
         return figures
 
+
+    def create_faceted_plot(self, user_result, filter_type, selected_value, x_axis, y_axis, treatment_times, data_version=None, cache=None, fits=None):
+        """
+        Creates one figure with a WebGL scatter facet per treatment time.
+
+        Parameters:
+        - **user_result** (DataFrame): The DataFrame containing the user's results.
+        - **filter_type** (str): The type of filter to apply. Can be either "Drugs" or "Cell Lines".
+        - **selected_value** (str): The value to filter by.
+        - **x_axis** (str): The column name for the x-axis.
+        - **y_axis** (str): The column name for the y-axis.
+        - **treatment_times** (list): A list of treatment times, one facet each.
+        - **data_version** (str, optional): Identifies the data in `user_result`; required for caching.
+        - **cache** (OrderedDict, optional): An LRU cache of built figures and facets, e.g. kept in session state.
+        - **fits** (DataFrame, optional): The curve fits of `user_result` returned by `fit_dose_response`, drawn as lines.
+
+        Returns:
+        - **fig** (Figure): A Plotly figure with one subplot per treatment time.
+
+        Notes:
+        - The data is filtered and split by treatment time once per (data version, filter); the split is cached,
+          so changing only the axes does not filter the data again.
+        - Facets with more than `max_plot_points` points are downsampled (see `_downsample`).
+        - Built traces are cached per (data version, filter, treatment time, axes) and whole figures per
+          (data version, filter, axes), up to `plot_cache_size` entries.
+        """
+        import plotly.express as px
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+
+        def format_axis_title(axis_name):
+            return axis_name.replace("_", " ").lower().capitalize()
+
+        treatment_times = sorted(treatment_times, key=lambda x: int(x.split()[0]) if isinstance(x, str) else x)
+        use_cache = cache is not None and data_version is not None
+        figure_key = ("figure", data_version, filter_type, selected_value, x_axis, y_axis, tuple(treatment_times), fits is not None)
+        if use_cache and figure_key in cache:
+            cache.move_to_end(figure_key)
+            return cache[figure_key]
+
+        facets_key = ("facets", data_version, filter_type, selected_value)
+        if use_cache and facets_key in cache:
+            facets = cache[facets_key]
+        else:
+            filter_column = 'DRUG_NAME' if filter_type == "Drugs" else 'CELL_LINE_NAME'
+            filtered_df = user_result[user_result[filter_column] == selected_value]
+            facets = dict(tuple(filtered_df.groupby('TREATMENT_TIME', sort=False, observed=True)))
+            self._cache_put(cache if use_cache else None, facets_key, facets)
+
+        color_col = 'CELL_LINE_NAME' if 'CELL_LINE_NAME' in user_result.columns else None
+        colors = px.colors.qualitative.Plotly
+        color_values = list(pd.unique(user_result[color_col])) if color_col else [None]
+        color_map = {value: colors[i % len(colors)] for i, value in enumerate(color_values)}
+
+        columns = min(len(treatment_times), self.plot_facet_columns) or 1
+        rows = -(-len(treatment_times) // columns) or 1
+        fig = make_subplots(
+            rows=rows,
+            cols=columns,
+            shared_yaxes=True,
+            subplot_titles=[f"{time} min" for time in treatment_times],
+        )
+        shown_in_legend = set()
+        for position, time in enumerate(treatment_times):
+            traces_key = ("traces", data_version, filter_type, selected_value, time, x_axis, y_axis)
+            if use_cache and traces_key in cache:
+                traces = cache[traces_key]
+            else:
+                df_subset = facets.get(time, user_result.iloc[0:0])
+                traces = self._build_traces(df_subset, x_axis, y_axis, color_col)
+                self._cache_put(cache if use_cache else None, traces_key, traces)
+
+            for name, trace_data in traces:
+                trace = go.Scattergl(
+                    x=trace_data['x'],
+                    y=trace_data['y'],
+                    mode="markers",
+                    name=str(name),
+                    legendgroup=str(name),
+                    showlegend=name not in shown_in_legend and color_col is not None,
+                    marker=dict(color=color_map.get(name, colors[0])),
+                    customdata=trace_data['customdata'],
+                    hovertemplate="%{x}, %{y}<br>%{customdata[0]}<br>%{customdata[1]}<extra></extra>",
+                )
+                fig.add_trace(trace, row=position // columns + 1, col=position % columns + 1)
+                shown_in_legend.add(name)
+
+            df_subset = facets.get(time, user_result.iloc[0:0])
+            for fit_trace in self._fit_traces(fits, filter_type, selected_value, time, x_axis, y_axis, df_subset):
+                fit_trace.line.color = color_map.get(fit_trace.legendgroup, colors[0])
+                fit_trace.showlegend = False
+                fig.add_trace(fit_trace, row=position // columns + 1, col=position % columns + 1)
+
+        x_axis_title = format_axis_title(x_axis)
+        y_axis_title = format_axis_title(y_axis)
+        fig.update_xaxes(title_text=x_axis_title, showgrid=True)
+        fig.update_yaxes(showgrid=True)
+        fig.update_yaxes(title_text=y_axis_title, col=1)
+        fig.update_layout(
+            title=f"{x_axis_title} vs {y_axis_title} for {selected_value}",
+            height=max(400, 350 * rows),
+        )
+
+        self._cache_put(cache if use_cache else None, figure_key, fig)
+        return fig
+
+    def _fit_traces(self, fits, filter_type, selected_value, time, x_axis, y_axis, df_subset):
+        """
+        Builds the line traces of the fitted curves of one treatment time, grouped by cell line.
+        Curves are only drawn on plots of the fitted response against concentration.
+        """
+        import plotly.graph_objects as go
+
+        fitter = self.curve_fitter
+        if fits is None or x_axis != fitter.x_column or y_axis != fitter.y_column or df_subset.empty:
+            return []
+
+        filter_column = 'DRUG_NAME' if filter_type == "Drugs" else 'CELL_LINE_NAME'
+        selected = fits[(fits[filter_column] == selected_value) & (fits['TREATMENT_TIME'] == time) & fits['IC50'].notna()]
+        concentrations = np.linspace(0, pd.to_numeric(df_subset[x_axis]).max(), self.curve_points)
+        return [
+            go.Scatter(
+                x=concentrations,
+                y=fitter.curve(fit, concentrations),
+                mode="lines",
+                name=f"{fit['DRUG_NAME']} / {fit['CELL_LINE_NAME']} fit (IC50 {fit['IC50']:.3g})",
+                legendgroup=str(fit['CELL_LINE_NAME']),
+                line=dict(dash="solid" if fit['CONVERGED'] else "dash"),
+                hovertemplate=(
+                    f"IC50 {fit['IC50']:.3g}, Hill slope {fit['HILL_SLOPE']:.2f}, "
+                    f"R² {fit['R_SQUARED']:.3f}<extra>{fit['DRUG_NAME']} / {fit['CELL_LINE_NAME']}</extra>"
+                ),
+            )
+            for _, fit in selected.iterrows()
+        ]
+
+    def _build_traces(self, df_subset, x_axis, y_axis, color_col):
+        """
+        Builds the trace data of one facet: one (name, data) pair per color value.
+        """
+        df_subset = self._downsample(df_subset, x_axis, y_axis, color_col)
+        groups = df_subset.groupby(color_col, sort=False, observed=True) if color_col else [(None, df_subset)]
+        return [
+            (name, {
+                'x': group[x_axis].to_numpy(),
+                'y': group[y_axis].to_numpy(),
+                'customdata': group[['DRUG_NAME', 'CELL_LINE_NAME']].to_numpy(),
+            })
+            for name, group in groups
+        ]
+
+    def _downsample(self, df_subset, x_axis, y_axis, color_col):
+        """
+        Reduces a facet to at most `max_plot_points` points.
+
+        Points sharing a color and an x value (e.g. replicate wells at one concentration) are first
+        averaged; if that is still too many points, an evenly spaced sample is kept.
+        """
+        if len(df_subset) <= self.max_plot_points:
+            return df_subset
+
+        keys = [color_col, x_axis] if color_col and color_col != x_axis else [x_axis]
+        if y_axis not in keys and pd.api.types.is_numeric_dtype(df_subset[y_axis]):
+            aggregations = {y_axis: 'mean', 'DRUG_NAME': 'first', 'CELL_LINE_NAME': 'first'}
+            aggregations = {column: how for column, how in aggregations.items() if column not in keys}
+            df_subset = df_subset.groupby(keys, sort=False, observed=True, as_index=False).agg(aggregations)
+        if len(df_subset) > self.max_plot_points:
+            step = -(-len(df_subset) // self.max_plot_points)
+            df_subset = df_subset.iloc[::step]
+        return df_subset
+
+    def _cache_put(self, cache, key, value):
+        """
+        Stores a value in an LRU cache, evicting the oldest entries above `plot_cache_size`.
+        """
+        if cache is None:
+            return
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.plot_cache_size:
+            cache.popitem(last=False)
+
+
+def _format_lines(lines, limit=10):
+    """
+    Formats line numbers for an error message, e.g. "3, 7, 12, ...", showing at most `limit` of them.
+    """
+    lines = list(map(int, lines))
+    return ", ".join(map(str, lines[:limit])) + (", ..." if len(lines) > limit else "")
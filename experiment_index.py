@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+class ExperimentIndex:
+    """
+    A partition map from experiment number to a contiguous block of rows.
+
+    The frame is sorted by experiment number once, at build time. Every lookup is then
+    a dictionary hit plus a positional slice, without scanning or copying the data.
+
+    Attributes:
+    ----------
+    data : DataFrame
+        The indexed DataFrame, stably sorted by the key column.
+    key : str
+        The name of the column the frame is partitioned by.
+    ranges : dict
+        A dictionary mapping each experiment number to its (start, stop) row positions.
+    """
+
+    def __init__(self, data, key='EXPERIMENT_NUMBER'):
+        """
+        Builds the index over a DataFrame.
+
+        Parameters:
+        ----------
+        data : DataFrame
+            The DataFrame to index, e.g. the result of `SnowflakeHandler.fetch_full_data`.
+        key : str
+            The name of the column to partition the frame by.
+        """
+        data = pd.DataFrame(data)
+        order = np.argsort(data[key].to_numpy(), kind='stable')
+        self.data = data.take(order).reset_index(drop=True)
+        self.key = key
+
+        keys = self.data[key]
+        boundaries = np.flatnonzero(keys.ne(keys.shift()).to_numpy())
+        stops = np.append(boundaries[1:], len(keys))
+        self.ranges = {
+            int(keys.iat[start]): (int(start), int(stop))
+            for start, stop in zip(boundaries, stops)
+            if pd.notna(keys.iat[start])
+        }
+
+    @property
+    def numbers(self):
+        """
+        Returns the sorted list of experiment numbers present in the data.
+        """
+        return sorted(self.ranges)
+
+    def get(self, experiment_number):
+        """
+        Returns the rows of a single experiment.
+
+        Parameters:
+        ----------
+        experiment_number : int
+            The number of the experiment to return.
+
+        Returns:
+        -------
+        DataFrame
+            A positional slice of the indexed frame; empty if the experiment does not exist.
+        """
+        start, stop = self.ranges.get(experiment_number, (0, 0))
+        return self.data.iloc[start:stop]
+
+    def __contains__(self, experiment_number):
+        return experiment_number in self.ranges
+
+    def __len__(self):
+        return len(self.ranges)
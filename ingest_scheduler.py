@@ -0,0 +1,234 @@
+from collections import deque
+from concurrent.futures import Future
+import threading
+import time
+import numpy as np
+from tracing import Tracer
+
+class IngestScheduler:
+    """
+    Coalesces the ingests of many sessions into shared Snowpipe refresh and merge cycles.
+
+    Loads submitted within `window` seconds of the first pending one form a batch. The batch
+    runs one `reset_pipeline` for the combined expected rows and one `run_merge_pipeline` for
+    the combined load IDs, and every submitter is then notified through its future. If not all
+    rows arrive in time, only the loads missing rows fail; the others are merged. Batches run
+    one at a time on a background thread, so merges of different users never overlap. The
+    spans of a batch are copied to the tracer of every submitter.
+
+    Attributes:
+    ----------
+    window : float
+        The number of seconds to collect loads for, counted from the first pending one.
+    max_batch : int
+        The maximum number of loads per batch; a full batch starts without waiting.
+    batches : int
+        The number of batches run.
+    loads : int
+        The number of loads merged.
+    failures : int
+        The number of loads whose batch failed.
+    """
+
+    def __init__(self, create_snow_handler, window=2.0, max_batch=50, history=1000):
+        """
+        Initializes the scheduler and starts its background thread.
+
+        Parameters:
+        ----------
+        create_snow_handler : callable
+            Called with a `Tracer`, returns a new `SnowflakeHandler` recording on it; one is opened per batch.
+        window : float
+            The number of seconds to collect loads for.
+        max_batch : int
+            The maximum number of loads per batch.
+        history : int
+            The number of recent batches and loads kept for the latency metrics.
+        """
+        self.create_snow_handler = create_snow_handler
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.loads = 0
+        self.failures = 0
+        self._batch_sizes = deque(maxlen=history)
+        self._cycle_seconds = deque(maxlen=history)
+        self._latencies = deque(maxlen=history)
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name="ingest-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, expected_rows, load_ids, on_state=None, tracer=None):
+        """
+        Queues a load for the next batch.
+
+        Parameters:
+        ----------
+        expected_rows : dict
+            A dictionary mapping uploaded file names to their number of data rows, as for
+            `SnowflakeHandler.reset_pipeline`. Empty if the rows are already in staging.
+        load_ids : list of str
+            The load identifiers of the files.
+        on_state : callable, optional
+            Called with "merging" when the batch of the load starts merging.
+        tracer : Tracer, optional
+            The tracer of the submitting session. The spans of the batch are added to it, nested
+            under the span open in the calling thread.
+
+        Returns:
+        -------
+        Future
+            Resolves to a dictionary with the merge timings and the batch size once the load is
+            merged, or raises the error of its batch.
+        """
+        future = Future()
+        with self._condition:
+            self._pending.append({
+                "expected_rows": dict(expected_rows),
+                "load_ids": list(load_ids),
+                "on_state": on_state,
+                "tracer": tracer,
+                "parent_id": tracer.current_span_id() if tracer else None,
+                "future": future,
+                "submitted_at": time.monotonic(),
+            })
+            self._condition.notify()
+        return future
+
+    def stats(self):
+        """
+        Returns the scheduler metrics.
+
+        Returns:
+        -------
+        dict
+            The window, pending loads, batch and load counts, batch sizes, cycle durations and
+            the p50 and p95 latency from submission to notification, in seconds.
+        """
+        with self._condition:
+            sizes = list(self._batch_sizes)
+            cycles = list(self._cycle_seconds)
+            latencies = list(self._latencies)
+            pending = len(self._pending)
+        return {
+            "window": self.window,
+            "pending": pending,
+            "batches": self.batches,
+            "loads": self.loads,
+            "failures": self.failures,
+            "mean_batch_size": float(np.mean(sizes)) if sizes else 0.0,
+            "max_batch_size": max(sizes, default=0),
+            "mean_cycle_seconds": float(np.mean(cycles)) if cycles else 0.0,
+            "p50_latency_seconds": float(np.percentile(latencies, 50)) if latencies else 0.0,
+            "p95_latency_seconds": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        }
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = self._pending[0]["submitted_at"] + self.window
+                while len(self._pending) < self.max_batch and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        """
+        Runs one refresh and merge cycle for a batch of loads and notifies their submitters.
+        """
+        expected_rows = {}
+        for load in batch:
+            for file_name, rows in load["expected_rows"].items():
+                expected_rows[file_name] = expected_rows.get(file_name, 0) + rows
+        load_ids = sorted({load_id for load in batch for load_id in load["load_ids"]})
+
+        tracer = Tracer()
+        errors = {}
+        merged = []
+        start = time.monotonic()
+        try:
+            snow_handler = self.create_snow_handler(tracer)
+            try:
+                with tracer.span("ingest_batch", loads=len(batch), rows=sum(expected_rows.values())) as span:
+                    if not snow_handler.reset_pipeline(expected_rows, load_ids):
+                        # fail only the loads that are still missing rows
+                        for index, load in enumerate(batch):
+                            missing = self._missing_rows(snow_handler, load)
+                            if missing:
+                                errors[index] = TimeoutError(
+                                    f"Your data did not arrive in Snowflake in time. Rows loaded so far: {missing}"
+                                )
+                        span["missing_loads"] = len(errors)
+                    merged = [load for index, load in enumerate(batch) if index not in errors]
+                    if merged:
+                        for load in merged:
+                            if load["on_state"]:
+                                load["on_state"]("merging")
+                        merge_timings = snow_handler.run_merge_pipeline(
+                            sorted({load_id for load in merged for load_id in load["load_ids"]})
+                        )
+            finally:
+                snow_handler.close_connection()
+        except Exception as e:
+            print(f"Ingest batch of {len(batch)} loads failed: {e}")
+            errors = {index: errors.get(index, e) for index in range(len(batch))}
+        if errors:
+            print(f"{len(errors)} of {len(batch)} loads of an ingest batch failed")
+        result = {"merge_timings": merge_timings, "batch_size": len(merged)} if len(errors) < len(batch) else None
+
+        end = time.monotonic()
+        with self._condition:
+            self.batches += 1
+            self.loads += len(batch)
+            self.failures += len(errors)
+            self._batch_sizes.append(len(batch))
+            self._cycle_seconds.append(end - start)
+            self._latencies.extend(end - load["submitted_at"] for load in batch)
+        for index, load in enumerate(batch):
+            if load["tracer"] is not None:
+                load["tracer"].add_spans(tracer.spans, load["parent_id"])
+            if index in errors:
+                load["future"].set_exception(errors[index])
+            else:
+                load["future"].set_result(result)
+
+    def _missing_rows(self, snow_handler, load):
+        """
+        Returns the staging tables in which a load is missing rows, as "loaded/expected" strings.
+        """
+        if not load["expected_rows"]:
+            return {}
+        counts = snow_handler.count_staging_rows(load["load_ids"])
+        expected = {snow_handler.staging_tables[file_name]: rows for file_name, rows in load["expected_rows"].items()}
+        return {table: f"{counts[table]}/{rows}" for table, rows in expected.items() if counts[table] < rows}
+
+
+def create_ingest_scheduler(create_snow_handler):
+    """
+    Creates an ingest scheduler configured from secrets
+    (`ingest_batch_window_s`, default 2, and `ingest_max_batch`, default 50).
+    With the local warehouse (`warehouse_backend: local`) merges take milliseconds,
+    so the window defaults to 0 and loads are not held back.
+
+    Parameters:
+    ----------
+    create_snow_handler : callable
+        Called with a `Tracer`, returns a new `SnowflakeHandler`.
+
+    Returns:
+    -------
+    IngestScheduler
+        The scheduler, meant to be created once per process and shared by all sessions.
+    """
+    from backends import get_secrets
+
+    secrets = get_secrets()
+    return IngestScheduler(
+        create_snow_handler,
+        window=secrets.get("ingest_batch_window_s", 0.0 if secrets.get("warehouse_backend") == "local" else 2.0),
+        max_batch=secrets.get("ingest_max_batch", 50),
+    )
@@ -0,0 +1,332 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import threading
+import time
+import uuid
+
+STATES = ["queued", "uploading", "loading", "merging", "ready", "failed"]
+ACTIVE_STATES = ["queued", "uploading", "loading", "merging"]
+
+class JobStore:
+    """
+    Persists the state of background jobs as one JSON file per job.
+
+    A job is a dictionary with its ID, user ID, state (one of `STATES`), per-stage progress
+    between 0 and 1, error message, result and timestamps.
+
+    Attributes:
+    ----------
+    directory : Path
+        The directory holding the job files.
+    """
+
+    def __init__(self, directory):
+        """
+        Initializes the store.
+
+        Parameters:
+        ----------
+        directory : str or Path
+            The directory holding the job files. It is created if it does not exist.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def create(self, user_id):
+        """
+        Creates a queued job.
+
+        Parameters:
+        ----------
+        user_id : str
+            The user the job belongs to.
+
+        Returns:
+        -------
+        dict
+            The new job.
+        """
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex[:16],
+            "user_id": user_id,
+            "state": "queued",
+            "progress": {},
+            "error": None,
+            "result": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        with self._lock:
+            self._write(job)
+        return job
+
+    def get(self, job_id):
+        """
+        Loads a job.
+
+        Parameters:
+        ----------
+        job_id : str
+            The ID of the job.
+
+        Returns:
+        -------
+        dict or None
+            The job, or None if it does not exist.
+        """
+        path = self._path(job_id)
+        with self._lock:
+            return json.loads(path.read_text()) if path.exists() else None
+
+    def update(self, job_id, progress=None, **changes):
+        """
+        Updates a job.
+
+        Parameters:
+        ----------
+        job_id : str
+            The ID of the job.
+        progress : dict, optional
+            A dictionary mapping stage names to their progress, merged into the job's progress.
+        **changes
+            The fields to replace, e.g. state, error or result.
+
+        Returns:
+        -------
+        dict
+            The updated job.
+        """
+        with self._lock:
+            job = json.loads(self._path(job_id).read_text())
+            job.update(changes)
+            job["progress"].update(progress or {})
+            job["updated_at"] = time.time()
+            self._write(job)
+        return job
+
+    def _path(self, job_id):
+        if not job_id.isalnum():
+            raise ValueError(f"Invalid job ID: {job_id!r}")
+        return self.directory / f"{job_id}.json"
+
+    def _write(self, job):
+        path = self._path(job["job_id"])
+        temporary_path = path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(job, default=str))
+        os.replace(temporary_path, path)
+
+
+class JobRunner:
+    """
+    Runs jobs on a bounded pool of worker threads and records their state in a `JobStore`.
+
+    The runner is meant to be created once per process and shared by all sessions, so a
+    rerun or a reconnect can look a job up again by its ID. Job functions run outside of any
+    Streamlit script and must not call `st.*`.
+
+    Attributes:
+    ----------
+    store : JobStore
+        The store the job states are persisted in.
+    max_workers : int
+        The maximum number of jobs running at once; further jobs wait in the "queued" state.
+    """
+
+    def __init__(self, store, max_workers=4):
+        """
+        Initializes the runner.
+
+        Parameters:
+        ----------
+        store : JobStore
+            The store the job states are persisted in.
+        max_workers : int
+            The maximum number of jobs running at once.
+        """
+        self.store = store
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        # only unfinished jobs are kept, with their current state; finished ones are only counted
+        self._states = {}
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, func, *args):
+        """
+        Queues a job.
+
+        Parameters:
+        ----------
+        user_id : str
+            The user the job belongs to.
+        func : callable
+            The job function. It is called as `func(update, *args)`, where `update` takes the
+            keyword arguments of `JobStore.update` (e.g. `state="loading"` or
+            `progress={"uploading": 0.5}`). Its return value becomes the job's result.
+        *args
+            The arguments passed on to the job function.
+
+        Returns:
+        -------
+        str
+            The ID of the job.
+        """
+        with self._lock:
+            job = self.store.create(user_id)
+            self._states[job["job_id"]] = "queued"
+            self._executor.submit(self._run, job["job_id"], func, args)
+        return job["job_id"]
+
+    def get(self, job_id):
+        """
+        Returns the current state of a job.
+        Jobs left active by a previous process are marked as failed.
+
+        Parameters:
+        ----------
+        job_id : str
+            The ID of the job.
+
+        Returns:
+        -------
+        dict or None
+            The job, or None if it does not exist.
+        """
+        with self._lock:
+            job = self.store.get(job_id)
+            interrupted = job is not None and job["state"] in ACTIVE_STATES and job_id not in self._states
+        if interrupted:
+            job = self.store.update(job_id, state="failed", error="The job was interrupted by a restart.")
+        return job
+
+    def stats(self):
+        """
+        Returns the number of jobs per state among the jobs submitted to this runner, from memory.
+        """
+        with self._lock:
+            counts = dict(self._finished)
+            for state in self._states.values():
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def _run(self, job_id, func, args):
+        def update(**changes):
+            job = self.store.update(job_id, **changes)
+            if "state" in changes:
+                with self._lock:
+                    self._states[job_id] = changes["state"]
+            return job
+
+        try:
+            changes = {"state": "ready", "result": func(update, *args)}
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            changes = {"state": "failed", "error": f"{type(e).__name__}: {e}"}
+        # the job file and the in-memory state change together, see `get`
+        with self._lock:
+            self.store.update(job_id, **changes)
+            del self._states[job_id]
+            self._finished[changes["state"]] = self._finished.get(changes["state"], 0) + 1
+
+
+def run_ingest(update, valid_files, row_counts, load_ids, user_id, aws_handler, create_snow_handler, scheduler=None):
+    """
+    Uploads validated files, waits for them to land in staging, merges them and warms the result cache.
+
+    With a scheduler, the Snowpipe wait and the merge are shared with the loads of other
+    sessions submitted at about the same time (see `IngestScheduler`).
+
+    Parameters:
+    ----------
+    update : callable
+        Records the job's state and progress (see `JobRunner.submit`).
+    valid_files : list
+        A list of tuples (file_name, file_object) as returned by `DataHandler.validate_user_data`.
+    row_counts : dict
+        A dictionary mapping file names to their number of data rows.
+    load_ids : list of str
+        The load identifiers of the files.
+    user_id : str
+        The user the data belongs to.
+    aws_handler : AWSHandler
+        The handler to upload the files with.
+    create_snow_handler : callable
+        Returns a new `SnowflakeHandler`; the job opens its own connection, and gives it back
+        while the scheduler runs its batch.
+    scheduler : IngestScheduler, optional
+        The scheduler to batch the refresh and merge cycle with.
+
+    Returns:
+    -------
+    dict
+        The upload statistics, the merge timings and the number of loads merged together.
+    """
+    snow_handler = create_snow_handler()
+    upload_stats = []
+    try:
+        with snow_handler.tracer.span("ingest_job", files=len(valid_files)):
+            if snow_handler.ingest_mode == "direct":
+                update(state="loading")
+                snow_handler.load_staging_files(valid_files)
+                expected_rows = {}
+            else:
+                update(state="uploading")
+                upload_stats = aws_handler.upload_files(
+                    valid_files, progress=lambda done, total: update(progress={"uploading": done / total})
+                )
+                # files already in the bucket are not loaded again, so only wait for the new ones
+                expected_rows = {
+                    stats["file_name"]: row_counts[stats["file_name"]] for stats in upload_stats if not stats["skipped"]
+                }
+                update(state="loading")
+
+            if scheduler is not None:
+                # the batch opens its own connection: give this one back to the pool while waiting,
+                # or concurrent jobs could hold every pooled connection and starve their own batch
+                snow_handler.close_connection()
+                batch = scheduler.submit(
+                    expected_rows, load_ids,
+                    on_state=lambda state: update(state=state, progress={"loading": 1.0}),
+                    tracer=snow_handler.tracer,
+                ).result()
+                merge_timings, batch_size = batch["merge_timings"], batch["batch_size"]
+            else:
+                if expected_rows:
+                    total_rows = sum(expected_rows.values())
+                    loaded = snow_handler.reset_pipeline(
+                        expected_rows, load_ids,
+                        progress=lambda counts: update(progress={"loading": min(sum(counts.values()) / total_rows, 1.0)}),
+                    )
+                    if not loaded:
+                        raise TimeoutError(
+                            f"Your data did not arrive in Snowflake in time. Rows loaded so far: {snow_handler.staging_counts}"
+                        )
+                update(state="merging", progress={"loading": 1.0})
+                merge_timings, batch_size = snow_handler.run_merge_pipeline(load_ids), 1
+            if snow_handler.cache is not None:
+                snow_handler.cache.invalidate(user_id)
+            columns = ["EXPERIMENT_NUMBER"] if snow_handler.aggregation_mode == "warehouse" else None
+            snow_handler.fetch_full_data("combined_results", user_id, columns=columns)
+            update(progress={"merging": 1.0})
+    finally:
+        snow_handler.close_connection()
+
+    return {"upload_stats": upload_stats, "merge_timings": merge_timings, "batch_size": batch_size}
+
+
+def create_job_runner(directory=".cache/jobs"):
+    """
+    Creates a job runner sized from secrets (`ingest_max_workers`, default 4).
+
+    Returns:
+    -------
+    JobRunner
+        The runner, meant to be created once per process and shared by all sessions.
+    """
+    from backends import get_secrets
+
+    return JobRunner(JobStore(directory), max_workers=get_secrets().get("ingest_max_workers", 4))
@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+
+STATISTIC_COLUMNS = ['MEAN', 'STD', 'CV', 'MEDIAN', 'MAD', 'N_REPLICATES', 'N_OUTLIERS']
+
+def replicate_matrix(data, columns=None):
+    """
+    Packs the replicate columns of a results frame into one float matrix and a validity mask.
+
+    Blank or non-numeric cells (e.g. " " in a CSV read as text), missing values and nullable
+    integer blanks all become invalid entries.
+
+    Parameters:
+    ----------
+    data : DataFrame
+        A frame with the replicate columns, e.g. from `SnowflakeHandler.fetch_full_data`.
+    columns : list of str, optional
+        The replicate columns. Defaults to the columns starting with 'RESULT_'.
+
+    Returns:
+    -------
+    values : ndarray
+        A C-contiguous (rows x replicates) float64 array, NaN where the replicate is invalid.
+    mask : ndarray
+        A boolean array of the same shape, True where the replicate is valid.
+    """
+    columns = columns if columns is not None else [col for col in data.columns if col.startswith('RESULT_')]
+    values = np.empty((len(data), len(columns)), dtype='float64')
+    for position, column in enumerate(columns):
+        series = data[column]
+        if not pd.api.types.is_numeric_dtype(series.dtype):
+            series = pd.to_numeric(series, errors='coerce')
+        values[:, position] = series.to_numpy(dtype='float64', na_value=np.nan)
+    return values, ~np.isnan(values)
+
+
+class ReplicateStatistics:
+    """
+    Computes the per-well replicate statistics and outlier flags of a results table in one vectorized pass.
+
+    Outliers are the replicates whose modified z-score, |x - median| / (1.4826 * MAD), exceeds
+    `threshold`. When more than half the replicates of a well are equal the MAD is 0, and the
+    mean absolute deviation (scaled by 1.2533) is used instead. Wells with fewer than
+    `min_replicates` valid replicates get no outlier flags.
+
+    Attributes:
+    ----------
+    threshold : float
+        The modified z-score above which a replicate is an outlier.
+    min_replicates : int
+        The number of valid replicates a well needs for outliers to be flagged.
+    exclude_outliers : bool
+        Whether MEAN, STD and CV are computed without the flagged replicates.
+    chunk_size : int
+        The number of wells processed at a time, which bounds the size of the temporary arrays.
+    """
+
+    def __init__(self, threshold=3.5, min_replicates=3, exclude_outliers=False, chunk_size=65_536):
+        self.threshold = threshold
+        self.min_replicates = min_replicates
+        self.exclude_outliers = exclude_outliers
+        self.chunk_size = chunk_size
+
+    def add_columns(self, data, columns=None):
+        """
+        Adds the replicate statistics to a results frame.
+
+        Parameters:
+        ----------
+        data : DataFrame
+            A frame with the replicate columns. It is modified in place.
+        columns : list of str, optional
+            The replicate columns. Defaults to the columns starting with 'RESULT_'.
+
+        Returns:
+        -------
+        data : DataFrame
+            The frame with added 'MEAN', 'STD', 'CV' (in percent), 'MEDIAN' and 'MAD' columns,
+            rounded to 2 decimals, and 'N_REPLICATES' and 'N_OUTLIERS' counts.
+        """
+        statistics = self.compute(*replicate_matrix(data, columns))
+        for column in STATISTIC_COLUMNS:
+            values = statistics[column]
+            data[column] = values if column.startswith('N_') else np.round(values, 2)
+        return data
+
+    def compute(self, values, mask):
+        """
+        Computes the statistics of every well, `chunk_size` wells at a time.
+
+        Parameters:
+        ----------
+        values : ndarray
+            A (wells x replicates) float64 array, NaN where the replicate is invalid, as returned by `replicate_matrix`.
+        mask : ndarray
+            A boolean array of the same shape, True where the replicate is valid.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping each of `STATISTIC_COLUMNS` to an array with one value per well,
+            and 'OUTLIERS' to a boolean (wells x replicates) array flagging the outliers.
+        """
+        statistics = {column: np.empty(len(values)) for column in STATISTIC_COLUMNS[:5]}
+        statistics.update(
+            N_REPLICATES=np.empty(len(values), dtype='int64'),
+            N_OUTLIERS=np.empty(len(values), dtype='int64'),
+            OUTLIERS=np.empty(values.shape, dtype=bool),
+        )
+        for start in range(0, len(values), self.chunk_size):
+            rows = slice(start, start + self.chunk_size)
+            for column, chunk in self._compute_chunk(values[rows], mask[rows]).items():
+                statistics[column][rows] = chunk
+        return statistics
+
+    def _compute_chunk(self, values, mask):
+        # invalid replicates are NaN in `values`, so they sort last and never compare as outliers
+        count = mask.sum(axis=1)
+        median = _median(values, count)
+        deviation = values - median[:, None]
+        np.abs(deviation, out=deviation)
+        mad = _median(deviation, count)
+
+        scale = 1.4826 * mad
+        constant = mad == 0
+        if constant.any():
+            with np.errstate(invalid='ignore'):
+                scale[constant] = 1.2533 * np.nanmean(deviation[constant], axis=1)
+        scale[count < self.min_replicates] = np.inf
+        # when the scale is 0 every deviation is 0 too, and no replicate is an outlier
+        with np.errstate(invalid='ignore'):
+            outliers = deviation > self.threshold * scale[:, None]
+
+        kept = mask & ~outliers if self.exclude_outliers else mask
+        n = kept.sum(axis=1)
+        filled = np.where(kept, values, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = filled.sum(axis=1) / n
+            centered = filled - mean[:, None]
+            centered *= kept
+            np.square(centered, out=centered)
+            std = np.sqrt(centered.sum(axis=1) / (n - 1))
+            std[n < 2] = np.nan
+            cv = std / np.abs(mean) * 100
+            cv[mean == 0] = np.nan
+        return {
+            'MEAN': mean, 'STD': std, 'CV': cv, 'MEDIAN': median, 'MAD': mad,
+            'N_REPLICATES': count, 'N_OUTLIERS': outliers.sum(axis=1), 'OUTLIERS': outliers,
+        }
+
+
+def _median(values, count):
+    """
+    Computes the median of the first `count` entries of every row once sorted, NaN last; NaN for empty rows.
+    """
+    ordered = np.sort(values, axis=1)
+    rows = np.arange(len(values))
+    lower = np.clip((count - 1) // 2, 0, None)
+    upper = np.clip(count // 2, 0, values.shape[1] - 1)
+    median = (ordered[rows, lower] + ordered[rows, upper]) / 2
+    median[count == 0] = np.nan
+    return median
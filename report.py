@@ -0,0 +1,306 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import re
+import threading
+import uuid
+
+class ReportBuilder:
+    """
+    Renders the plots and analysis tables of an experiment into one PDF report.
+
+    The report has one page per (filter value x treatment time) figure of `DataHandler.create_plots`,
+    followed by the curve fits and the analysis table. Pages are rendered to PDF by Kaleido on a
+    process pool, with at most `window` pages in flight, and appended to the document in order as
+    they finish, so only a few figures are held in memory at a time.
+
+    Rendered pages and finished reports are kept on disk per data version, the least recently
+    used files evicted above `max_disk_bytes`. Building the same report again only reads the
+    cached file, and a report that differs in its axes or filter reuses the cached table pages.
+
+    Attributes:
+    ----------
+    data_handler : DataHandler
+        The handler the figures are created with.
+    directory : Path
+        The directory holding the cached pages and reports.
+    max_workers : int or None
+        The number of rendering processes; None uses one per CPU.
+    window : int
+        The maximum number of pages rendered at once.
+    table_rows_per_page : int
+        The number of table rows per page.
+    page_size : tuple of int
+        The width and height of a page, in pixels.
+    max_disk_bytes : int
+        The maximum total size of the cached files.
+    hits : int
+        The number of reports served from the cache.
+    misses : int
+        The number of reports built.
+    """
+
+    def __init__(self, data_handler, directory, max_workers=None, window=8, table_rows_per_page=30,
+                 page_size=(1100, 780), max_disk_bytes=512 * 1024 ** 2):
+        """
+        Initializes the builder.
+
+        Parameters:
+        ----------
+        data_handler : DataHandler
+            The handler the figures are created with.
+        directory : str or Path
+            The directory holding the cached pages and reports. It is created if it does not exist.
+        max_workers : int or None
+            The number of rendering processes.
+        window : int
+            The maximum number of pages rendered at once.
+        table_rows_per_page : int
+            The number of table rows per page.
+        page_size : tuple of int
+            The width and height of a page, in pixels.
+        max_disk_bytes : int
+            The maximum total size of the cached files.
+        """
+        self.data_handler = data_handler
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_workers = max_workers
+        self.window = window
+        self.table_rows_per_page = table_rows_per_page
+        self.page_size = page_size
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # data-version directories with a build in progress, which eviction leaves alone
+        self._building = {}
+
+    def build(self, user_result, data_version, filter_type, x_axis, y_axis, fits=None, progress=None):
+        """
+        Builds the report of an experiment, or returns it from the cache.
+
+        Parameters:
+        ----------
+        user_result : DataFrame
+            The analysis of the experiment, e.g. returned by `DataHandler.slice_experiment`.
+        data_version : str
+            Identifies the data in `user_result` (and `fits`); pages are cached per data version.
+        filter_type : str
+            "Drugs" for one set of figures per drug, or "Cell Lines" for one per cell line.
+        x_axis, y_axis : str
+            The columns plotted.
+        fits : DataFrame, optional
+            The curve fits returned by `DataHandler.fit_dose_response`, drawn and listed in the report.
+        progress : callable, optional
+            Called with the number of pages done and the total number of pages.
+
+        Returns:
+        -------
+        Path
+            The path of the PDF file.
+        """
+        version_directory = self.directory / _safe_name(data_version)
+        # the directory, and the cached pages it yields before appending them, must not be evicted
+        # by another build until this one is done
+        with self._lock:
+            self._building[version_directory] = self._building.get(version_directory, 0) + 1
+        try:
+            report_path, built = self._build(user_result, version_directory, filter_type, x_axis, y_axis, fits, progress)
+        finally:
+            with self._lock:
+                self._building[version_directory] -= 1
+                if not self._building[version_directory]:
+                    del self._building[version_directory]
+        if built:
+            self._evict_disk()
+        return report_path
+
+    def _build(self, user_result, version_directory, filter_type, x_axis, y_axis, fits, progress):
+        """
+        Builds a report in its data-version directory, or finds it there.
+        Returns the path of the PDF file and whether it was built.
+        """
+        import plotly.io as pio
+        from pypdf import PdfWriter
+
+        version_directory.mkdir(parents=True, exist_ok=True)
+        report_key = _digest("report", filter_type, x_axis, y_axis, fits is not None)
+        report_path = version_directory / f"report-{report_key}.pdf"
+        if report_path.exists():
+            os.utime(report_path)
+            with self._lock:
+                self.hits += 1
+            return report_path, False
+
+        pages = self._pages(user_result, version_directory, filter_type, x_axis, y_axis, fits)
+        total = len(user_result[self._filter_column(filter_type)].unique()) * len(user_result['TREATMENT_TIME'].unique())
+        total += self._table_pages(user_result) + (self._table_pages(fits) if fits is not None else 0)
+
+        writer = PdfWriter()
+        done = 0
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = deque()
+            for path, figure in pages:
+                future = None
+                if figure is not None:
+                    future = executor.submit(render_page, pio.to_json(figure, validate=False), str(path), *self.page_size)
+                in_flight.append((path, future))
+                while len(in_flight) >= self.window:
+                    done = self._append(writer, *in_flight.popleft(), done, total, progress)
+            while in_flight:
+                done = self._append(writer, *in_flight.popleft(), done, total, progress)
+
+        temporary_path = report_path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        with open(temporary_path, "wb") as file:
+            writer.write(file)
+        writer.close()
+        os.replace(temporary_path, report_path)
+        with self._lock:
+            self.misses += 1
+        return report_path, True
+
+    def stats(self):
+        """
+        Returns the report cache counters: hits, misses and disk bytes.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_bytes": sum(path.stat().st_size for path in self.directory.glob("*/*.pdf")),
+        }
+
+    def _pages(self, user_result, version_directory, filter_type, x_axis, y_axis, fits):
+        """
+        Yields the pages of a report in order, as (path, figure) pairs with figure None for cached pages.
+        Figures of one filter value are created together, and only if one of their pages is missing.
+        """
+        treatment_times = sorted(user_result['TREATMENT_TIME'].unique())
+        for value in sorted(user_result[self._filter_column(filter_type)].unique()):
+            paths = [
+                version_directory / f"plot-{_digest(filter_type, value, time, x_axis, y_axis, fits is not None)}.pdf"
+                for time in treatment_times
+            ]
+            if all(path.exists() for path in paths):
+                yield from ((path, None) for path in paths)
+                continue
+            figures = self.data_handler.create_plots(
+                user_result, filter_type, value, x_axis, y_axis, treatment_times, fits=fits, template="plotly"
+            )
+            yield from zip(paths, figures)
+
+        tables = [("Dose-response fits", fits)] if fits is not None else []
+        tables.append(("Analysis results", user_result))
+        for title, table in tables:
+            for number, start in enumerate(range(0, len(table), self.table_rows_per_page)):
+                path = version_directory / f"table-{_digest(title, number, self.table_rows_per_page)}.pdf"
+                if path.exists():
+                    yield path, None
+                else:
+                    yield path, self._table_figure(table.iloc[start:start + self.table_rows_per_page], f"{title} ({number + 1})")
+
+    def _table_figure(self, rows, title):
+        """
+        Lays out a slice of a table as a Plotly table figure, with numbers rounded to 3 significant digits.
+        """
+        cells = [
+            [f"{value:.3g}" if isinstance(value, float) else str(value) for value in rows[column].tolist()]
+            for column in rows.columns
+        ]
+        # a plain dictionary; it is validated when the worker loads it, not in the Streamlit process
+        return {
+            "data": [{
+                "type": "table",
+                "header": {"values": [column.replace("_", " ") for column in rows.columns], "font": {"size": 9}},
+                "cells": {"values": cells, "font": {"size": 8}, "height": 20},
+            }],
+            "layout": {"title": {"text": title}, "margin": {"l": 20, "r": 20, "t": 50, "b": 20}},
+        }
+
+    def _table_pages(self, table):
+        return -(-len(table) // self.table_rows_per_page)
+
+    def _filter_column(self, filter_type):
+        return 'DRUG_NAME' if filter_type == "Drugs" else 'CELL_LINE_NAME'
+
+    def _append(self, writer, path, future, done, total, progress):
+        """
+        Waits for a page to be rendered and appends it to the document.
+        """
+        if future is not None:
+            future.result()
+        writer.append(str(path))
+        os.utime(path)
+        done += 1
+        if progress:
+            progress(done, total)
+        return done
+
+    def _evict_disk(self):
+        """
+        Deletes the least recently used files above `max_disk_bytes`, except in directories being built.
+        """
+        # under the lock, so no build starts in a directory while it is being removed
+        with self._lock:
+            files = sorted(self.directory.glob("*/*.pdf"), key=lambda path: path.stat().st_mtime)
+            total = sum(path.stat().st_size for path in files)
+            for path in files:
+                if total <= self.max_disk_bytes:
+                    break
+                if path.parent in self._building:
+                    continue
+                total -= path.stat().st_size
+                path.unlink(missing_ok=True)
+            for directory in self.directory.iterdir():
+                if directory.is_dir() and directory not in self._building and not any(directory.iterdir()):
+                    directory.rmdir()
+
+
+def render_page(figure_json, path, width, height):
+    """
+    Renders a figure to a one-page PDF with Kaleido. Runs in a worker process of `ReportBuilder`.
+
+    Parameters:
+    ----------
+    figure_json : str
+        The figure, serialized with `Figure.to_json`.
+    path : str
+        The file to write; it is written atomically.
+    width, height : int
+        The size of the page, in pixels.
+
+    Returns:
+    -------
+    str
+        The path of the rendered page.
+    """
+    import plotly.io as pio
+
+    temporary_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    pio.from_json(figure_json).update_layout(template="plotly").write_image(temporary_path, format="pdf", width=width, height=height)
+    os.replace(temporary_path, path)
+    return path
+
+
+def create_report_builder(data_handler, directory=".cache/reports"):
+    """
+    Creates a report builder configured from secrets (`report_max_workers`, default one per CPU).
+
+    Returns:
+    -------
+    ReportBuilder
+        The builder, meant to be created once per process and shared by all sessions.
+    """
+    from backends import get_secrets
+
+    return ReportBuilder(data_handler, directory, max_workers=get_secrets().get("report_max_workers"))
+
+
+def _digest(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+
+def _safe_name(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(name))
@@ -0,0 +1,219 @@
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import threading
+import time
+import uuid
+import pandas as pd
+
+class ResultCache:
+    """
+    A two-tier cache for query results, keyed by user ID, data version and query name.
+
+    The first tier is an in-memory LRU of DataFrames, the second one Parquet files on disk,
+    bounded in total size with the least recently used files evicted first. Entries of both
+    tiers expire after `ttl` seconds. Every user has a data version that changes when their
+    data changes (see `invalidate`), so stale results are never returned.
+
+    Attributes:
+    ----------
+    directory : Path
+        The directory holding the Parquet files and the version map.
+    max_memory_entries : int
+        The maximum number of DataFrames kept in memory.
+    max_disk_bytes : int
+        The maximum total size of the Parquet files.
+    ttl : float
+        The number of seconds after which an entry expires.
+    hits : int
+        The number of lookups served from memory or disk.
+    misses : int
+        The number of lookups that found nothing.
+    """
+
+    def __init__(self, directory, max_memory_entries=32, max_disk_bytes=1024 ** 3, ttl=7 * 24 * 3600):
+        """
+        Initializes the cache and loads the version map from disk.
+
+        Parameters:
+        ----------
+        directory : str or Path
+            The directory holding the Parquet files. It is created if it does not exist.
+        max_memory_entries : int
+            The maximum number of DataFrames kept in memory.
+        max_disk_bytes : int
+            The maximum total size of the Parquet files.
+        ttl : float
+            The number of seconds after which an entry expires.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._versions_file = self.directory / "versions.json"
+        self._versions = json.loads(self._versions_file.read_text()) if self._versions_file.exists() else {}
+
+    def version(self, user_id):
+        """
+        Returns the current data version of a user.
+        """
+        with self._lock:
+            if user_id not in self._versions:
+                self._set_version(user_id)
+            return self._versions[user_id]
+
+    def get(self, user_id, name):
+        """
+        Looks up a result in memory, then on disk.
+
+        Parameters:
+        ----------
+        user_id : str
+            The user the result belongs to.
+        name : str
+            The name of the query, e.g. the view name and projected columns.
+
+        Returns:
+        -------
+        pd.DataFrame or None
+            The cached result, or None if it is missing or expired.
+        """
+        with self._lock:
+            key = (user_id, self.version(user_id), name)
+            entry = self._memory.get(key)
+            if entry is not None and time.time() - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            path = self._path(*key)
+            if path.exists() and time.time() - path.stat().st_mtime <= self.ttl:
+                data = pd.read_parquet(path)
+                os.utime(path, (time.time(), path.stat().st_mtime))
+                self._remember(key, data, path.stat().st_mtime)
+                self.hits += 1
+                return data
+
+            self.misses += 1
+            return None
+
+    def put(self, user_id, name, data):
+        """
+        Stores a result in memory and on disk.
+
+        Parameters:
+        ----------
+        user_id : str
+            The user the result belongs to.
+        name : str
+            The name of the query, e.g. the view name and projected columns.
+        data : pd.DataFrame
+            The result to store.
+        """
+        with self._lock:
+            key = (user_id, self.version(user_id), name)
+            self._remember(key, data, time.time())
+
+            path = self._path(*key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = path.with_suffix(".tmp")
+            data.to_parquet(temporary_path, index=False)
+            os.replace(temporary_path, path)
+            self._evict_disk()
+
+    def has_results(self, user_id):
+        """
+        Checks whether any result of the user's current data version is cached.
+
+        Parameters:
+        ----------
+        user_id : str
+            The user to check.
+
+        Returns:
+        -------
+        bool
+            True if a cached, unexpired result exists in memory or on disk.
+        """
+        with self._lock:
+            version = self.version(user_id)
+            now = time.time()
+            if any(key[:2] == (user_id, version) and now - entry[1] <= self.ttl for key, entry in self._memory.items()):
+                return True
+            return any(
+                now - path.stat().st_mtime <= self.ttl
+                for path in (self.directory / _safe_name(user_id) / version).glob("*.parquet")
+            )
+
+    def invalidate(self, user_id):
+        """
+        Moves a user to a new data version and drops all their cached results.
+        Call it whenever the user's data is uploaded or merged. Merges also change the results
+        of other users that share a renamed cell line or drug, or a re-uploaded experiment;
+        `run_merge_pipeline` of the warehouse handlers invalidates those users.
+
+        Parameters:
+        ----------
+        user_id : str
+            The user whose data changed.
+        """
+        with self._lock:
+            self._set_version(user_id)
+            for key in [key for key in self._memory if key[0] == user_id]:
+                del self._memory[key]
+            shutil.rmtree(self.directory / _safe_name(user_id), ignore_errors=True)
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+        -------
+        dict
+            The hits, misses, memory entries and disk bytes.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_bytes": sum(path.stat().st_size for path in self.directory.glob("*/*/*.parquet")),
+            }
+
+    def _path(self, user_id, version, name):
+        return self.directory / _safe_name(user_id) / version / f"{_safe_name(name)}.parquet"
+
+    def _remember(self, key, data, stored_at):
+        self._memory[key] = (data, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        now = time.time()
+        files = sorted(self.directory.glob("*/*/*.parquet"), key=lambda path: path.stat().st_atime)
+        total = sum(path.stat().st_size for path in files)
+        for path in files:
+            expired = now - path.stat().st_mtime > self.ttl
+            if total <= self.max_disk_bytes and not expired:
+                continue
+            total -= path.stat().st_size
+            path.unlink()
+
+    def _set_version(self, user_id):
+        self._versions[user_id] = uuid.uuid4().hex[:12]
+        temporary_file = self._versions_file.with_suffix(".tmp")
+        temporary_file.write_text(json.dumps(self._versions))
+        os.replace(temporary_file, self._versions_file)
+
+
+def _safe_name(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(name))
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CATEGORY_COLUMNS = ["USER_ID", "CELL_LINE_NAME", "DRUG_NAME"]
+INTEGER_COLUMNS = ["EXPERIMENT_ID", "EXPERIMENT_NUMBER", "TREATMENT_TIME", "DRUG_CONCENTRATION"]
+RESULT_COLUMNS = [f"RESULT_{i:03d}" for i in range(1, 13)]
+INTEGER_TYPES = [np.int8, np.int16, np.int32, np.int64]
+PARQUET_MAGIC = b"PAR1"
+
+def apply_schema(data):
+    """
+    Converts a fetched results frame to compact types.
+
+    Names become categoricals, and integer columns (IDs, times, concentrations and the twelve
+    replicates) the narrowest integer type holding their values. Columns with blanks, such as
+    missing replicates, get the matching nullable type (e.g. Int16). Values are unchanged, so
+    analyses give the same results; columns that are not integral are left as they are.
+
+    Parameters:
+    ----------
+    data : DataFrame
+        A frame with columns of the combined_results view, e.g. from `fetch_full_data`.
+
+    Returns:
+    -------
+    DataFrame
+        A typed copy of the frame.
+    """
+    data = data.copy()
+    for column in data.columns:
+        if column.upper() in CATEGORY_COLUMNS:
+            data[column] = data[column].astype("category")
+        elif column.upper() in INTEGER_COLUMNS or column.upper() in RESULT_COLUMNS:
+            data[column] = narrow_integer(data[column])
+    return data
+
+
+def narrow_integer(values):
+    """
+    Casts a column to the narrowest integer type holding its values.
+
+    Parameters:
+    ----------
+    values : Series
+        The column to cast.
+
+    Returns:
+    -------
+    Series
+        The cast column: a numpy integer type, a nullable integer type if the column has blanks,
+        or the numeric column unchanged if it has non-integral values.
+    """
+    numbers = pd.to_numeric(values, errors="coerce")
+    present = numbers.dropna()
+    if len(present) and not (present == np.floor(present)).all():
+        return numbers
+
+    low, high = (present.min(), present.max()) if len(present) else (0, 0)
+    dtype = next(dtype for dtype in INTEGER_TYPES if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+    if len(present) < len(numbers):
+        return numbers.astype(f"Int{np.iinfo(dtype).bits}")
+    return numbers.astype(dtype)
+
+
+def memory_usage(data):
+    """
+    Returns the memory held by a frame, including the contents of object columns.
+
+    Parameters:
+    ----------
+    data : DataFrame
+        The frame to measure.
+
+    Returns:
+    -------
+    int
+        The size in bytes.
+    """
+    return int(data.memory_usage(deep=True).sum())
+
+
+def staging_schema(columns, integer_columns):
+    """
+    Builds the Arrow schema of a staging file, matching the types of its stg_* table.
+
+    Parameters:
+    ----------
+    columns : list of str
+        The columns of the file, in order, without 'user_id' and 'load_id'.
+    integer_columns : list of str
+        The columns stored as integers; all other columns are strings.
+
+    Returns:
+    -------
+    pa.Schema
+        The schema, with the 'user_id' and 'load_id' string columns appended.
+    """
+    return pa.schema(
+        [(column, pa.int64() if column in integer_columns else pa.string()) for column in columns]
+        + [("user_id", pa.string()), ("load_id", pa.string())]
+    )
+
+
+def is_parquet(source):
+    """
+    Checks whether a binary file object holds Parquet data, leaving it at its start.
+    """
+    source.seek(0)
+    magic = source.read(len(PARQUET_MAGIC))
+    source.seek(0)
+    return magic == PARQUET_MAGIC
+
+
+def read_staging_chunks(source, chunk_size):
+    """
+    Reads a validated staging file, CSV or Parquet, in chunks.
+
+    Parameters:
+    ----------
+    source : file-like
+        A binary file object written by `DataHandler.stream_validate_file`.
+    chunk_size : int
+        The number of rows per chunk.
+
+    Yields:
+    ------
+    DataFrame
+        A chunk with integer columns as Int64 and 'user_id' and 'load_id' as strings.
+    """
+    if is_parquet(source):
+        integer_types = {pa.int64(): pd.Int64Dtype()}
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas(types_mapper=integer_types.get)
+        return
+
+    yield from pd.read_csv(
+        source, chunksize=chunk_size, dtype={"user_id": str, "load_id": str},
+        keep_default_na=False, na_values=[""],
+    )
@@ -0,0 +1,115 @@
+"""
+SQL for computing the survival analysis in the warehouse.
+
+The query is generated from one definition so the same SQL runs on Snowflake and on the
+embedded SQLite engine of `LocalWarehouseHandler`. It mirrors
+`DataHandler.analyze_experiment_data` followed by `DataHandler.calculate_survival`:
+per-well MEAN and STD over the non-blank replicates (rounded to 2 decimals), control
+means per (experiment, drug, cell line) over wells with no treatment time and no drug,
+and SURVIVAL_RATE as MEAN / MEAN_CONTROL * 100 (0 when the control mean is 0).
+Values are rounded half to even, as pandas does.
+"""
+
+RESULT_COLUMNS = [f"RESULT_{i:03d}" for i in range(1, 13)]
+KEY_COLUMNS = [
+    "EXPERIMENT_ID",
+    "EXPERIMENT_NUMBER",
+    "USER_ID",
+    "CELL_LINE_NAME",
+    "DRUG_NAME",
+    "TREATMENT_TIME",
+    "DRUG_CONCENTRATION",
+]
+AGGREGATE_COLUMNS = ["MEAN", "STD", "MEAN_CONTROL", "SURVIVAL_RATE"]
+
+
+def round_half_even(expression, decimals=2):
+    """
+    Builds a SQL expression rounding half to even, like `pandas.Series.round`.
+
+    Parameters:
+    ----------
+    expression : str
+        The SQL expression to round.
+    decimals : int
+        The number of decimals to keep.
+
+    Returns:
+    -------
+    str
+        The rounding expression.
+    """
+    scale = 10 ** decimals
+    scaled = f"({expression}) * {scale}"
+    return (
+        f"CASE WHEN {scaled} - FLOOR({scaled}) = 0.5 "
+        f"THEN (FLOOR({scaled}) + FLOOR({scaled}) % 2) / {scale}.0 "
+        f"ELSE ROUND({expression}, {decimals}) END"
+    )
+
+
+def survival_query(view_name="combined_results", placeholder="%s", include_replicates=False):
+    """
+    Builds the survival query for one user and one experiment.
+
+    Parameters:
+    ----------
+    view_name : str
+        The view with the combined results.
+    placeholder : str
+        The parameter placeholder of the database driver ("%s" for Snowflake, "?" for SQLite).
+    include_replicates : bool
+        Whether to return the twelve RESULT columns along with the aggregates.
+
+    Returns:
+    -------
+    str
+        The query. It takes two parameters: the user ID and the experiment number.
+    """
+    count = " + ".join(f"CASE WHEN {column} IS NULL THEN 0 ELSE 1 END" for column in RESULT_COLUMNS)
+    total = " + ".join(f"COALESCE({column}, 0)" for column in RESULT_COLUMNS)
+    squares = " + ".join(f"COALESCE({column}, 0) * COALESCE({column}, 0)" for column in RESULT_COLUMNS)
+    columns = KEY_COLUMNS + (RESULT_COLUMNS if include_replicates else [])
+    output = ",\n    ".join(f"w.{column} AS {column}" for column in columns)
+
+    return f"""
+WITH wells AS (
+    SELECT DISTINCT *
+    FROM {view_name}
+    WHERE USER_ID = {placeholder} AND EXPERIMENT_NUMBER = {placeholder}
+),
+sums AS (
+    SELECT wells.*, ({count}) AS N, ({total}) * 1.0 AS S1, ({squares}) * 1.0 AS S2
+    FROM wells
+),
+variances AS (
+    SELECT sums.*,
+        S1 / NULLIF(N, 0) AS RAW_MEAN,
+        (S2 - S1 * S1 / NULLIF(N, 0)) / NULLIF(N - 1, 0) AS RAW_VARIANCE
+    FROM sums
+),
+stats AS (
+    SELECT variances.*,
+        {round_half_even("RAW_MEAN")} AS MEAN,
+        {round_half_even("SQRT(CASE WHEN RAW_VARIANCE < 0 THEN 0 ELSE RAW_VARIANCE END)")} AS STD
+    FROM variances
+),
+controls AS (
+    SELECT EXPERIMENT_NUMBER, DRUG_NAME, CELL_LINE_NAME, AVG(MEAN) AS MEAN_CONTROL
+    FROM stats
+    WHERE TREATMENT_TIME = 0 AND DRUG_CONCENTRATION = 0
+    GROUP BY EXPERIMENT_NUMBER, DRUG_NAME, CELL_LINE_NAME
+)
+SELECT
+    {output},
+    w.MEAN AS MEAN,
+    w.STD AS STD,
+    c.MEAN_CONTROL AS MEAN_CONTROL,
+    CASE WHEN c.MEAN_CONTROL = 0 THEN 0 ELSE {round_half_even("w.MEAN / c.MEAN_CONTROL * 100")} END AS SURVIVAL_RATE
+FROM stats w
+JOIN controls c
+    ON w.EXPERIMENT_NUMBER = c.EXPERIMENT_NUMBER
+    AND w.DRUG_NAME = c.DRUG_NAME
+    AND w.CELL_LINE_NAME = c.CELL_LINE_NAME
+ORDER BY w.EXPERIMENT_ID
+"""
@@ -0,0 +1,648 @@
+import math
+from pathlib import Path
+import re
+import sqlite3
+import threading
+import time
+import pandas as pd
+from backends import get_secrets
+from .aggregation import survival_query
+from .snow_handler import affected_users_query, build_select
+from schema import apply_schema, memory_usage, read_staging_chunks
+from tracing import Tracer, traced
+
+SQL_DEFINITIONS = Path(__file__).resolve().parent.parent / "snowflake_logic.sql"
+
+class LocalDatabase:
+    """
+    An embedded SQLite warehouse with the tables, views and merges of `snowflake_logic.sql`.
+
+    One database is shared by all handlers of a process (see `create_local_database`); handlers
+    hold `lock` while they use the connection, so the transactions of different threads do not mix.
+
+    Attributes:
+    ----------
+    conn : sqlite3.Connection
+        The SQLite connection.
+    lock : threading.RLock
+        Serializes the use of the connection.
+    merges : dict
+        A dictionary mapping merge procedure names to their (target, upsert query) pairs.
+    """
+
+    def __init__(self, path=":memory:"):
+        """
+        Opens the database and creates the tables and views.
+
+        Parameters:
+        ----------
+        path : str
+            The SQLite database path, or ":memory:" for an in-memory database.
+        """
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.create_function("SQRT", 1, lambda value: None if value is None else math.sqrt(value))
+        self.conn.create_function("FLOOR", 1, lambda value: None if value is None else math.floor(value))
+        for query in table_definitions() + view_definitions():
+            self.conn.execute(query)
+        self.conn.commit()
+        self.merges = merge_definitions()
+
+    def close(self):
+        """
+        Closes the SQLite connection.
+        """
+        with self.lock:
+            self.conn.close()
+
+
+class LocalWarehouseHandler:
+    """
+    An in-process stand-in for `SnowflakeHandler`, backed by SQLite.
+
+    The tables, the combined_results view and the three `merge_into_*` procedures are built from
+    the definitions in `snowflake_logic.sql`, so data can be loaded, merged and analyzed offline.
+    There are no pipes: files are always loaded straight into staging (`ingest_mode` "direct").
+    Selected with `warehouse_backend: local` in secrets (see `backends.create_warehouse_handler`),
+    it serves small datasets without a Snowflake account, and doubles as the warehouse of local
+    tests and benchmarks.
+
+    Attributes:
+    ----------
+    database : LocalDatabase
+        The database the handler queries.
+    conn : sqlite3.Connection
+        The SQLite connection of the database.
+    cache : ResultCache or None
+        A cache consulted by `fetch_full_data` before querying the database.
+    tracer : Tracer
+        Records a span per handler call.
+    staging_tables : dict
+        A dictionary mapping expected file names to staging table names.
+    """
+
+    def __init__(self, database=None, cache=None, tracer=None):
+        """
+        Initializes the handler and creates the tables if needed.
+
+        Parameters:
+        ----------
+        database : LocalDatabase or str, optional
+            A shared database, e.g. `get_backend("local_warehouse")`, or the path of a database
+            owned by the handler. Defaults to `local_warehouse_path` from secrets, or an in-memory database.
+        cache : ResultCache, optional
+            A cache consulted by `fetch_full_data` before querying the database.
+        tracer : Tracer, optional
+            Records a span per handler call.
+        """
+        secrets = get_secrets()
+        self._owns_database = not isinstance(database, LocalDatabase)
+        if self._owns_database:
+            database = LocalDatabase(database or secrets.get("local_warehouse_path", ":memory:"))
+        self.database = database
+        self.conn = database.conn
+        self.pool = None
+        self.cache = cache
+        self.tracer = tracer or Tracer()
+
+        self.staging_tables = {
+            "data_photodynamic_therapy_cell_lines.csv": "stg_cell_lines",
+            "data_photodynamic_therapy_drugs.csv": "stg_drugs",
+            "data_photodynamic_therapy_results.csv": "stg_results",
+        }
+        self.staging_format = secrets.get("staging_format", "csv")
+        self.ingest_mode = "direct"
+        self.merge_mode = secrets.get("merge_mode", "concurrent")
+        self.aggregation_mode = secrets.get("aggregation_mode", "local")
+        self.load_chunk_size = 500_000
+        self.staging_counts = {}
+
+    @traced
+    def truncate_staging_tables(self):
+        """
+        Truncates all staging tables before ingestion.
+        """
+        with self.database.lock, self.conn:
+            for table in self.staging_tables.values():
+                self.conn.execute(f"DELETE FROM {table}")
+
+    @traced
+    def clear_staging(self, load_ids):
+        """
+        Deletes the rows of the given loads from all staging tables, once they are merged.
+
+        Parameters:
+        ----------
+        load_ids : list of str
+            The load identifiers to delete.
+        """
+        if not load_ids:
+            # `_clear_staging` reads no load IDs as all of staging
+            return
+        with self.database.lock, self.conn:
+            self._clear_staging(load_ids)
+
+    @traced
+    def call_procedure(self, procedure_name, params=None):
+        """
+        Runs one of the merge procedures of `snowflake_logic.sql`, or `procedure_truncate`.
+
+        Parameters:
+        ----------
+        procedure_name : str
+            The call as for `SnowflakeHandler.call_procedure`, e.g. 'merge_into_dim_drugs(NULL)'.
+        params : tuple, optional
+            The load identifiers passed in the call's ARRAY_CONSTRUCT; all staging rows when omitted.
+        """
+        name = procedure_name.split("(")[0].strip()
+        load_ids = list(params) if params else None
+        with self.database.lock, self.conn:
+            if name == "procedure_truncate":
+                for procedure in self.database.merges:
+                    self._merge(procedure, load_ids)
+                self._clear_staging(load_ids)
+            else:
+                self._merge(name, load_ids)
+        self.tracer.current()["procedure"] = procedure_name
+
+    @traced
+    def fetch_affected_users(self, load_ids=None):
+        """
+        Returns the users whose combined results change when the given loads are merged
+        (see `affected_users_query`). Run it before the merge, while the loads are in staging.
+
+        Parameters:
+        ----------
+        load_ids : list of str, optional
+            The loads to be merged. Defaults to all staging rows.
+
+        Returns:
+        -------
+        set of str
+            The user IDs.
+        """
+        load_ids = list(load_ids or [])
+        with self.database.lock:
+            rows = self.conn.execute(affected_users_query(len(load_ids), placeholder="?"), tuple(load_ids) * 3)
+            users = {row[0] for row in rows.fetchall()}
+        self.tracer.current()["users"] = len(users)
+        return users
+
+    @traced
+    def run_merge_pipeline(self, load_ids=None, mode=None):
+        """
+        Merges the staging tables into the dimension and fact tables and times each step.
+
+        SQLite has a single writer, so in "concurrent" mode the merges run one after the
+        other, each in its own transaction, and the merged loads are then deleted from staging.
+        In "transaction" mode the merges and the deletion run in one transaction.
+
+        Parameters:
+        ----------
+        load_ids : list of str, optional
+            The loads to merge. Defaults to all staging rows.
+        mode : str, optional
+            "concurrent" or "transaction". Defaults to `merge_mode`.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping each step to its duration in seconds.
+        """
+        # other users' cached results go stale when the merge renames a cell line or drug they use
+        affected_users = self.fetch_affected_users(load_ids) if self.cache is not None else set()
+        timings = self._run_merges(load_ids, mode)
+        for user_id in affected_users:
+            self.cache.invalidate(user_id)
+        return timings
+
+    def _run_merges(self, load_ids, mode):
+        """
+        Runs the merge steps of `run_merge_pipeline` and returns their timings.
+        """
+        mode = mode or self.merge_mode
+        load_ids = sorted(set(load_ids)) if load_ids else None
+        self.tracer.current().update(mode=mode, loads=len(load_ids or []))
+        timings = {}
+        start = time.perf_counter()
+        with self.database.lock:
+            if mode == "transaction":
+                with self.conn:
+                    for procedure in self.database.merges:
+                        self._merge(procedure, load_ids)
+                    self._clear_staging(load_ids)
+                timings["procedure_truncate"] = time.perf_counter() - start
+                return timings
+
+            for procedure in self.database.merges:
+                step_start = time.perf_counter()
+                with self.conn:
+                    self._merge(procedure, load_ids)
+                timings[procedure] = time.perf_counter() - step_start
+            if load_ids:
+                clear_start = time.perf_counter()
+                with self.conn:
+                    self._clear_staging(load_ids)
+                timings["clear_staging"] = time.perf_counter() - clear_start
+        timings["total"] = time.perf_counter() - start
+        return timings
+
+    def refresh_snowpipe(self, pipe_name):
+        """
+        Does nothing: files are loaded straight into staging. Returns True.
+        """
+        return True
+
+    @traced
+    def load_staging_files(self, valid_files):
+        """
+        Bulk-loads validated files (CSV or Parquet) into the staging tables, in chunks of `load_chunk_size` rows.
+
+        Parameters:
+        ----------
+        valid_files : list
+            A list of tuples (file_name, file_object) as returned by `DataHandler.validate_user_data`.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping staging table names to the number of rows loaded.
+        """
+        loaded_rows = {}
+        with self.database.lock, self.conn:
+            for file_name, file_content in valid_files:
+                table = self.staging_tables[file_name]
+                loaded_rows[table] = 0
+                file_content.seek(0)
+                for chunk in read_staging_chunks(file_content, self.load_chunk_size):
+                    chunk.to_sql(table, self.conn, if_exists="append", index=False)
+                    loaded_rows[table] += len(chunk)
+        self.tracer.current()["rows"] = sum(loaded_rows.values())
+        return loaded_rows
+
+    @traced
+    def count_staging_rows(self, load_ids):
+        """
+        Counts the rows of the given loads in each staging table.
+
+        Parameters:
+        ----------
+        load_ids : list of str
+            The load identifiers to count rows for.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping staging table names to row counts.
+        """
+        if not load_ids:
+            return dict.fromkeys(self.staging_tables.values(), 0)
+        placeholders = ", ".join(["?"] * len(load_ids))
+        with self.database.lock:
+            return {
+                table: self.conn.execute(
+                    f"SELECT COUNT(*) FROM {table} WHERE load_id IN ({placeholders})", tuple(load_ids)
+                ).fetchone()[0]
+                for table in self.staging_tables.values()
+            }
+
+    @traced
+    def wait_for_staging(self, expected_rows, load_ids, timeout=None, progress=None):
+        """
+        Checks that the staging tables hold the expected rows.
+        Files are loaded synchronously, so the rows are counted once instead of polled.
+
+        Parameters:
+        ----------
+        expected_rows : dict
+            A dictionary mapping uploaded file names to their number of data rows.
+        load_ids : list of str
+            The load identifiers of the uploaded files.
+        timeout : float, optional
+            Ignored; kept for compatibility with `SnowflakeHandler.wait_for_staging`.
+        progress : callable, optional
+            Called with the staging row counts.
+
+        Returns:
+        -------
+        bool
+            True if every staging table holds the expected rows.
+        """
+        self.staging_counts = self.count_staging_rows(load_ids)
+        if progress:
+            progress(self.staging_counts)
+        missing = {
+            self.staging_tables[file_name]: f"{self.staging_counts[self.staging_tables[file_name]]}/{rows}"
+            for file_name, rows in expected_rows.items()
+            if self.staging_counts[self.staging_tables[file_name]] < rows
+        }
+        if missing:
+            print(f"Missing rows in the local warehouse staging tables: {missing}")
+        return not missing
+
+    @traced
+    def reset_pipeline(self, expected_rows=None, load_ids=None, progress=None):
+        """
+        Checks that the loaded files are in staging; there are no pipes to refresh.
+
+        Parameters:
+        ----------
+        expected_rows : dict, optional
+            A dictionary mapping file names to their number of data rows.
+        load_ids : list of str, optional
+            The load identifiers of the files.
+        progress : callable, optional
+            Called with the staging row counts (see `wait_for_staging`).
+
+        Returns:
+        -------
+        bool
+            True if the expected rows (if any) are in staging.
+        """
+        if expected_rows and load_ids:
+            return self.wait_for_staging(expected_rows, load_ids, progress=progress)
+        return True
+
+    def build_select(self, table_name, columns=None, filters=None, distinct=False):
+        """
+        Builds a parameterized SELECT query for SQLite (see `snow_handler.build_select`).
+        """
+        return build_select(table_name, columns, filters, distinct, placeholder="?")
+
+    @traced
+    def fetch_data(self, table_name, columns=None, filters=None):
+        """
+        Fetches data from a specified table.
+
+        Parameters:
+        ----------
+        table_name : str
+            The name of the table to fetch data from.
+        columns : list of str, optional
+            The columns to fetch. Defaults to all columns.
+        filters : dict, optional
+            A dictionary mapping column names to a value, or to a list of accepted values.
+
+        Returns:
+        -------
+        tuple
+            A tuple containing the list of column names and a DataFrame with the table's content.
+        """
+        try:
+            data = self._read(*self.build_select(table_name, columns, filters))
+            self.tracer.current().update(rows=len(data), bytes=int(data.memory_usage(deep=True).sum()))
+            return list(data.columns), data
+        except Exception as e:
+            print(f"Error fetching data from {table_name}: {e}")
+            return None
+
+    def iter_data(self, table_name, columns=None, filters=None, distinct=False):
+        """
+        Fetches data from a specified table batch by batch, holding the database lock until done.
+
+        Parameters:
+        ----------
+        table_name : str
+            The name of the table or view to fetch data from.
+        columns : list of str, optional
+            The columns to fetch. Defaults to all columns.
+        filters : dict, optional
+            A dictionary mapping column names to a value, or to a list of accepted values.
+        distinct : bool
+            Whether to fetch distinct rows only.
+
+        Yields:
+        ------
+        pd.DataFrame
+            One DataFrame per `load_chunk_size` rows.
+        """
+        query, params = self.build_select(table_name, columns, filters, distinct)
+        with self.database.lock:
+            for chunk in pd.read_sql(query, self.conn, params=params, chunksize=self.load_chunk_size):
+                chunk.columns = [column.upper() for column in chunk.columns]
+                yield chunk
+
+    @traced
+    def fetch_full_data(self, view_name, user_id, columns=None, filters=None):
+        """
+        Fetches user-specific distinct data from a view, converted to compact types
+        (see `schema.apply_schema`) and served from `cache`, when set, until the user's data changes.
+
+        Parameters:
+        ----------
+        view_name : str
+            The name of the view to query.
+        user_id : str or int
+            The user ID to filter data by.
+        columns : list of str, optional
+            The columns to fetch. Defaults to all columns.
+        filters : dict, optional
+            Additional filters, as a dictionary mapping column names to a value or a list of values.
+
+        Returns:
+        -------
+        pd.DataFrame or None
+            A DataFrame with the filtered data, or None if the query fails.
+        """
+        cache_name = f"{view_name}-{columns}-{sorted((filters or {}).items())}"
+        if self.cache is not None:
+            data = self.cache.get(user_id, cache_name)
+            self.tracer.current()["cache_hit"] = data is not None
+            if data is not None:
+                return data
+        try:
+            data = self._read(*self.build_select(
+                view_name, columns, {"USER_ID": user_id, **(filters or {})}, distinct=True
+            ))
+        except Exception as e:
+            print(f"Error fetching data from {view_name}: {e}")
+            return None
+        fetched_bytes = memory_usage(data)
+        data = apply_schema(data)
+        self.tracer.current().update(rows=len(data), fetched_bytes=fetched_bytes, bytes=memory_usage(data))
+        if self.cache is not None:
+            self.cache.put(user_id, cache_name, data)
+        return data
+
+    @traced
+    def fetch_experiment_survival(self, view_name, user_id, experiment_number, include_replicates=False):
+        """
+        Computes the survival analysis of one experiment with the warehouse SQL.
+
+        Parameters:
+        ----------
+        view_name : str
+            The name of the view with the combined results.
+        user_id : str
+            The user ID to filter data by.
+        experiment_number : int
+            The number of the experiment to analyze.
+        include_replicates : bool
+            Whether to return the twelve RESULT columns along with the aggregates.
+
+        Returns:
+        -------
+        pd.DataFrame or None
+            A DataFrame with the columns of `DataHandler.calculate_survival`, or None if the query fails.
+        """
+        try:
+            query = survival_query(view_name, placeholder="?", include_replicates=include_replicates)
+            data = self._read(query, (user_id, int(experiment_number)))
+            self.tracer.current()["rows"] = len(data)
+            return apply_schema(data)
+        except Exception as e:
+            print(f"Error computing survival from {view_name}: {e}")
+            return None
+
+    def close_connection(self):
+        """
+        Closes the database if the handler opened it. A shared database stays open and the
+        handler can be used again, as a `SnowflakeHandler` borrows a new pooled connection.
+        """
+        if self._owns_database and self.database is not None:
+            self.database.close()
+            self.database = None
+
+    def _read(self, query, params):
+        """
+        Runs a query and returns its rows with upper-case column names, as Snowflake does.
+        """
+        with self.database.lock:
+            data = pd.read_sql(query, self.conn, params=params)
+        data.columns = [column.upper() for column in data.columns]
+        return data
+
+    def _merge(self, procedure, load_ids):
+        """
+        Runs one merge procedure; the caller holds the lock and commits.
+        """
+        target, query = self.database.merges[procedure]
+        condition, params = _load_condition(load_ids)
+        cursor = self.conn.execute(query.format(condition=condition), params)
+        self.tracer.current()[target] = cursor.rowcount
+
+    def _clear_staging(self, load_ids):
+        """
+        Deletes the given loads (all rows when None) from staging; the caller holds the lock and commits.
+        """
+        condition, params = _load_condition(load_ids)
+        for table in self.staging_tables.values():
+            self.conn.execute(f"DELETE FROM {table} WHERE {condition}", params)
+
+
+def create_local_database():
+    """
+    Opens the local warehouse at `local_warehouse_path` from secrets (default in-memory).
+
+    Returns:
+    -------
+    LocalDatabase
+        The database, meant to be created once per process and shared by all handlers.
+    """
+    return LocalDatabase(get_secrets().get("local_warehouse_path", ":memory:"))
+
+
+def table_definitions(path=SQL_DEFINITIONS):
+    """
+    Translates the CREATE TABLE statements of `snowflake_logic.sql` to SQLite.
+
+    Snowflake does not enforce PRIMARY KEY and UNIQUE constraints, so they are dropped,
+    except for the primary keys of the dimension and fact tables, which the merges rely on.
+
+    Parameters:
+    ----------
+    path : Path
+        The path to the SQL definitions.
+
+    Returns:
+    -------
+    list of str
+        The CREATE TABLE statements.
+    """
+    statements = re.findall(
+        r"CREATE OR REPLACE TABLE (\w+)\s*\((.*?)\);", path.read_text(), flags=re.DOTALL | re.IGNORECASE
+    )
+    queries = []
+    for table, body in statements:
+        columns = []
+        for column in body.split(","):
+            column = " ".join(column.split()).replace(" UNIQUE", "")
+            if table.startswith("stg_"):
+                column = column.replace(" PRIMARY KEY", "")
+            columns.append(column)
+        queries.append(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+    queries += [f"CREATE INDEX IF NOT EXISTS {table}_load_id ON {table} (load_id)" for table, _ in statements if table.startswith("stg_")]
+    return queries
+
+
+def view_definitions(path=SQL_DEFINITIONS):
+    """
+    Translates the CREATE VIEW statements of `snowflake_logic.sql` to SQLite.
+
+    Parameters:
+    ----------
+    path : Path
+        The path to the SQL definitions.
+
+    Returns:
+    -------
+    list of str
+        The CREATE VIEW statements.
+    """
+    statements = re.findall(
+        r"CREATE OR REPLACE VIEW (\w+)\s+AS\s+(.*?);", path.read_text(), flags=re.DOTALL | re.IGNORECASE
+    )
+    return [f"CREATE VIEW IF NOT EXISTS {view} AS {body}" for view, body in statements]
+
+
+def merge_definitions(path=SQL_DEFINITIONS):
+    """
+    Translates the MERGE procedures of `snowflake_logic.sql` to SQLite upserts.
+
+    Each `MERGE INTO target USING (SELECT * FROM source ...) ON target.key = source.key` becomes
+    `INSERT INTO target SELECT ... FROM source WHERE {condition} ON CONFLICT (key) DO UPDATE`,
+    updating the same columns as the MERGE. `{condition}` selects the merged loads. A source
+    deduplicated with `QUALIFY ROW_NUMBER() OVER (...) = 1` keeps the same row per key here,
+    so duplicate keys resolve as they do on Snowflake.
+
+    Parameters:
+    ----------
+    path : Path
+        The path to the SQL definitions.
+
+    Returns:
+    -------
+    dict
+        A dictionary mapping procedure names to (target table, query) pairs, in definition order.
+    """
+    statements = re.findall(
+        r"CREATE OR REPLACE PROCEDURE (\w+)\(.*?MERGE INTO (\w+) AS target\s+USING \(\s*SELECT \* FROM (\w+)"
+        r"(.*?)\) AS source\s+ON target\.(\w+) = source\.\w+\s+WHEN MATCHED THEN UPDATE SET(.*?)"
+        r"WHEN NOT MATCHED THEN\s+INSERT \((.*?)\)",
+        path.read_text(), flags=re.DOTALL | re.IGNORECASE,
+    )
+    merges = {}
+    for procedure, target, source, filters, key, updates, inserts in statements:
+        columns = ", ".join(column.strip() for column in inserts.split(","))
+        assignments = ", ".join(
+            f"{column} = excluded.{column}" for column in re.findall(r"target\.(\w+)\s*=", updates)
+        )
+        # SQLite has no QUALIFY: the window of the deduplicating QUALIFY is ranked in a subquery
+        qualify = re.search(r"QUALIFY\s+(ROW_NUMBER\(\)\s+OVER\s*\(.*?\))\s*=\s*1", filters, flags=re.DOTALL | re.IGNORECASE)
+        if qualify:
+            source = f"(SELECT *, {' '.join(qualify.group(1).split())} AS source_rank FROM {source} WHERE {{condition}})"
+            condition = "source_rank = 1"
+        else:
+            condition = "{condition}"
+        # the WHERE clause is required: without it SQLite would read ON CONFLICT as a join constraint
+        merges[procedure] = (target, (
+            f"INSERT INTO {target} ({columns}) SELECT {columns} FROM {source} WHERE {condition} "
+            f"ON CONFLICT ({key}) DO UPDATE SET {assignments}"
+        ))
+    return merges
+
+
+def _load_condition(load_ids):
+    if not load_ids:
+        return "1", ()
+    return f"load_id IN ({', '.join(['?'] * len(load_ids))})", tuple(load_ids)
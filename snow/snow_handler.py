@@ -1,15 +1,31 @@
-import snowflake.connector
 import pandas as pd
-from . import secrets
+from backends import get_secrets
+from .aggregation import survival_query
+import re
 import time
+import weakref
+from connection_pool import ConnectionPool
+from schema import apply_schema, memory_usage, read_staging_chunks
+from tracing import Tracer, traced
 
 class SnowflakeHandler:
 
-    def __init__(self):
+    def __init__(self, pool=None, cache=None, tracer=None):
         """
-        Initializes the SnowflakeHandler with credentials from secrets
-        and establishes a persistent connection.
+        Initializes the SnowflakeHandler with credentials from secrets.
+        The connection is opened, or borrowed from the pool, on the first query.
+
+        Parameters:
+        ----------
+        pool : ConnectionPool, optional
+            A pool to borrow the connection from, e.g. `get_backend("snowflake_pool")`. The connection
+            goes back to the pool on `close_connection`, or when the handler is garbage collected.
+        cache : ResultCache, optional
+            A cache consulted by `fetch_full_data` before querying Snowflake.
+        tracer : Tracer, optional
+            Records a span per handler call, with row counts and Snowflake query IDs.
         """
+        secrets = get_secrets()
         self.account = secrets["snowflake_account"]
         self.user = secrets["snowflake_user"]
         self.password = secrets["snowflake_password"]
@@ -17,15 +33,46 @@ class SnowflakeHandler:
         self.database = secrets["snowflake_database"]
         self.schema = secrets["snowflake_schema"]
 
-        self.conn = snowflake.connector.connect(
-            user=self.user,
-            password=self.password,
-            account=self.account,
-            warehouse=self.warehouse,
-            database=self.database,
-            schema=self.schema,
-        )
+        self.pool = pool
+        self.cache = cache
+        self.tracer = tracer or Tracer()
+        self._conn = None
+
+        self.staging_tables = {
+            "data_photodynamic_therapy_cell_lines.csv": "stg_cell_lines",
+            "data_photodynamic_therapy_drugs.csv": "stg_drugs",
+            "data_photodynamic_therapy_results.csv": "stg_results",
+        }
+        # "parquet" stages validated files as Parquet, loaded by the *_parquet pipes
+        self.staging_format = secrets.get("staging_format", "csv")
+        suffix = "_parquet" if self.staging_format == "parquet" else ""
+        self.pipes = {
+            "stg_cell_lines": f"update_stg_cell_lines{suffix}",
+            "stg_drugs": f"update_stg_drugs{suffix}",
+            "stg_results": f"update_stg_results{suffix}",
+        }
+        self.staging_timeout = secrets.get("snowpipe_timeout_s", 120)
+        self.ingest_mode = secrets.get("ingest_mode", "s3")
+        self.merge_mode = secrets.get("merge_mode", "concurrent")
+        self.aggregation_mode = secrets.get("aggregation_mode", "local")
+        self.load_chunk_size = 500_000
+        self.staging_counts = {}
+
+    @property
+    def conn(self):
+        """
+        The Snowflake connection, opened or borrowed from the pool on first use.
+        """
+        if self._conn is None:
+            with self.tracer.span("SnowflakeHandler.connect", pooled=self.pool is not None):
+                if self.pool is None:
+                    self._conn = connect()
+                else:
+                    self._conn = self.pool.acquire()
+                    self._release = weakref.finalize(self, self.pool.release, self._conn)
+        return self._conn
 
+    @traced
     def truncate_staging_tables(self):
         """
         Truncates all staging tables before ingestion.
@@ -39,23 +86,150 @@ class SnowflakeHandler:
         with self.conn.cursor() as cur:
             for query in queries:
                 cur.execute(query)
+                self.tracer.add_query_id(cur)
 
-    def call_procedure(self, procedure_name):
+    @traced
+    def clear_staging(self, load_ids):
+        """
+        Deletes the rows of the given loads from all staging tables, once they are merged.
+
+        Parameters:
+        ----------
+        load_ids : list of str
+            The load identifiers to delete.
+        """
+        if not load_ids:
+            return
+        placeholders = ", ".join(["%s"] * len(load_ids))
+        with self.conn.cursor() as cur:
+            for table in self.pipes:
+                cur.execute(f"DELETE FROM {table} WHERE load_id IN ({placeholders})", tuple(load_ids))
+                self.tracer.add_query_id(cur)
+
+    @traced
+    def call_procedure(self, procedure_name, params=None):
         """
         Calls a stored procedure in Snowflake.
 
         Parameters:
         ----------
         procedure_name : str
-            The name of the procedure to call (e.g., 'merge_into_dim_drugs()').
+            The name of the procedure to call (e.g., 'merge_into_dim_drugs(NULL)').
+        params : tuple, optional
+            The values bound to the %s placeholders of the call.
         """
         with self.conn.cursor() as cur:
-            cur.execute(f"CALL {procedure_name}")
+            cur.execute(f"CALL {procedure_name}", params)
+            self.tracer.add_query_id(cur)
+        self.tracer.current()["procedure"] = procedure_name
 
     
+    @traced
+    def fetch_affected_users(self, load_ids=None):
+        """
+        Returns the users whose combined results change when the given loads are merged
+        (see `affected_users_query`). Run it before the merge, while the loads are in staging.
+
+        Parameters:
+        ----------
+        load_ids : list of str, optional
+            The loads to be merged. Defaults to all staging rows.
+
+        Returns:
+        -------
+        set of str
+            The user IDs.
+        """
+        load_ids = list(load_ids or [])
+        with self.conn.cursor() as cur:
+            cur.execute(affected_users_query(len(load_ids)), tuple(load_ids) * 3 or None)
+            self.tracer.add_query_id(cur)
+            users = {row[0] for row in cur.fetchall()}
+        self.tracer.current()["users"] = len(users)
+        return users
+
+    @traced
+    def run_merge_pipeline(self, load_ids=None, mode=None):
+        """
+        Merges the staging tables into the dimension and fact tables and times each step.
+
+        In "concurrent" mode the two independent dimension merges are submitted
+        asynchronously and run side by side, the fact merge follows once both finish,
+        and the merged loads are then deleted from staging.
+        In "transaction" mode a single `procedure_truncate()` call merges all three tables
+        and clears the merged loads from staging in one server-side transaction.
+
+        Parameters:
+        ----------
+        load_ids : list of str, optional
+            The loads to merge. Only their staging rows are read, so the merge time follows
+            the size of the new data. Defaults to all staging rows.
+        mode : str, optional
+            "concurrent" or "transaction". Defaults to `merge_mode`.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping each step to its duration in seconds.
+        """
+        # other users' cached results go stale when the merge renames a cell line or drug they use
+        affected_users = self.fetch_affected_users(load_ids) if self.cache is not None else set()
+        timings = self._run_merges(load_ids, mode)
+        for user_id in affected_users:
+            self.cache.invalidate(user_id)
+        return timings
+
+    def _run_merges(self, load_ids, mode):
+        """
+        Runs the merge steps of `run_merge_pipeline` and returns their timings.
+        """
+        mode = mode or self.merge_mode
+        if load_ids:
+            load_ids = sorted(set(load_ids))
+            argument = f"ARRAY_CONSTRUCT({', '.join(['%s'] * len(load_ids))})"
+            params = tuple(load_ids)
+        else:
+            argument, params = "NULL", None
+        self.tracer.current().update(mode=mode, loads=len(load_ids or []))
+        timings = {}
+        start = time.perf_counter()
+        if mode == "transaction":
+            self.call_procedure(f"procedure_truncate({argument})", params)
+            timings["procedure_truncate"] = time.perf_counter() - start
+            return timings
+
+        with self.conn.cursor() as cur:
+            running = {}
+            for procedure in ("merge_into_dim_cell_lines", "merge_into_dim_drugs"):
+                cur.execute_async(f"CALL {procedure}({argument})", params)
+                running[procedure] = cur.sfqid
+                self.tracer.add_query_id(cur)
+            delay = 0.05
+            while running:
+                for procedure, query_id in list(running.items()):
+                    status = self.conn.get_query_status_throw_if_error(query_id)
+                    if not self.conn.is_still_running(status):
+                        timings[procedure] = time.perf_counter() - start
+                        del running[procedure]
+                if running:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1)
+
+        fact_start = time.perf_counter()
+        self.call_procedure(f"merge_into_fac_results({argument})", params)
+        timings["merge_into_fac_results"] = time.perf_counter() - fact_start
+        if load_ids:
+            clear_start = time.perf_counter()
+            self.clear_staging(load_ids)
+            timings["clear_staging"] = time.perf_counter() - clear_start
+        timings["total"] = time.perf_counter() - start
+        return timings
+
+    @traced
     def refresh_snowpipe(self, pipe_name):
         """
         Refreshes a specified Snowpipe to manually trigger file ingestion.
+        The refresh only queues the files; use `wait_for_staging` to know when they have landed.
 
         Parameters:
         ----------
@@ -70,32 +244,168 @@ class SnowflakeHandler:
         try:
             with self.conn.cursor() as cur:
                 cur.execute(f"ALTER PIPE {pipe_name} REFRESH;")
-            time.sleep(10)
+                self.tracer.add_query_id(cur)
             return True
         except Exception as e:
             print(f"Error during communication with Snowflake: {e}")
             return False
+
+    @traced
+    def load_staging_files(self, valid_files):
+        """
+        Bulk-loads validated files straight into the staging tables, bypassing S3 and Snowpipe.
+        Used when `ingest_mode` is "direct".
+
+        Each file (CSV or Parquet) is read in chunks of `load_chunk_size` rows and every chunk is written with
+        `write_pandas`, which stages it as compressed Parquet and copies it in one call.
+
+        Parameters:
+        ----------
+        valid_files : list
+            A list of tuples (file_name, file_object) as returned by `DataHandler.validate_user_data`.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping staging table names to the number of rows loaded.
+        """
+        from snowflake.connector.pandas_tools import write_pandas
+
+        loaded_rows = {}
+        for file_name, file_content in valid_files:
+            table = self.staging_tables[file_name]
+            loaded_rows[table] = 0
+            file_content.seek(0)
+            for chunk in read_staging_chunks(file_content, self.load_chunk_size):
+                chunk.columns = [column.upper() for column in chunk.columns]
+                _, _, rows, _ = write_pandas(self.conn, chunk, table.upper(), quote_identifiers=False)
+                loaded_rows[table] += rows
+        self.tracer.current()["rows"] = sum(loaded_rows.values())
+        return loaded_rows
+
+    @traced
+    def count_staging_rows(self, load_ids):
+        """
+        Counts the rows of the given loads in each staging table.
+
+        Parameters:
+        ----------
+        load_ids : list of str
+            The load identifiers to count rows for.
+
+        Returns:
+        -------
+        dict
+            A dictionary mapping staging table names to row counts.
+        """
+        tables = list(self.pipes)
+        if not load_ids:
+            return dict.fromkeys(tables, 0)
+        placeholders = ", ".join(["%s"] * len(load_ids))
+        query = "SELECT " + ", ".join(
+            f"(SELECT COUNT(*) FROM {table} WHERE load_id IN ({placeholders}))" for table in tables
+        )
+        with self.conn.cursor() as cur:
+            cur.execute(query, tuple(load_ids) * len(tables))
+            self.tracer.add_query_id(cur)
+            counts = cur.fetchone()
+        return dict(zip(tables, counts))
+
+    @traced
+    def wait_for_staging(self, expected_rows, load_ids, timeout=None, progress=None):
+        """
+        Polls the staging tables until they hold the expected rows, with exponential backoff.
+
+        Parameters:
+        ----------
+        expected_rows : dict
+            A dictionary mapping uploaded file names to their number of data rows.
+        load_ids : list of str
+            The load identifiers of the uploaded files.
+        timeout : float, optional
+            The deadline in seconds. Defaults to `staging_timeout`.
+        progress : callable, optional
+            Called with the staging row counts after every poll.
+
+        Returns:
+        -------
+        bool
+            True as soon as every staging table holds the expected rows, False on timeout.
+        """
+        expected = {self.staging_tables[file_name]: rows for file_name, rows in expected_rows.items()}
+        deadline = time.monotonic() + (self.staging_timeout if timeout is None else timeout)
+        delay = 0.5
+        span = self.tracer.current()
+        span["polls"] = 0
+        while True:
+            self.staging_counts = self.count_staging_rows(load_ids)
+            span["polls"] += 1
+            if progress:
+                progress(self.staging_counts)
+            missing = {
+                table: f"{self.staging_counts[table]}/{rows}"
+                for table, rows in expected.items()
+                if self.staging_counts[table] < rows
+            }
+            if not missing:
+                return True
+            if time.monotonic() + delay > deadline:
+                print(f"Timed out waiting for Snowpipe, loaded rows per table: {missing}")
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 8)
         
-    def reset_pipeline(self):
+    @traced
+    def reset_pipeline(self, expected_rows=None, load_ids=None, progress=None):
         """
-        Truncates staging tables and refreshes all Snowpipes.
-        Useful to prepare the environment for a fresh ETL run.
+        Refreshes all Snowpipes and waits for the uploaded files to land in staging.
+        Staging is not truncated: rows are scoped by load identifier and cleared once merged.
+
+        Parameters:
+        ----------
+        expected_rows : dict, optional
+            A dictionary mapping uploaded file names to their number of data rows.
+            When given with `load_ids`, waits until the rows have landed in staging.
+        load_ids : list of str, optional
+            The load identifiers of the uploaded files.
+        progress : callable, optional
+            Called with the staging row counts while waiting (see `wait_for_staging`).
+
+        Returns:
+        -------
+        bool
+            True if all pipes were refreshed and the expected rows (if any) have landed.
         """
-        self.truncate_staging_tables()
-        pipes = ["update_stg_cell_lines", "update_stg_drugs", "update_stg_results"]
-        for pipe in pipes:
-            success = self.refresh_snowpipe(pipe)
-            if not success:
+        success = True
+        for pipe in self.pipes.values():
+            if not self.refresh_snowpipe(pipe):
                 print(f"Failed to refresh pipe: {pipe}")
+                success = False
+
+        if success and expected_rows and load_ids:
+            success = self.wait_for_staging(expected_rows, load_ids, progress=progress)
+        return success
         
-    def fetch_data(self, table_name):
+    def build_select(self, table_name, columns=None, filters=None, distinct=False):
+        """
+        Builds a parameterized SELECT query for Snowflake (see the module-level `build_select`).
+        """
+        return build_select(table_name, columns, filters, distinct)
+
+    @traced
+    def fetch_data(self, table_name, columns=None, filters=None):
         """
-        Fetches all data from a specified table in Snowflake.
+        Fetches data from a specified table in Snowflake.
+        Results are transferred as Arrow batches and converted straight into a typed DataFrame.
 
         Parameters:
         ----------
         table_name : str
             The name of the table to fetch data from.
+        columns : list of str, optional
+            The columns to fetch. Defaults to all columns.
+        filters : dict, optional
+            A dictionary mapping column names to a value, or to a list of accepted values.
 
         Returns:
         -------
@@ -103,18 +413,49 @@ class SnowflakeHandler:
             A tuple containing the list of column names and a DataFrame with the table's content.
         """      
         try:
+            query, params = self.build_select(table_name, columns, filters)
             with self.conn.cursor() as cur:
-                cur.execute(f"SELECT * FROM {table_name};")
-                rows = cur.fetchall()
-                columns = [desc[0] for desc in cur.description]
-                return columns, pd.DataFrame(rows, columns=columns)
+                cur.execute(query, params)
+                self.tracer.add_query_id(cur)
+                data = cur.fetch_pandas_all()
+                self.tracer.current().update(rows=len(data), bytes=int(data.memory_usage(deep=True).sum()))
+                return list(data.columns), data
         except Exception as e:
             print(f"Error fetching data from {table_name}: {e}")
             return None
 
-    def fetch_full_data(self, view_name, user_id):
+    def iter_data(self, table_name, columns=None, filters=None, distinct=False):
+        """
+        Fetches data from a specified table in Snowflake batch by batch.
+        Use it for large results that should not be held in memory at once.
+
+        Parameters:
+        ----------
+        table_name : str
+            The name of the table or view to fetch data from.
+        columns : list of str, optional
+            The columns to fetch. Defaults to all columns.
+        filters : dict, optional
+            A dictionary mapping column names to a value, or to a list of accepted values.
+        distinct : bool
+            Whether to fetch distinct rows only.
+
+        Yields:
+        ------
+        pd.DataFrame
+            One DataFrame per Arrow result batch.
+        """
+        query, params = self.build_select(table_name, columns, filters, distinct)
+        with self.conn.cursor() as cur:
+            cur.execute(query, params)
+            yield from cur.fetch_pandas_batches()
+
+    @traced
+    def fetch_full_data(self, view_name, user_id, columns=None, filters=None):
         """
         Fetches user-specific distinct data from a Snowflake view.
+        Results are transferred as Arrow batches, converted to compact types (see `schema.apply_schema`),
+        and served from `cache`, when set, until the user's data changes.
 
         Parameters:
         ----------
@@ -122,27 +463,203 @@ class SnowflakeHandler:
             The name of the view to query.
         user_id : str or int
             The user ID to filter data by.
+        columns : list of str, optional
+            The columns to fetch. Defaults to all columns.
+        filters : dict, optional
+            Additional filters, as a dictionary mapping column names to a value or a list of values.
 
         Returns:
         -------
         pd.DataFrame or None
             A DataFrame with the filtered data, or None if the query fails.
         """
+        cache_name = f"{view_name}-{columns}-{sorted((filters or {}).items())}"
+        if self.cache is not None:
+            data = self.cache.get(user_id, cache_name)
+            self.tracer.current()["cache_hit"] = data is not None
+            if data is not None:
+                return data
         try:
+            query, params = self.build_select(
+                view_name, columns, {"USER_ID": user_id, **(filters or {})}, distinct=True
+            )
             with self.conn.cursor() as cur:
-                query = f"SELECT DISTINCT * FROM {view_name} WHERE USER_ID = %s"
-                cur.execute(query, (user_id,))
-                result = cur.fetchall()
-                columns = [desc[0] for desc in cur.description]
-                return pd.DataFrame(result, columns=columns)
+                cur.execute(query, params)
+                self.tracer.add_query_id(cur)
+                data = cur.fetch_pandas_all()
         except Exception as e:
             print(f"Error fetching data from {view_name}: {e}")
             return None
+        fetched_bytes = memory_usage(data)
+        data = apply_schema(data)
+        self.tracer.current().update(rows=len(data), fetched_bytes=fetched_bytes, bytes=memory_usage(data))
+        if self.cache is not None:
+            self.cache.put(user_id, cache_name, data)
+        return data
         
+    @traced
+    def fetch_experiment_survival(self, view_name, user_id, experiment_number, include_replicates=False):
+        """
+        Computes the survival analysis of one experiment in Snowflake.
+        Used when `aggregation_mode` is "warehouse"; only the aggregated rows come back.
+
+        Parameters:
+        ----------
+        view_name : str
+            The name of the view with the combined results.
+        user_id : str
+            The user ID to filter data by.
+        experiment_number : int
+            The number of the experiment to analyze.
+        include_replicates : bool
+            Whether to return the twelve RESULT columns along with the aggregates.
+
+        Returns:
+        -------
+        pd.DataFrame or None
+            A DataFrame with the columns of `DataHandler.calculate_survival`, or None if the query fails.
+        """
+        try:
+            query = survival_query(view_name, include_replicates=include_replicates)
+            with self.conn.cursor() as cur:
+                cur.execute(query, (user_id, int(experiment_number)))
+                self.tracer.add_query_id(cur)
+                data = cur.fetch_pandas_all()
+                self.tracer.current()["rows"] = len(data)
+                return apply_schema(data)
+        except Exception as e:
+            print(f"Error computing survival from {view_name}: {e}")
+            return None
+
     def close_connection(self):
         """
-        Closes the Snowflake connection.
+        Closes the Snowflake connection, or gives it back to the pool.
         Should be called when done using the handler.
         """
-        if self.conn:
-            self.conn.close()
\ No newline at end of file
+        if self._conn is None:
+            return
+        if self.pool is not None:
+            self._release()
+        else:
+            self._conn.close()
+        self._conn = None
+
+
+def build_select(table_name, columns=None, filters=None, distinct=False, placeholder="%s"):
+    """
+    Builds a parameterized SELECT query with a column projection and equality filters.
+
+    Parameters:
+    ----------
+    table_name : str
+        The name of the table or view to query.
+    columns : list of str, optional
+        The columns to select. Defaults to all columns.
+    filters : dict, optional
+        A dictionary mapping column names to a value, or to a list of accepted values.
+    distinct : bool
+        Whether to select distinct rows only.
+    placeholder : str
+        The parameter placeholder of the database driver ("%s" for Snowflake, "?" for SQLite).
+
+    Returns:
+    -------
+    tuple
+        A tuple (query, params).
+    """
+    for identifier in [table_name, *(columns or []), *(filters or {})]:
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_$]*", identifier):
+            raise ValueError(f"Invalid identifier: {identifier!r}")
+
+    projection = ", ".join(columns) if columns else "*"
+    query = f"SELECT {'DISTINCT ' if distinct else ''}{projection} FROM {table_name}"
+    conditions, params = [], []
+    for column, value in (filters or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            # an empty list matches nothing; "IN ()" is a syntax error
+            conditions.append(f"{column} IN ({', '.join([placeholder] * len(value))})" if value else "1 = 0")
+            params.extend(value)
+        else:
+            conditions.append(f"{column} = {placeholder}")
+            params.append(value)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query, tuple(params)
+
+
+def affected_users_query(load_count, placeholder="%s"):
+    """
+    Builds a query for the users whose `combined_results` rows change when loads are merged.
+
+    Besides the uploader, these are the owners of re-uploaded experiment IDs, and the users whose
+    results reference a cell line or drug code that the loads add or rename: the dimension
+    tables are shared by all users and joined to the results by code.
+
+    Parameters:
+    ----------
+    load_count : int
+        The number of load IDs; 0 considers all staging rows.
+    placeholder : str
+        The parameter placeholder of the database driver ("%s" for Snowflake, "?" for SQLite).
+
+    Returns:
+    -------
+    str
+        The query. It takes the load IDs three times, once per staging table.
+    """
+    loads = f"s.load_id IN ({', '.join([placeholder] * load_count)})" if load_count else "1 = 1"
+    return f"""
+SELECT DISTINCT f.user_id
+FROM fac_results f
+WHERE f.experiment_id IN (SELECT s.experiment_id FROM stg_results s WHERE {loads})
+    OR f.cell_line_code IN (
+        SELECT s.cell_line_code FROM stg_cell_lines s
+        LEFT JOIN dim_cell_lines d ON d.cell_line_code = s.cell_line_code
+        WHERE {loads} AND s.cell_line_name IS DISTINCT FROM d.cell_line_name
+    )
+    OR f.drug_code IN (
+        SELECT s.drug_code FROM stg_drugs s
+        LEFT JOIN dim_drugs d ON d.drug_code = s.drug_code
+        WHERE {loads} AND s.drug_name IS DISTINCT FROM d.drug_name
+    )
+"""
+
+
+def connect():
+    """
+    Opens a Snowflake connection with the credentials from secrets.
+
+    Returns:
+    -------
+    snowflake.connector.SnowflakeConnection
+        The new connection.
+    """
+    import snowflake.connector
+
+    secrets = get_secrets()
+    return snowflake.connector.connect(
+        user=secrets["snowflake_user"],
+        password=secrets["snowflake_password"],
+        account=secrets["snowflake_account"],
+        warehouse=secrets["snowflake_warehouse"],
+        database=secrets["snowflake_database"],
+        schema=secrets["snowflake_schema"],
+    )
+
+
+def create_connection_pool():
+    """
+    Creates a pool of Snowflake connections sized from secrets.
+
+    Returns:
+    -------
+    ConnectionPool
+        The pool, meant to be created once per process and shared by all sessions
+        (see `backends.get_backend("snowflake_pool")`).
+    """
+    secrets = get_secrets()
+    return ConnectionPool(
+        connect,
+        max_size=secrets.get("snowflake_pool_size", 4),
+        idle_timeout=secrets.get("snowflake_pool_idle_timeout_s", 600),
+    )
\ No newline at end of file
@@ -45,14 +45,16 @@ CREATE OR REPLACE TABLE fac_results(
 CREATE OR REPLACE TABLE stg_cell_lines(
     cell_line_code VARCHAR(20) PRIMARY KEY UNIQUE,
     cell_line_name VARCHAR(50) NOT NULL UNIQUE,
-    user_id VARCHAR(20)
+    user_id VARCHAR(20),
+    load_id VARCHAR(64)
 );
 
 -- Create the stg_drugs table
 CREATE OR REPLACE TABLE stg_drugs(
     drug_code VARCHAR(20) PRIMARY KEY UNIQUE,
     drug_name VARCHAR(50) NOT NULL UNIQUE,
-    user_id VARCHAR(20)
+    user_id VARCHAR(20),
+    load_id VARCHAR(64)
 );
 
 -- Create the stg_results table
@@ -75,7 +77,8 @@ CREATE OR REPLACE TABLE stg_results(
     result_010 INT,
     result_011 INT,
     result_012 INT,
-    user_id VARCHAR(20)
+    user_id VARCHAR(20),
+    load_id VARCHAR(64)
 );
 
 -- Create an external storage integration for S3
@@ -86,13 +89,19 @@ CREATE STORAGE INTEGRATION smart_data_analyzer_bucket
     STORAGE_ALLOWED_LOCATIONS = ('s3://$BUCKET_NAME')
     STORAGE_AWS_ROLE_ARN = $AWS_ROLE_ARN;
 
--- Define a CSV file format
+-- Define a CSV file format (plain or gzip-compressed)
 CREATE OR REPLACE FILE FORMAT my_csv_format
     TYPE = 'CSV'
     FIELD_OPTIONALLY_ENCLOSED_BY = '"'
     SKIP_HEADER = 1
+    COMPRESSION = AUTO
     NULL_IF = ('NULL', 'null', '', ' ');
 
+-- Define a Parquet file format for the Parquet staging mode (staging_format: parquet)
+CREATE OR REPLACE FILE FORMAT my_parquet_format
+    TYPE = 'PARQUET'
+    COMPRESSION = AUTO;
+
 -- Create an external stage using the storage integration
 CREATE OR REPLACE STAGE aws_ext_stage_integration
     STORAGE_INTEGRATION = smart_data_analyzer_bucket
@@ -105,37 +114,74 @@ CREATE OR REPLACE PIPE update_stg_cell_lines
     AUTO_INGEST = TRUE
     AS COPY INTO stg_cell_lines
 FROM @aws_ext_stage_integration
-PATTERN = '.*cell_lines.*\.csv'
+PATTERN = '.*cell_lines.*[.]csv([.]gz)?'
 FILE_FORMAT = my_csv_format;
 
 CREATE OR REPLACE PIPE update_stg_drugs
     AUTO_INGEST = TRUE
     AS COPY INTO stg_drugs
 FROM @aws_ext_stage_integration
-PATTERN = '.*drugs.*\.csv'
+PATTERN = '.*drugs.*[.]csv([.]gz)?'
 FILE_FORMAT = my_csv_format;
 
 CREATE OR REPLACE PIPE update_stg_results
     AUTO_INGEST = TRUE
     AS COPY INTO stg_results
 FROM @aws_ext_stage_integration
-PATTERN = '.*results.*\.csv'
+PATTERN = '.*results.*[.]csv([.]gz)?'
 FILE_FORMAT = my_csv_format;
 
+-- Pipes for Parquet staging files, uploaded under the parquet/ prefix
+CREATE OR REPLACE PIPE update_stg_cell_lines_parquet
+    AUTO_INGEST = TRUE
+    AS COPY INTO stg_cell_lines
+FROM @aws_ext_stage_integration/parquet/
+PATTERN = '.*cell_lines.*[.]parquet'
+FILE_FORMAT = my_parquet_format
+MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE;
+
+CREATE OR REPLACE PIPE update_stg_drugs_parquet
+    AUTO_INGEST = TRUE
+    AS COPY INTO stg_drugs
+FROM @aws_ext_stage_integration/parquet/
+PATTERN = '.*drugs.*[.]parquet'
+FILE_FORMAT = my_parquet_format
+MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE;
+
+CREATE OR REPLACE PIPE update_stg_results_parquet
+    AUTO_INGEST = TRUE
+    AS COPY INTO stg_results
+FROM @aws_ext_stage_integration/parquet/
+PATTERN = '.*results.*[.]parquet'
+FILE_FORMAT = my_parquet_format
+MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE;
+
 -- Refresh the pipes to ensure data is loaded
 ALTER PIPE update_stg_cell_lines REFRESH;
 ALTER PIPE update_stg_drugs REFRESH;
 ALTER PIPE update_stg_results REFRESH;
+ALTER PIPE update_stg_cell_lines_parquet REFRESH;
+ALTER PIPE update_stg_drugs_parquet REFRESH;
+ALTER PIPE update_stg_results_parquet REFRESH;
 
--- Create procedure for merging data
-CREATE OR REPLACE PROCEDURE merge_into_dim_cell_lines()
+-- Create procedures for merging data
+-- Each merge only reads the staging rows of the given loads (all rows when load_ids is NULL).
+-- load_id is compared to the flattened load IDs as a plain column rather than cast to VARIANT;
+-- FLATTEN yields no rows for NULL, so the NULL case is a separate branch.
+-- Loads merged in one cycle may stage the same key (e.g. two uploads of one experiment);
+-- QUALIFY keeps one source row per key, so the MERGE stays deterministic instead of failing.
+CREATE OR REPLACE PROCEDURE merge_into_dim_cell_lines(load_ids ARRAY)
 RETURNS STRING
 LANGUAGE SQL
 AS
 $$
 BEGIN
   MERGE INTO dim_cell_lines AS target
-  USING stg_cell_lines AS source
+  USING (
+    SELECT * FROM stg_cell_lines
+    WHERE :load_ids IS NULL OR load_id IN (SELECT value::STRING FROM TABLE(FLATTEN(input => :load_ids)))
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY cell_line_code ORDER BY load_id DESC) = 1
+  ) AS source
   ON target.cell_line_code = source.cell_line_code
   WHEN MATCHED THEN UPDATE SET target.cell_line_name = source.cell_line_name
   WHEN NOT MATCHED THEN INSERT (cell_line_code, cell_line_name, user_id)
@@ -145,14 +191,18 @@ BEGIN
 END;
 $$;
 
-CREATE OR REPLACE PROCEDURE merge_into_dim_drugs()
+CREATE OR REPLACE PROCEDURE merge_into_dim_drugs(load_ids ARRAY)
 RETURNS STRING
 LANGUAGE SQL
 AS
 $$
 BEGIN
   MERGE INTO dim_drugs AS target
-  USING stg_drugs AS source
+  USING (
+    SELECT * FROM stg_drugs
+    WHERE :load_ids IS NULL OR load_id IN (SELECT value::STRING FROM TABLE(FLATTEN(input => :load_ids)))
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY drug_code ORDER BY load_id DESC) = 1
+  ) AS source
   ON target.drug_code = source.drug_code
   WHEN MATCHED THEN UPDATE SET 
     target.drug_name = source.drug_name,
@@ -165,14 +215,18 @@ BEGIN
 END;
 $$;
 
-CREATE OR REPLACE PROCEDURE merge_into_fac_results()
+CREATE OR REPLACE PROCEDURE merge_into_fac_results(load_ids ARRAY)
 RETURNS STRING
 LANGUAGE SQL
 AS
 $$
 BEGIN
   MERGE INTO fac_results AS target
-  USING stg_results AS source
+  USING (
+    SELECT * FROM stg_results
+    WHERE :load_ids IS NULL OR load_id IN (SELECT value::STRING FROM TABLE(FLATTEN(input => :load_ids)))
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY experiment_id ORDER BY load_id DESC) = 1
+  ) AS source
   ON target.experiment_id = source.experiment_id
   WHEN MATCHED THEN UPDATE SET
     target.experiment_number = source.experiment_number,
@@ -213,24 +267,31 @@ BEGIN
 END;
 $$;
 
--- Create procedure with truncate tabel and merge
-CREATE OR REPLACE PROCEDURE procedure_truncate()
+-- Create procedure with merge and truncate tabel in one transaction
+CREATE OR REPLACE PROCEDURE procedure_truncate(load_ids ARRAY)
 RETURNS STRING
 LANGUAGE SQL
 AS
 $$
 BEGIN
-  -- Truncate staging tables first
-  TRUNCATE TABLE stg_cell_lines;
-  TRUNCATE TABLE stg_drugs;
-  TRUNCATE TABLE stg_results;
+  BEGIN TRANSACTION;
+
+  -- Run merge statements for each target table first
+  CALL merge_into_dim_cell_lines(:load_ids);
+  CALL merge_into_dim_drugs(:load_ids);
+  CALL merge_into_fac_results(:load_ids);
 
-  -- Run merge statements for each target table
-  CALL merge_into_dim_cell_lines();
-  CALL merge_into_dim_drugs();
-  CALL merge_into_fac_results();
+  -- Then clear the merged loads from staging (DELETE, unlike TRUNCATE, does not commit implicitly)
+  DELETE FROM stg_cell_lines WHERE :load_ids IS NULL OR load_id IN (SELECT value::STRING FROM TABLE(FLATTEN(input => :load_ids)));
+  DELETE FROM stg_drugs WHERE :load_ids IS NULL OR load_id IN (SELECT value::STRING FROM TABLE(FLATTEN(input => :load_ids)));
+  DELETE FROM stg_results WHERE :load_ids IS NULL OR load_id IN (SELECT value::STRING FROM TABLE(FLATTEN(input => :load_ids)));
 
-  RETURN 'Truncate and merge completed successfully';
+  COMMIT;
+  RETURN 'Merge and truncate completed successfully';
+EXCEPTION
+  WHEN OTHER THEN
+    ROLLBACK;
+    RAISE;
 END;
 $$;
 
@@ -239,7 +300,7 @@ CREATE OR REPLACE TASK task_merge
   WAREHOUSE = 'COMPUTE_WH'
   -- SCHEDULE = '5 MINUTE'
 AS
-  CALL merge_into_dim_cell_lines();
+  CALL merge_into_dim_cell_lines(NULL);
 
 
 -- Create a view combining results
@@ -0,0 +1,58 @@
+import io
+from pathlib import Path
+
+import pytest
+
+import backends
+from data_handler import DataHandler
+
+
+@pytest.fixture
+def secrets(monkeypatch):
+    """
+    Replaces the settings of `secrets.yaml` with the local warehouse backend, no credentials needed.
+    Tests may add or change settings in the returned dictionary.
+    """
+    settings = {"warehouse_backend": "local", "local_warehouse_path": ":memory:"}
+    monkeypatch.setattr(backends, "_secrets", settings)
+    return settings
+
+
+SAMPLE_DIRECTORY = Path(__file__).resolve().parent.parent / "sample_files"
+SAMPLE_FILES = {
+    "data_photodynamic_therapy_cell_lines.csv": "your_cell_lines.csv",
+    "data_photodynamic_therapy_drugs.csv": "your_drugs.csv",
+    "data_photodynamic_therapy_results.csv": "your_results.csv",
+}
+
+
+def validate_files(user_id, contents=None):
+    """
+    Validates the sample files, or replacement contents, as `DataHandler.validate_user_data` does.
+
+    Parameters:
+    ----------
+    user_id : str
+        The user the files are uploaded for.
+    contents : dict, optional
+        A dictionary mapping expected file names to CSV text replacing the sample file.
+
+    Returns:
+    -------
+    tuple
+        A tuple (valid_files, row_counts, load_ids) as passed to `jobs.run_ingest`.
+    """
+    handler = DataHandler()
+    valid_files, row_counts, load_ids = [], {}, {}
+    for file_name, sample_name in SAMPLE_FILES.items():
+        if contents and file_name in contents:
+            source = io.BytesIO(contents[file_name].encode())
+        else:
+            source = io.BytesIO((SAMPLE_DIRECTORY / sample_name).read_bytes())
+        load_ids[file_name] = handler.compute_load_id(source, user_id)
+        validated_file, row_counts[file_name], errors = handler.stream_validate_file(
+            source, file_name, user_id, load_ids[file_name]
+        )
+        assert errors == [], errors
+        valid_files.append((file_name, validated_file))
+    return valid_files, row_counts, load_ids
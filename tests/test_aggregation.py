@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import validate_files
+from data_handler import DataHandler
+from snow.aggregation import AGGREGATE_COLUMNS
+from snow.local_warehouse import LocalWarehouseHandler
+
+HEADER = (
+    "experiment_id,experiment_number,cell_line_code,treatment_time,drug_code,drug_concentration,"
+    + ",".join(f"result_{i:03d}" for i in range(1, 13))
+)
+
+
+def results_csv(rows):
+    """
+    Builds a results file from (experiment_id, experiment_number, cell_line_code, treatment_time,
+    drug_code, drug_concentration, replicates) tuples; missing replicates are blank.
+    """
+    lines = [HEADER]
+    for *keys, replicates in rows:
+        cells = [str(value) for value in replicates] + [" "] * (12 - len(replicates))
+        lines.append(",".join(map(str, keys)) + "," + ",".join(cells))
+    return "\n".join(lines) + "\n"
+
+
+RESULTS = results_csv([
+    # blank replicates, two cell lines
+    (1, 1, "cl001", 0, "d001", 0, [100, 102, 101, 100]),
+    (2, 1, "cl001", 5, "d001", 20, [50, 52, 51, 50, 53]),
+    (3, 1, "cl001", 10, "d001", 40, [33, 32, 30, 31, 35]),
+    (4, 1, "cl002", 0, "d001", 0, [90, 95]),
+    (5, 1, "cl002", 5, "d001", 20, [47]),
+    (6, 1, "cl002", 10, "d001", 40, []),
+    # a control mean of 0
+    (7, 2, "cl001", 0, "d002", 0, [0, 0, 0]),
+    (8, 2, "cl001", 5, "d002", 20, [12, 15, 11]),
+    # a mean of 0.125, a rounding tie
+    (9, 3, "cl002", 0, "d002", 0, [3, 4]),
+    (10, 3, "cl002", 5, "d002", 20, [1, 0, 0, 0, 0, 0, 0, 0]),
+    (11, 3, "cl002", 10, "d002", 40, [7, 8, 8]),
+])
+
+
+@pytest.fixture
+def local_handler(secrets):
+    handler = LocalWarehouseHandler(":memory:")
+    valid_files, _, load_ids = validate_files("user", {"data_photodynamic_therapy_results.csv": RESULTS})
+    handler.load_staging_files(valid_files)
+    handler.run_merge_pipeline(list(load_ids.values()))
+    yield handler
+    handler.close_connection()
+
+
+@pytest.mark.parametrize("experiment_number", [1, 2, 3])
+def test_survival_query_matches_pandas_analysis(local_handler, experiment_number):
+    data_handler = DataHandler()
+    experiment_data = data_handler.fetch_experiment_data(
+        local_handler.fetch_full_data("combined_results", "user"), experiment_number
+    )
+    _, _, full_experiment_data = data_handler.analyze_experiment_data(experiment_data.copy())
+    expected = data_handler.calculate_survival(full_experiment_data).sort_values("EXPERIMENT_ID")
+
+    survival = local_handler.fetch_experiment_survival("combined_results", "user", experiment_number)
+
+    assert list(survival["EXPERIMENT_ID"]) == list(expected["EXPERIMENT_ID"])
+    for column in AGGREGATE_COLUMNS:
+        np.testing.assert_allclose(
+            survival[column].to_numpy(dtype="float64"), expected[column].to_numpy(dtype="float64"),
+            rtol=0, atol=1e-9, err_msg=column,
+        )
+
+
+def test_zero_control_mean_gives_zero_survival(local_handler):
+    survival = local_handler.fetch_experiment_survival("combined_results", "user", 2)
+
+    assert (survival["MEAN_CONTROL"] == 0).all()
+    assert (survival["SURVIVAL_RATE"] == 0).all()
+
+
+def test_wells_without_replicates_have_no_statistics(local_handler):
+    survival = local_handler.fetch_experiment_survival("combined_results", "user", 1).set_index("EXPERIMENT_ID")
+
+    assert pd.isna(survival.loc[6, "MEAN"]) and pd.isna(survival.loc[6, "STD"])
+    assert pd.isna(survival.loc[5, "STD"])
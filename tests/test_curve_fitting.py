@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from curve_fitting import PARAMETER_COLUMNS, CurveFitter
+
+
+def survival_table(concentrations):
+    """
+    Builds a survival table with one row per concentration for two groups.
+    """
+    rows = []
+    for cell_line in ["Cell A", "Cell B"]:
+        for concentration in concentrations:
+            rows.append({
+                'DRUG_NAME': "Drug 1",
+                'CELL_LINE_NAME': cell_line,
+                'TREATMENT_TIME': 5,
+                'DRUG_CONCENTRATION': concentration,
+                'SURVIVAL_RATE': 100 / (1 + concentration / 20),
+            })
+    return pd.DataFrame(rows)
+
+
+def test_fit_without_fittable_groups_returns_nan_parameters():
+    # every group has fewer than `min_concentrations` distinct concentrations
+    fits = CurveFitter().fit(survival_table([0, 20, 40]))
+
+    assert len(fits) == 2
+    assert list(fits.columns[3:]) == PARAMETER_COLUMNS
+    assert fits['IC50'].isna().all()
+    assert not fits['CONVERGED'].any()
+    assert (fits['N_POINTS'] == 3).all()
+
+
+def test_fit_recovers_ic50():
+    fits = CurveFitter().fit(survival_table([0, 5, 10, 20, 40, 80, 160]))
+
+    assert fits['CONVERGED'].all()
+    assert np.allclose(fits['IC50'], 20, rtol=1e-3)
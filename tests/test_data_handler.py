@@ -0,0 +1,97 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_handler import DataHandler
+
+CELL_LINES_FILE = "data_photodynamic_therapy_cell_lines.csv"
+
+
+def validate(text, chunk_size=50_000):
+    """
+    Validates CSV text as the cell lines file.
+    """
+    handler = DataHandler()
+    handler.chunk_size = chunk_size
+    return handler.stream_validate_file(io.BytesIO(text.encode()), CELL_LINES_FILE, "user", load_id="load")
+
+
+def test_valid_file_gets_user_and_load_ids():
+    validated_file, row_count, errors = validate("cell_line_code,cell_line_name\nC1,Cell A\nC2,Cell B\n")
+
+    assert errors == []
+    assert row_count == 2
+    assert pd.read_csv(validated_file).to_dict("records") == [
+        {"cell_line_code": "C1", "cell_line_name": "Cell A", "user_id": "user", "load_id": "load"},
+        {"cell_line_code": "C2", "cell_line_name": "Cell B", "user_id": "user", "load_id": "load"},
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 50_000])
+@pytest.mark.parametrize("row, fields", [("C2,Cell B,extra", 3), ("C2,Cell B,extra,more", 4)])
+def test_row_with_extra_fields_is_rejected(row, fields, chunk_size):
+    # an extra field used to shift the values of the row into the wrong columns
+    text = f"cell_line_code,cell_line_name\nC1,Cell A\n{row}\nC3,Cell C\n"
+    validated_file, _, errors = validate(text, chunk_size)
+
+    assert validated_file is None
+    assert len(errors) == 1
+    assert errors[0].startswith("Wrong number of fields, expected 2")
+    assert "line 3" in errors[0] or "lines 3" in errors[0]
+
+
+def combined_results():
+    """
+    Builds a combined_results frame with several experiments, two drugs and two cell lines.
+    Experiment 2 has a control mean of 0 and experiment 3 has no control rows.
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    experiment_id = 0
+    for experiment_number in [1, 2, 3, 4]:
+        for drug in ["drug1", "drug2"]:
+            for cell_line in ["cell1", "cell2"]:
+                for treatment_time, concentration in [(0, 0), (5, 20), (10, 40), (10, 80)]:
+                    if experiment_number == 3 and concentration == 0:
+                        continue
+                    experiment_id += 1
+                    replicates = rng.integers(0, 120, 12).astype(float)
+                    if experiment_number == 2 and concentration == 0:
+                        replicates[:] = 0
+                    replicates[rng.integers(3, 12):] = np.nan
+                    rows.append({
+                        'EXPERIMENT_ID': experiment_id,
+                        'EXPERIMENT_NUMBER': experiment_number,
+                        'USER_ID': "user",
+                        'CELL_LINE_NAME': cell_line,
+                        'DRUG_NAME': drug,
+                        'TREATMENT_TIME': treatment_time,
+                        'DRUG_CONCENTRATION': concentration,
+                        **{f'RESULT_{i:03d}': value for i, value in enumerate(replicates, start=1)},
+                    })
+    data = pd.DataFrame(rows)
+    result_columns = [column for column in data.columns if column.startswith('RESULT_')]
+    data[result_columns] = data[result_columns].astype("Int64")
+    return data
+
+
+@pytest.mark.parametrize("experiment_number", [1, 2, 3, 4])
+def test_analyze_all_experiments_matches_per_experiment_analysis(experiment_number):
+    data = combined_results()
+    handler = DataHandler()
+
+    experiment_data = handler.fetch_experiment_data(data, experiment_number).copy()
+    _, _, full_experiment_data = handler.analyze_experiment_data(experiment_data)
+    expected = handler.calculate_survival(full_experiment_data).reset_index(drop=True)
+    result = handler.slice_experiment(handler.analyze_all_experiments(data), experiment_number)
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_zero_control_mean_and_missing_controls():
+    analysis = DataHandler().analyze_all_experiments(combined_results())
+
+    assert (analysis.loc[analysis['EXPERIMENT_NUMBER'] == 2, 'SURVIVAL_RATE'] == 0).all()
+    assert 3 not in set(analysis['EXPERIMENT_NUMBER'])
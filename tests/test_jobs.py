@@ -0,0 +1,93 @@
+import time
+
+from conftest import validate_files
+from connection_pool import ConnectionPool
+from ingest_scheduler import IngestScheduler
+from jobs import ACTIVE_STATES, JobRunner, JobStore, run_ingest
+from snow.local_warehouse import LocalDatabase, LocalWarehouseHandler
+
+
+class PooledLocalHandler(LocalWarehouseHandler):
+    """
+    A local handler that holds a slot of a pool from its first query until `close_connection`,
+    as a `SnowflakeHandler` holds a pooled connection.
+    """
+
+    def __init__(self, database, pool, tracer=None):
+        super().__init__(database, tracer=tracer)
+        self.pool = pool
+        self.slot = None
+
+    def load_staging_files(self, valid_files):
+        self._borrow()
+        return super().load_staging_files(valid_files)
+
+    def reset_pipeline(self, expected_rows=None, load_ids=None, progress=None):
+        self._borrow()
+        return super().reset_pipeline(expected_rows, load_ids, progress)
+
+    def run_merge_pipeline(self, load_ids=None, mode=None):
+        self._borrow()
+        return super().run_merge_pipeline(load_ids, mode)
+
+    def fetch_full_data(self, view_name, user_id, columns=None, filters=None):
+        self._borrow()
+        return super().fetch_full_data(view_name, user_id, columns, filters)
+
+    def close_connection(self):
+        if self.slot is not None:
+            self.pool.release(self.slot)
+            self.slot = None
+        super().close_connection()
+
+    def _borrow(self):
+        if self.slot is None:
+            self.slot = self.pool.acquire(timeout=2)
+
+
+def wait_for_jobs(runner, job_ids, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = [runner.get(job_id) for job_id in job_ids]
+        if all(job["state"] not in ACTIVE_STATES for job in jobs):
+            return jobs
+        time.sleep(0.05)
+    raise TimeoutError("The jobs did not finish in time")
+
+
+def test_direct_ingest_burst_does_not_starve_the_scheduler(secrets, tmp_path):
+    # more jobs than pooled connections: a job waiting on its batch must not hold a connection
+    database = LocalDatabase()
+    pool = ConnectionPool(object, max_size=2)
+    scheduler = IngestScheduler(lambda tracer: PooledLocalHandler(database, pool, tracer), window=0.2)
+    runner = JobRunner(JobStore(tmp_path), max_workers=4)
+
+    job_ids = []
+    for user_id in ["u1", "u2", "u3", "u4"]:
+        valid_files, row_counts, load_ids = validate_files(user_id)
+        job_ids.append(runner.submit(
+            user_id, run_ingest, valid_files, row_counts, list(load_ids.values()), user_id, None,
+            lambda: PooledLocalHandler(database, pool), scheduler,
+        ))
+    jobs = wait_for_jobs(runner, job_ids)
+
+    assert [job["error"] for job in jobs] == [None] * 4
+    assert [job["state"] for job in jobs] == ["ready"] * 4
+    assert scheduler.stats()["failures"] == 0
+    assert pool.stats()["idle"] == pool.stats()["open"]
+
+
+def test_stats_are_counted_in_memory_without_keeping_finished_jobs(tmp_path):
+    def job(update, fail):
+        update(state="loading")
+        if fail:
+            raise ValueError("failed")
+        return {}
+
+    runner = JobRunner(JobStore(tmp_path), max_workers=2)
+    job_ids = [runner.submit("user", job, fail) for fail in [False, True, False]]
+    wait_for_jobs(runner, job_ids)
+
+    runner.store.get = None  # stats must not read the job files
+    assert runner.stats() == {"ready": 2, "failed": 1}
+    assert runner._states == {}
@@ -0,0 +1,100 @@
+import pytest
+
+from conftest import validate_files
+from snow.local_warehouse import LocalWarehouseHandler
+
+RESULTS_FILE = "data_photodynamic_therapy_results.csv"
+MERGE_KEYS = {"dim_cell_lines": "cell_line_code", "dim_drugs": "drug_code", "fac_results": "experiment_id"}
+HEADER = (
+    "experiment_id,experiment_number,cell_line_code,treatment_time,drug_code,drug_concentration,"
+    + ",".join(f"result_{i:03d}" for i in range(1, 13))
+)
+
+
+def results_csv(first_replicate):
+    """
+    Builds a results file with the experiment IDs of the sample file and a given first replicate.
+    """
+    rows = [
+        f"{experiment_id},1,cl001,{time},d001,{concentration},{first_replicate},50" + ", " * 10
+        for experiment_id, time, concentration in [(1, 0, 0), (2, 5, 20), (3, 10, 40)]
+    ]
+    return "\n".join([HEADER] + rows) + "\n"
+
+
+@pytest.fixture
+def handler(secrets):
+    handler = LocalWarehouseHandler(":memory:")
+    yield handler
+    handler.close_connection()
+
+
+def load(handler, user_id, contents=None):
+    valid_files, row_counts, load_ids = validate_files(user_id, contents)
+    assert handler.load_staging_files(valid_files) == {
+        handler.staging_tables[file_name]: rows for file_name, rows in row_counts.items()
+    }
+    return load_ids
+
+
+@pytest.mark.parametrize("mode", ["concurrent", "transaction"])
+def test_merged_load_is_served_from_combined_results(handler, mode):
+    load_ids = list(load(handler, "user").values())
+
+    handler.run_merge_pipeline(load_ids, mode=mode)
+    data = handler.fetch_full_data("combined_results", "user")
+
+    assert sorted(data["EXPERIMENT_ID"]) == [1, 2, 3]
+    assert set(data["CELL_LINE_NAME"]) == {"cell line name1"}
+    assert set(data["DRUG_NAME"]) == {"drug1 name"}
+    assert list(data.sort_values("EXPERIMENT_ID")["RESULT_001"]) == [100, 50, 33]
+    assert data["RESULT_006"].isna().all()
+    assert handler.count_staging_rows(load_ids) == {"stg_cell_lines": 0, "stg_drugs": 0, "stg_results": 0}
+
+
+@pytest.mark.parametrize("mode", ["concurrent", "transaction"])
+def test_same_keys_uploaded_twice_in_one_batch_merge_once(handler, mode):
+    first = load(handler, "user", {RESULTS_FILE: results_csv(10)})
+    second = load(handler, "user", {RESULTS_FILE: results_csv(20)})
+
+    handler.run_merge_pipeline(list(first.values()) + list(second.values()), mode=mode)
+    data = handler.fetch_full_data("combined_results", "user")
+
+    # the source keeps the row of the greatest load_id per key, as the QUALIFY on Snowflake does
+    latest = 10 if first[RESULTS_FILE] > second[RESULTS_FILE] else 20
+    assert sorted(data["EXPERIMENT_ID"]) == [1, 2, 3]
+    assert set(data["RESULT_001"]) == {latest}
+    for table, key in MERGE_KEYS.items():
+        keys = handler.conn.execute(f"SELECT COUNT(*), COUNT(DISTINCT {key}) FROM {table}").fetchone()
+        assert keys[0] == keys[1]
+
+
+def test_merge_clears_only_the_merged_loads(handler):
+    merged = list(load(handler, "user", {RESULTS_FILE: results_csv(10)}).values())
+    pending = list(load(handler, "other", {RESULTS_FILE: results_csv(20)}).values())
+
+    handler.run_merge_pipeline(merged)
+
+    assert handler.count_staging_rows(merged) == {"stg_cell_lines": 0, "stg_drugs": 0, "stg_results": 0}
+    assert handler.count_staging_rows(pending) == {"stg_cell_lines": 2, "stg_drugs": 2, "stg_results": 3}
+    assert handler.fetch_full_data("combined_results", "other").empty
+
+
+def test_clear_staging_keeps_other_loads(handler):
+    cleared = list(load(handler, "user", {RESULTS_FILE: results_csv(10)}).values())
+    kept = list(load(handler, "other", {RESULTS_FILE: results_csv(20)}).values())
+
+    handler.clear_staging(cleared)
+
+    assert handler.count_staging_rows(cleared) == {"stg_cell_lines": 0, "stg_drugs": 0, "stg_results": 0}
+    assert handler.count_staging_rows(kept) == {"stg_cell_lines": 2, "stg_drugs": 2, "stg_results": 3}
+
+
+def test_empty_load_and_filter_lists_match_nothing(handler):
+    load_ids = list(load(handler, "user").values())
+    handler.run_merge_pipeline(load_ids[:1])
+
+    assert handler.count_staging_rows([]) == {"stg_cell_lines": 0, "stg_drugs": 0, "stg_results": 0}
+    handler.clear_staging([])
+    assert handler.count_staging_rows(load_ids[1:]) == {"stg_cell_lines": 0, "stg_drugs": 2, "stg_results": 3}
+    assert handler.fetch_full_data("combined_results", "user", filters={"EXPERIMENT_NUMBER": []}).empty
@@ -0,0 +1,19 @@
+from data_handler import DataHandler
+from report import ReportBuilder
+
+
+def test_eviction_skips_directories_being_built(tmp_path):
+    builder = ReportBuilder(DataHandler(), tmp_path, max_disk_bytes=0)
+    for version in ["old", "building"]:
+        (tmp_path / version).mkdir()
+        (tmp_path / version / "plot-page.pdf").write_bytes(b"%PDF" * 100)
+    builder._building[tmp_path / "building"] = 1
+
+    builder._evict_disk()
+
+    assert not (tmp_path / "old").exists()
+    assert (tmp_path / "building" / "plot-page.pdf").exists()
+
+    del builder._building[tmp_path / "building"]
+    builder._evict_disk()
+    assert not (tmp_path / "building").exists()
@@ -0,0 +1,68 @@
+import pytest
+
+from conftest import validate_files
+from result_cache import ResultCache
+from snow.local_warehouse import LocalWarehouseHandler
+
+CELL_LINES_FILE = "data_photodynamic_therapy_cell_lines.csv"
+RESULTS_FILE = "data_photodynamic_therapy_results.csv"
+
+
+def other_results(experiment_id):
+    """
+    Builds a results file with one experiment on codes the sample files do not use.
+    """
+    return (
+        "experiment_id,experiment_number,cell_line_code,treatment_time,drug_code,drug_concentration,"
+        + ",".join(f"result_{i:03d}" for i in range(1, 13)) + "\n"
+        + f"{experiment_id},1,cl009,0,d009,0,100,101" + ", " * 10 + "\n"
+    )
+
+
+@pytest.fixture
+def handler(secrets, tmp_path):
+    handler = LocalWarehouseHandler(":memory:", cache=ResultCache(tmp_path))
+    yield handler
+    handler.close_connection()
+
+
+def merge(handler, user_id, contents=None):
+    valid_files, _, load_ids = validate_files(user_id, contents)
+    handler.load_staging_files(valid_files)
+    handler.run_merge_pipeline(list(load_ids.values()))
+    handler.cache.invalidate(user_id)
+
+
+def test_renamed_cell_line_invalidates_the_users_referencing_it(handler):
+    merge(handler, "a")
+    merge(handler, "c", {RESULTS_FILE: other_results(100)})
+    handler.fetch_full_data("combined_results", "a")
+    handler.fetch_full_data("combined_results", "c")
+
+    merge(handler, "b", {
+        CELL_LINES_FILE: "cell_line_code,cell_line_name\ncl001,renamed\n", RESULTS_FILE: other_results(200),
+    })
+
+    assert not handler.cache.has_results("a")
+    assert handler.cache.has_results("c")
+    data = handler.fetch_full_data("combined_results", "a")
+    assert set(data["CELL_LINE_NAME"]) == {"renamed"}
+
+
+def test_unchanged_dimensions_keep_other_users_cached(handler):
+    merge(handler, "a")
+    handler.fetch_full_data("combined_results", "a")
+
+    merge(handler, "b", {RESULTS_FILE: other_results(200)})
+
+    assert handler.cache.has_results("a")
+
+
+def test_reuploaded_experiment_invalidates_its_previous_owner(handler):
+    merge(handler, "a")
+    handler.fetch_full_data("combined_results", "a")
+
+    merge(handler, "b")
+
+    assert not handler.cache.has_results("a")
+    assert handler.fetch_full_data("combined_results", "a").empty
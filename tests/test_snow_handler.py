@@ -0,0 +1,22 @@
+import pytest
+
+from snow.snow_handler import build_select
+
+
+def test_build_select_filters():
+    query, params = build_select("combined_results", ["EXPERIMENT_NUMBER"], {"USER_ID": "u", "DRUG_NAME": ["a", "b"]}, distinct=True)
+
+    assert query == "SELECT DISTINCT EXPERIMENT_NUMBER FROM combined_results WHERE USER_ID = %s AND DRUG_NAME IN (%s, %s)"
+    assert params == ("u", "a", "b")
+
+
+def test_build_select_with_an_empty_list_matches_nothing():
+    query, params = build_select("combined_results", filters={"USER_ID": "u", "DRUG_NAME": []}, placeholder="?")
+
+    assert query == "SELECT * FROM combined_results WHERE USER_ID = ? AND 1 = 0"
+    assert params == ("u",)
+
+
+def test_build_select_rejects_invalid_identifiers():
+    with pytest.raises(ValueError):
+        build_select("combined_results; DROP TABLE fac_results")
@@ -0,0 +1,41 @@
+import io
+import json
+
+from aws.aws_handler import AWSHandler
+from aws.local_storage import LocalStorageClient
+from tracing import Tracer
+
+
+def test_spans_of_worker_threads_nest_under_the_submitting_span(secrets, tmp_path):
+    secrets.update(
+        aws_secret_access_key="key", aws_access_key_id="id", s3_bucket_name="bucket", aws_default_region="region",
+    )
+    tracer = Tracer()
+    handler = AWSHandler(LocalStorageClient(tmp_path), tracer)
+
+    handler.upload_files([(f"file{i}.csv", io.BytesIO(b"a,b\n1,2\n" * (i + 1))) for i in range(3)])
+
+    spans = {span["span_id"]: span for span in tracer.spans}
+    root = next(span for span in tracer.spans if span["name"] == "AWSHandler.upload_files")
+    uploads = [span for span in tracer.spans if span["name"] == "AWSHandler.upload_file"]
+    assert root["parent_id"] is None
+    assert len(uploads) == 3
+    assert all(span["parent_id"] == root["span_id"] for span in uploads)
+    assert all(spans[span["parent_id"]]["name"] == "AWSHandler.upload_file"
+               for span in tracer.spans if span["name"] == "AWSHandler.object_exists")
+
+
+def test_export_is_skipped_without_new_spans(tmp_path):
+    tracer = Tracer()
+    with tracer.span("stage"):
+        pass
+    path = tracer.export(tmp_path)
+
+    path.write_text("{}")
+    tracer.export(tmp_path)
+    assert path.read_text() == "{}"
+
+    with tracer.span("stage"):
+        pass
+    tracer.export(tmp_path)
+    assert len(json.loads(path.read_text())["spans"]) == 2
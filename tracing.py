@@ -0,0 +1,272 @@
+from contextlib import contextmanager
+import functools
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+import uuid
+import pandas as pd
+
+class Tracer:
+    """
+    Records timed spans of the pipeline stages of one session.
+
+    A span is opened with `span` around a stage (e.g. an upload, a merge or a fetch), nests
+    under the span that is open in the same thread, and records its duration along with
+    attributes such as row and byte counts or Snowflake query IDs.
+
+    Attributes:
+    ----------
+    session_id : str
+        The identifier of the session, used as the name of the exported trace.
+    user_id : str or None
+        The user of the session, stored with the exported trace.
+    spans : list of dict
+        The finished spans, oldest first.
+    max_spans : int
+        The maximum number of spans kept; older spans are dropped first.
+    """
+
+    def __init__(self, session_id=None, user_id=None, max_spans=1000):
+        """
+        Initializes an empty tracer.
+
+        Parameters:
+        ----------
+        session_id : str, optional
+            The identifier of the session. Defaults to a random one.
+        user_id : str, optional
+            The user of the session.
+        max_spans : int
+            The maximum number of spans kept.
+        """
+        self.session_id = session_id or uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.spans = []
+        self.max_spans = max_spans
+        self._recorded = 0
+        self._exported = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the enclosed block as a span.
+
+        Parameters:
+        ----------
+        name : str
+            The name of the stage, e.g. "SnowflakeHandler.fetch_full_data".
+        **attributes
+            Initial attributes of the span.
+
+        Yields:
+        ------
+        dict
+            The attributes of the span, to add e.g. "rows" or "bytes" to.
+        """
+        stack = self._stack()
+        record = {
+            "name": name,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": stack[-1]["span_id"] if stack else None,
+            "started_at": time.time(),
+            "seconds": None,
+            "error": None,
+            "attributes": dict(attributes),
+        }
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record["attributes"]
+        except BaseException as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.spans.append(record)
+                del self.spans[:-self.max_spans]
+                self._recorded += 1
+
+    def current(self):
+        """
+        Returns the attributes of the innermost open span of the calling thread.
+
+        Returns:
+        -------
+        dict
+            The attributes, or an empty dict that is discarded if no span is open.
+        """
+        stack = self._stack()
+        return stack[-1]["attributes"] if stack else {}
+
+    def current_span_id(self):
+        """
+        Returns the ID of the innermost open span of the calling thread, or None.
+        """
+        stack = self._stack()
+        return stack[-1]["span_id"] if stack else None
+
+    @contextmanager
+    def nested_under(self, parent_id):
+        """
+        Nests the spans opened in the enclosed block under a span of another thread, since
+        every thread has its own span stack (e.g. in a worker of a thread pool).
+
+        Parameters:
+        ----------
+        parent_id : str or None
+            The span to nest under, from `current_span_id` in the submitting thread.
+        """
+        stack = self._stack()
+        stack.append({"span_id": parent_id, "attributes": {}})
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def add_spans(self, spans, parent_id=None):
+        """
+        Adds spans recorded by another tracer, e.g. the shared ingest batch of several sessions.
+
+        Parameters:
+        ----------
+        spans : list of dict
+            The finished spans, as in `spans`. They are copied.
+        parent_id : str, optional
+            The span the root spans are nested under, e.g. from `current_span_id`.
+        """
+        copies = [
+            {**span, "attributes": dict(span["attributes"]), "parent_id": span["parent_id"] or parent_id}
+            for span in spans
+        ]
+        with self._lock:
+            self.spans.extend(copies)
+            del self.spans[:-self.max_spans]
+            self._recorded += len(copies)
+
+    def add_query_id(self, cursor):
+        """
+        Records the Snowflake query ID of a cursor's last query on the current span.
+
+        Parameters:
+        ----------
+        cursor : snowflake.connector.cursor.SnowflakeCursor
+            The cursor that ran the query.
+        """
+        query_id = getattr(cursor, "sfqid", None)
+        if query_id:
+            self.current().setdefault("query_ids", []).append(query_id)
+
+    def to_frame(self):
+        """
+        Returns the finished spans as a table, newest first.
+
+        Returns:
+        -------
+        pd.DataFrame
+            One row per span with its name, start time, duration, error and attributes.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        rows = [
+            {
+                "name": span["name"],
+                "started_at": pd.Timestamp(span["started_at"], unit="s"),
+                "seconds": round(span["seconds"], 4),
+                "error": span["error"],
+                **span["attributes"],
+            }
+            for span in reversed(spans)
+        ]
+        return pd.DataFrame(rows)
+
+    def export(self, directory):
+        """
+        Writes the trace of the session as JSON, replacing a previous export.
+        Does nothing if no span was recorded (and the user did not change) since the last export.
+
+        Parameters:
+        ----------
+        directory : str or Path
+            The directory holding one `<session_id>.json` file per session.
+
+        Returns:
+        -------
+        Path
+            The path of the trace file.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{self.session_id}.json"
+        with self._lock:
+            exported = (self._recorded, self.user_id)
+            if exported == self._exported and path.exists():
+                return path
+            trace = {"session_id": self.session_id, "user_id": self.user_id, "spans": list(self.spans)}
+        temporary_path = path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(trace, default=str))
+        os.replace(temporary_path, path)
+        self._exported = exported
+        return path
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+
+def traced(method):
+    """
+    Decorates a handler method to run in a span named "<class>.<method>".
+    The handler must have a `tracer` attribute.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.tracer.span(f"{type(self).__name__}.{method.__name__}"):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def aggregate(paths):
+    """
+    Aggregates exported traces into latency percentiles per stage.
+
+    Parameters:
+    ----------
+    paths : iterable of str or Path
+        Trace files written by `Tracer.export`, or directories holding them.
+
+    Returns:
+    -------
+    pd.DataFrame
+        The count, mean, p50, p95 and max duration in seconds of each span name,
+        slowest p95 first.
+    """
+    spans = []
+    for path in map(Path, paths):
+        for file in sorted(path.glob("*.json")) if path.is_dir() else [path]:
+            trace = json.loads(file.read_text())
+            spans.extend({"name": span["name"], "seconds": span["seconds"]} for span in trace["spans"])
+    if not spans:
+        return pd.DataFrame(columns=["count", "mean", "p50", "p95", "max"])
+
+    durations = pd.DataFrame(spans).groupby("name")["seconds"]
+    return pd.DataFrame({
+        "count": durations.count(),
+        "mean": durations.mean(),
+        "p50": durations.quantile(0.5),
+        "p95": durations.quantile(0.95),
+        "max": durations.max(),
+    }).sort_values("p95", ascending=False)
+
+
+if __name__ == "__main__":
+    # Usage: python tracing.py .cache/traces [more trace files or directories]
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(aggregate(sys.argv[1:] or [".cache/traces"]).round(4))